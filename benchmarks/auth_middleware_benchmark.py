@@ -0,0 +1,131 @@
+"""
+Micro-benchmark of the per-request overhead of the X-Auth-Token check.
+
+Compares the pure ASGI AuthMiddleware with the BaseHTTPMiddleware based implementation
+it replaced, on stand-ins for the /healthz and /token endpoints, by calling the ASGI
+app directly so no server or HTTP client time is measured.
+
+    python -m benchmarks.auth_middleware_benchmark --requests 20000
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from fastapi import FastAPI, HTTPException, Request
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from src.auth_middleware import AuthMiddleware
+
+SECRET = 'benchmark-secret'
+
+
+class BaseHTTPAuthMiddleware(BaseHTTPMiddleware):
+    """
+    The previous AuthMiddleware, kept here as the baseline.
+    """
+
+    async def dispatch(self, request: Request, call_next):
+        x_auth_token = request.headers.get('X-Auth-Token')
+        if not x_auth_token:
+            raise HTTPException(status_code=400, detail="X-Auth-Token header is missing")
+        if x_auth_token != os.getenv('X_AUTH_TOKEN'):
+            raise HTTPException(status_code=403, detail="Invalid X-Auth-Token header")
+        response = await call_next(request)
+        return response
+
+
+def create_app(middleware=None):
+    app = FastAPI()
+
+    if middleware is AuthMiddleware:
+        app.add_middleware(AuthMiddleware, secrets=[SECRET])
+    elif middleware is not None:
+        app.add_middleware(middleware)
+
+    @app.get("/healthz")
+    async def health_check():
+        return {"status": "up"}
+
+    @app.post("/token/{user_id}")
+    async def get_token(user_id: str):
+        return {"accessToken": "token", "expires_on": 0, "tokenType": "Bearer"}
+
+    return app
+
+
+async def call_async(app, method: str, path: str, body: bytes):
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode('utf-8'),
+        'root_path': '',
+        'query_string': b'',
+        'headers': [
+            (b'host', b'localhost'),
+            (b'x-auth-token', SECRET.encode('utf-8')),
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('latin-1'))
+        ],
+        'client': ('127.0.0.1', 50000),
+        'server': ('localhost', 80)
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        return {'type': 'http.disconnect'}
+
+    status = []
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+
+    await app(scope, receive, send)
+    if status != [200]:
+        raise RuntimeError(f"{method} {path} returned {status}")
+
+
+async def measure_async(app, method: str, path: str, body: bytes, requests: int):
+    # warm up the middleware stack and the routes
+    for _ in range(100):
+        await call_async(app, method, path, body)
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        await call_async(app, method, path, body)
+    return (time.perf_counter() - start) / requests * 1_000_000
+
+
+async def main_async(requests: int):
+    os.environ['X_AUTH_TOKEN'] = SECRET
+
+    apps = {
+        'none': create_app(),
+        'base_http': create_app(BaseHTTPAuthMiddleware),
+        'asgi': create_app(AuthMiddleware)
+    }
+    endpoints = {
+        '/healthz': ('GET', '/healthz', b''),
+        '/token': ('POST', '/token/user1', json.dumps({"resource": "https://graph.microsoft.com"}).encode('utf-8'))
+    }
+
+    print(f"{'endpoint':<10} {'no auth':>10} {'BaseHTTP':>10} {'ASGI':>10} {'saved':>10}   (us/request)")
+    for name, (method, path, body) in endpoints.items():
+        results = {key: await measure_async(app, method, path, body, requests) for key, app in apps.items()}
+        saved = results['base_http'] - results['asgi']
+        print(f"{name:<10} {results['none']:>10.1f} {results['base_http']:>10.1f} {results['asgi']:>10.1f} {saved:>10.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20000, help='number of requests per endpoint and middleware')
+    args = parser.parse_args()
+    asyncio.run(main_async(args.requests))
@@ -0,0 +1,161 @@
+"""
+Stand-in for the `az` executable, used by the load benchmark so no Azure login is needed.
+
+Emulates the commands the service runs: `account get-access-token`, `account list`,
+`config set`, `login --use-device-code`, `logout` and `version`. It is configured
+through environment variables:
+
+    FAKE_AZ_LATENCY        seconds every command sleeps before answering (default 0.05)
+    FAKE_AZ_LATENCY_<CMD>  latency of one command, e.g. FAKE_AZ_LATENCY_GET_ACCESS_TOKEN
+    FAKE_AZ_LOGIN_DELAY    seconds between printing the device code and the login completing (default 0.5)
+    FAKE_AZ_MSAL_TOKENS    comma separated resources the login writes to the MSAL token cache
+    FAKE_AZ_LOG            file every invocation appends its subcommand to, to count spawns
+"""
+import datetime
+import json
+import os
+import sys
+import time
+
+PROFILE_FILE_NAME = 'azureProfile.json'
+TOKEN_CACHE_FILE_NAME = 'msal_token_cache.json'
+
+CLIENT_ID = '04b07795-8ddb-461a-bbee-02f9e1bf7b46'
+TENANT_ID = 'aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa'
+SUBSCRIPTIONS = [
+    {"id": "11111111-1111-1111-1111-111111111111", "name": "Default Subscription", "state": "Enabled",
+     "user": {"name": "user@contoso.com", "type": "user"}, "isDefault": True, "tenantId": TENANT_ID,
+     "environmentName": "AzureCloud", "homeTenantId": TENANT_ID, "managedByTenants": []},
+    {"id": "22222222-2222-2222-2222-222222222222", "name": "Other Subscription", "state": "Disabled",
+     "user": {"name": "user@contoso.com", "type": "user"}, "isDefault": False, "tenantId": TENANT_ID,
+     "environmentName": "AzureCloud", "homeTenantId": TENANT_ID, "managedByTenants": []}
+]
+TOKEN_LIFETIME = 3600
+
+
+def get_command_name(args: list):
+    words = []
+    for arg in args:
+        if arg.startswith('-'):
+            break
+        words.append(arg)
+    return ' '.join(words)
+
+
+def get_option(args: list, name: str):
+    if name in args and args.index(name) + 1 < len(args):
+        return args[args.index(name) + 1]
+    return None
+
+
+def sleep(command: str):
+    variable = 'FAKE_AZ_LATENCY_' + command.split(' ')[-1].upper().replace('-', '_') if command else None
+    latency = os.getenv(variable) if variable else None
+    time.sleep(float(latency if latency is not None else os.getenv('FAKE_AZ_LATENCY', '0.05')))
+
+
+def get_access_token(args: list):
+    expires_on = int(time.time()) + TOKEN_LIFETIME
+    resource = get_option(args, '--resource') or 'https://management.core.windows.net/'
+    token = {
+        "accessToken": f"fake-token-{resource}",
+        "expiresOn": datetime.datetime.fromtimestamp(expires_on).strftime('%Y-%m-%d %H:%M:%S.%f'),
+        "expires_on": expires_on,
+        "tenant": get_option(args, '--tenant') or TENANT_ID,
+        "tokenType": "Bearer"
+    }
+    if not get_option(args, '--tenant'):
+        token["subscription"] = get_option(args, '--subscription') or SUBSCRIPTIONS[0]["id"]
+    return token
+
+
+def login(config_dir: str):
+    print("To sign in, use a web browser to open the page https://microsoft.com/devicelogin "
+          "and enter the code FAKECODE1 to authenticate.", file=sys.stderr, flush=True)
+    time.sleep(float(os.getenv('FAKE_AZ_LOGIN_DELAY', '0.5')))
+
+    expires_on = str(int(time.time()) + TOKEN_LIFETIME)
+    access_tokens = {}
+    for resource in filter(None, os.getenv('FAKE_AZ_MSAL_TOKENS', '').split(',')):
+        access_tokens[resource] = {
+            "home_account_id": "uid.utid",
+            "environment": "login.microsoftonline.com",
+            "credential_type": "AccessToken",
+            "client_id": CLIENT_ID,
+            "secret": f"fake-msal-token-{resource}",
+            "realm": TENANT_ID,
+            "target": f"{resource.rstrip('/')}/.default",
+            "token_type": "Bearer",
+            "cached_at": str(int(time.time())),
+            "expires_on": expires_on,
+            "extended_expires_on": expires_on
+        }
+
+    token_cache = {
+        "Account": {
+            f"uid.utid-login.microsoftonline.com-{TENANT_ID}": {
+                "home_account_id": "uid.utid",
+                "environment": "login.microsoftonline.com",
+                "realm": TENANT_ID,
+                "local_account_id": "uid",
+                "username": "user@contoso.com",
+                "authority_type": "MSSTS"
+            }
+        },
+        "AccessToken": access_tokens,
+        "RefreshToken": {},
+        "IdToken": {},
+        "AppMetadata": {}
+    }
+    with open(os.path.join(config_dir, TOKEN_CACHE_FILE_NAME), 'w') as f:
+        json.dump(token_cache, f)
+    with open(os.path.join(config_dir, PROFILE_FILE_NAME), 'w', encoding='utf-8-sig') as f:
+        json.dump({"installationId": "00000000-0000-0000-0000-000000000000", "subscriptions": SUBSCRIPTIONS}, f)
+
+    print(json.dumps(SUBSCRIPTIONS))
+
+
+def logout(config_dir: str):
+    for file_name in (PROFILE_FILE_NAME, TOKEN_CACHE_FILE_NAME):
+        try:
+            os.remove(os.path.join(config_dir, file_name))
+        except FileNotFoundError:
+            pass
+
+
+def main(args: list):
+    command = get_command_name(args)
+    config_dir = os.getenv('AZURE_CONFIG_DIR', os.path.join(os.path.expanduser('~'), '.azure'))
+
+    log_path = os.getenv('FAKE_AZ_LOG')
+    if log_path:
+        # a single short append is atomic, so concurrent processes do not mix their lines
+        with open(log_path, 'a') as f:
+            f.write(command + '\n')
+
+    sleep(command)
+
+    if command == 'account get-access-token':
+        if not os.path.exists(os.path.join(config_dir, PROFILE_FILE_NAME)):
+            print("ERROR: Please run 'az login' to setup account.", file=sys.stderr)
+            return 1
+        print(json.dumps(get_access_token(args)))
+    elif command == 'account list':
+        print(json.dumps(SUBSCRIPTIONS if os.path.exists(os.path.join(config_dir, PROFILE_FILE_NAME)) else []))
+    elif command == 'login':
+        login(config_dir)
+    elif command == 'logout':
+        logout(config_dir)
+    elif command == 'version':
+        print(json.dumps({"azure-cli": "2.99.0-fake", "azure-cli-core": "2.99.0-fake", "extensions": {}}))
+    elif command == 'config set':
+        pass
+    else:
+        print(f"ERROR: '{command}' is not emulated by the fake az.", file=sys.stderr)
+        return 2
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,268 @@
+"""
+Load benchmark of the service against a fake `az` executable.
+
+Puts benchmarks/fake_az.py on PATH as `az`, logs users in with device codes, then
+sends a mix of /token, /tenant_token, /subscriptions and /healthz requests with
+several requests in flight, calling the ASGI app in-process through httpx. Reports
+throughput and p50/p95/p99 latency per endpoint, how many az processes every
+subcommand started and the peak RSS of the service.
+
+    python -m benchmarks.load_benchmark --users 20 --requests 2000 --concurrency 32
+    python -m benchmarks.load_benchmark --save-baseline benchmarks/baseline.json
+    python -m benchmarks.load_benchmark --baseline benchmarks/baseline.json --threshold 0.2
+
+With --baseline the exit code is 1 when throughput dropped, or a p95/p99 latency, a
+spawn count or the peak RSS grew, by more than the threshold.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_AZ = os.path.join(PROJECT_DIR, 'benchmarks', 'fake_az.py')
+
+SECRET = 'benchmark-secret'
+RESOURCES = ['https://management.core.windows.net/', 'https://graph.microsoft.com/', 'https://vault.azure.net']
+TENANT_ID = 'aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa'
+
+# latencies below this many milliseconds are not considered a regression, they are mostly noise
+MIN_LATENCY_REGRESSION_MS = 1.0
+
+
+def install_fake_az(work_dir: str):
+    """
+    Creates an `az` shim running fake_az.py and points PATH, HOME and FAKE_AZ_LOG at the work directory.
+    """
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    az = os.path.join(bin_dir, 'az')
+    with open(az, 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_AZ}" "$@"\n')
+    os.chmod(az, 0o755)
+
+    os.environ['PATH'] = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+    # the per-user AZURE_CONFIG_DIRs are created under ~/.temp
+    os.environ['HOME'] = work_dir
+    os.environ['FAKE_AZ_LOG'] = os.path.join(work_dir, 'az.log')
+
+
+def count_spawns(log_path: str):
+    try:
+        with open(log_path) as f:
+            return dict(collections.Counter(line.strip() for line in f))
+    except FileNotFoundError:
+        return {}
+
+
+def percentile(sorted_values: list, percent: float):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(percent / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def build_requests(users: list):
+    """
+    The request mix, as (endpoint, method, url, body) tuples sent in a round-robin.
+    """
+    requests = []
+    for user_id in users:
+        for resource in RESOURCES:
+            requests.append(('/token', 'POST', f'/token/{user_id}', {'resource': resource}))
+        requests.append(('/tenant_token', 'POST', f'/tenant_token/{user_id}',
+                         {'resource': RESOURCES[0], 'tenantId': TENANT_ID}))
+        requests.append(('/subscriptions', 'GET', f'/subscriptions/{user_id}', None))
+    requests.append(('/healthz', 'GET', '/healthz', None))
+    return requests
+
+
+def check_request_bodies(requests: list, models: dict):
+    """
+    Raises ValueError when a body does not round-trip through the model of its endpoint.
+
+    Pydantic drops unknown fields, so a misspelled one would silently measure another request.
+    """
+    for endpoint, method, url, body in requests:
+        model = models.get(endpoint)
+        if model is None or body is None:
+            continue
+        parsed = model(**body).model_dump(exclude_unset=True)
+        if parsed != body:
+            raise ValueError(f"The {endpoint} body {body} is read by the service as {parsed}")
+
+
+async def login_users_async(client, users: list):
+    for user_id in users:
+        response = await client.post(f'/device-code/{user_id}')
+        response.raise_for_status()
+
+    for user_id in users:
+        response = await client.get(f'/login-status/{user_id}', params={'timeout': 30})
+        response.raise_for_status()
+        if response.json()['status'] != 'succeeded':
+            raise RuntimeError(f"Login of {user_id} did not succeed: {response.json()}")
+
+
+async def run_load_async(client, requests: list, total: int, concurrency: int):
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index
+        while next_index < total:
+            endpoint, method, url, body = requests[next_index % len(requests)]
+            next_index += 1
+
+            start = time.perf_counter()
+            response = await client.request(method, url, json=body)
+            latencies[endpoint].append((time.perf_counter() - start) * 1000)
+            if response.status_code != 200:
+                errors[endpoint] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+
+async def main_async(args):
+    # the service reads its settings when it is imported
+    os.environ['X_AUTH_TOKEN'] = SECRET
+    os.environ.setdefault('LOGGING_LEVEL', 'WARNING')
+    os.environ.setdefault('TOKEN_REFRESH_ENABLED', 'false')
+
+    import httpx
+    from src.api import app, TenantTokenRequest, TokenRequest
+
+    users = [f'user{index}' for index in range(args.users)]
+    requests = build_requests(users)
+    check_request_bodies(requests, {'/token': TokenRequest, '/tenant_token': TenantTokenRequest})
+    transport = httpx.ASGITransport(app=app)
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark',
+                                     headers={'X-Auth-Token': SECRET}, timeout=120) as client:
+            await login_users_async(client, users)
+            setup_spawns = count_spawns(os.environ['FAKE_AZ_LOG'])
+
+            latencies, errors, elapsed = await run_load_async(client, requests, args.requests, args.concurrency)
+
+    spawns = count_spawns(os.environ['FAKE_AZ_LOG'])
+    load_spawns = {command: count - setup_spawns.get(command, 0) for command, count in spawns.items()}
+
+    endpoints = {}
+    for endpoint, values in sorted(latencies.items()):
+        values.sort()
+        endpoints[endpoint] = {
+            'requests': len(values),
+            'errors': errors[endpoint],
+            'p50_ms': round(percentile(values, 50), 3),
+            'p95_ms': round(percentile(values, 95), 3),
+            'p99_ms': round(percentile(values, 99), 3)
+        }
+
+    return {
+        'config': {
+            'users': args.users,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'az_latency': float(os.environ['FAKE_AZ_LATENCY']),
+            'msal_cache': args.msal_cache,
+            'az_engine': os.getenv('AZ_ENGINE', 'subprocess')
+        },
+        'throughput_rps': round(args.requests / elapsed, 1),
+        'endpoints': endpoints,
+        'spawns': {'setup': setup_spawns, 'load': {command: count for command, count in load_spawns.items() if count}},
+        # ru_maxrss is in kilobytes on Linux. The one of the children is not reported, it
+        # includes the pages az processes share with the service right after the fork.
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+
+def print_report(result: dict):
+    print(f"throughput: {result['throughput_rps']} requests/s")
+    print(f"{'endpoint':<16} {'requests':>9} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for endpoint, stats in result['endpoints'].items():
+        print(f"{endpoint:<16} {stats['requests']:>9} {stats['errors']:>7} "
+              f"{stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f}")
+    for phase, spawns in result['spawns'].items():
+        print(f"az processes ({phase}): " + (', '.join(f'{command}={count}' for command, count in sorted(spawns.items())) or 'none'))
+    print(f"peak RSS: {result['peak_rss_mb']} MB")
+
+
+def compare(result: dict, baseline: dict, threshold: float):
+    """
+    Returns the regressions of the result against the baseline, as readable lines.
+    """
+    regressions = []
+
+    if result['throughput_rps'] < baseline['throughput_rps'] * (1 - threshold):
+        regressions.append(f"throughput {result['throughput_rps']} < baseline {baseline['throughput_rps']} requests/s")
+
+    for endpoint, stats in baseline['endpoints'].items():
+        current = result['endpoints'].get(endpoint)
+        if current is None:
+            continue
+        for key in ('p95_ms', 'p99_ms'):
+            limit = max(stats[key] * (1 + threshold), stats[key] + MIN_LATENCY_REGRESSION_MS)
+            if current[key] > limit:
+                regressions.append(f"{endpoint} {key} {current[key]} > baseline {stats[key]}")
+
+    for command, count in result['spawns']['load'].items():
+        expected = baseline['spawns']['load'].get(command, 0)
+        if count > expected * (1 + threshold):
+            regressions.append(f"'az {command}' started {count} times > baseline {expected}")
+
+    if result['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + threshold):
+        regressions.append(f"peak RSS {result['peak_rss_mb']} MB > baseline {baseline['peak_rss_mb']} MB")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20, help='number of logged in users')
+    parser.add_argument('--requests', type=int, default=2000, help='number of requests sent after the logins')
+    parser.add_argument('--concurrency', type=int, default=32, help='number of requests in flight')
+    parser.add_argument('--az-latency', type=float, default=0.05, help='seconds every fake az command takes')
+    parser.add_argument('--msal-cache', action='store_true',
+                        help='let the fake login write the tokens to the MSAL token cache, so they are read without az')
+    parser.add_argument('--save-baseline', metavar='PATH', help='write the results to this JSON file')
+    parser.add_argument('--baseline', metavar='PATH', help='compare the results with this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative regression, e.g. 0.2 for 20%%')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='tokenflow-benchmark-') as work_dir:
+        install_fake_az(work_dir)
+        os.environ['FAKE_AZ_LATENCY'] = str(args.az_latency)
+        if args.msal_cache:
+            os.environ['FAKE_AZ_MSAL_TOKENS'] = ','.join(RESOURCES)
+
+        result = asyncio.run(main_async(args))
+
+    print_report(result)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.threshold)
+        if regressions:
+            print("regressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"no regression beyond {args.threshold:.0%} of the baseline")
+
+
+if __name__ == '__main__':
+    main()
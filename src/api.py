@@ -1,30 +1,275 @@
+import asyncio
+import hashlib
+import json
 import logging
 import os
-from fastapi import Body, FastAPI, HTTPException, Path
+from contextlib import asynccontextmanager
+from fastapi import Body, Depends, FastAPI, Header, HTTPException, Path, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
-
-from src.auth_middleware import AuthMiddleware
+from typing import List, Optional
+
+from src import metrics
+from src.auth_middleware import AuthMiddleware, parse_auth_tokens
+from src.az_errors import (AzCommandError, RetryPolicy, ERROR_CLASS_LOGIN_REQUIRED, ERROR_CLASS_PERMANENT,
+                           ERROR_CLASS_TRANSIENT)
+from src.az_scheduler import AzProcessScheduler, SchedulerBusyError
+from src.az_worker_pool import AzWorkerPool
+from src.config_dirs import ConfigDirManager, InvalidUserIdError, normalize_user_id
+from src.device_code_sessions import DeviceCodeSessionRegistry, SessionLimitError
+from src.health import HealthMonitor
+from src.logging_config import CorrelationIdMiddleware, configure_logging
+from src.login_state import LOGIN_STATE_DIR_NAME, FileLoginStateBackend, MemoryLoginStateBackend
+from src.subscription_cache import filter_subscriptions
 from src.token_authenticator import AzureAuthenticator
+from src.token_cache import TokenCache
+from src.token_refresher import TokenRefresher
+from src.token_store import TOKEN_STORE_FILE_NAME, TokenStore
 
 
-# Get logging level from environment variable
+# Get logging settings from environment variables
 logging_level = os.getenv('LOGGING_LEVEL', 'INFO')
+log_format = os.getenv('LOG_FORMAT', 'json')
+log_rate_limit = float(os.getenv('LOG_RATE_LIMIT', '10'))
+log_rate_burst = int(os.getenv('LOG_RATE_BURST', '20'))
 
-# Set logging level
-logging.basicConfig(level=getattr(logging, logging_level.upper()))
+# Write the logs from a background thread, so requests never wait for stdout
+log_listener = configure_logging(logging_level, log_format, log_rate_limit, log_rate_burst)
 
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# Get the shared secrets once, a comma separated list allows rotating them
+x_auth_tokens = parse_auth_tokens(os.getenv('X_AUTH_TOKEN'))
+if not x_auth_tokens:
+    raise ValueError("X_AUTH_TOKEN environment variable is not set")
 
-app.add_middleware(AuthMiddleware)
+# Get token cache settings from environment variables
+token_cache_max_size = int(os.getenv('TOKEN_CACHE_MAX_SIZE', '1024'))
+# below az's 5 minute renewal window, so background refreshes get a new token while the cached one is served
+token_cache_refresh_margin = int(os.getenv('TOKEN_CACHE_REFRESH_MARGIN', '120'))
+
+# Get the number of seconds a token request waits for a pending device code login
+login_wait_timeout = float(os.getenv('LOGIN_WAIT_TIMEOUT', '45'))
+
+# Get device code session settings from environment variables, the TTL matches the device code lifetime.
+# Every pending login is an az process of about 100 MB, the limit bounds their memory
+device_code_max_pending = int(os.getenv('DEVICE_CODE_MAX_PENDING', '10'))
+device_code_session_ttl = float(os.getenv('DEVICE_CODE_SESSION_TTL', '900'))
+device_code_reap_interval = float(os.getenv('DEVICE_CODE_REAP_INTERVAL', '30'))
+
+# Get the login state backend from environment variables, 'file' shares the logins between workers, 'memory' does not
+login_state_backend = os.getenv('LOGIN_STATE_BACKEND', 'file')
+if login_state_backend == 'file':
+    login_state = FileLoginStateBackend(
+        os.getenv('LOGIN_STATE_DIR', os.path.join(os.path.expanduser('~'), '.temp', LOGIN_STATE_DIR_NAME)))
+elif login_state_backend == 'memory':
+    login_state = MemoryLoginStateBackend()
+else:
+    raise ValueError(f"LOGIN_STATE_BACKEND must be 'file' or 'memory', not '{login_state_backend}'")
+
+# Get az process scheduler settings from environment variables, every az process takes about 100 MB so the
+# default is sized to memory rather than to the CPUs of the node, which ignore the container limits
+az_max_concurrency = int(os.getenv('AZ_MAX_CONCURRENCY', '4'))
+az_max_concurrency_per_user = int(os.getenv('AZ_MAX_CONCURRENCY_PER_USER', '2'))
+az_max_queue_depth = int(os.getenv('AZ_MAX_QUEUE_DEPTH', '100'))
+az_max_queue_wait = float(os.getenv('AZ_MAX_QUEUE_WAIT', '30'))
+az_retry_after = int(os.getenv('AZ_RETRY_AFTER', '5'))
+
+# Get the retry policy of token requests from environment variables, transient az errors are retried until the deadline
+auth_retry_deadline = float(os.getenv('AUTH_RETRY_DEADLINE', '45'))
+auth_retry_policy = RetryPolicy(initial_delay=float(os.getenv('AUTH_RETRY_INITIAL_DELAY', '1')),
+                                max_delay=float(os.getenv('AUTH_RETRY_MAX_DELAY', '15')))
+
+# Get config directory garbage collection settings from environment variables, 0 disables the TTL and the quota
+config_dirs = ConfigDirManager(idle_ttl=float(os.getenv('CONFIG_DIR_IDLE_TTL', str(30 * 24 * 3600))),
+                               max_total_size=int(float(os.getenv('CONFIG_DIR_MAX_TOTAL_SIZE_MB', '0')) * 1024 * 1024),
+                               gc_interval=float(os.getenv('CONFIG_DIR_GC_INTERVAL', '3600')),
+                               trim_age=float(os.getenv('CONFIG_DIR_TRIM_AGE', str(24 * 3600))))
+
+authenticator = AzureAuthenticator(
+    token_cache=TokenCache(max_size=token_cache_max_size, refresh_margin=token_cache_refresh_margin),
+    scheduler=AzProcessScheduler(max_concurrency=az_max_concurrency,
+                                 per_user_concurrency=az_max_concurrency_per_user,
+                                 max_queue_depth=az_max_queue_depth,
+                                 max_wait_seconds=az_max_queue_wait,
+                                 retry_after=az_retry_after),
+    login_wait_timeout=login_wait_timeout,
+    retry_policy=auth_retry_policy,
+    retry_deadline=auth_retry_deadline,
+    config_dirs=config_dirs,
+    sessions=DeviceCodeSessionRegistry(max_pending=device_code_max_pending,
+                                       ttl=device_code_session_ttl,
+                                       reap_interval=device_code_reap_interval,
+                                       backend=login_state))
+
+# Get persistent token store settings from environment variables, tokens are encrypted with TOKEN_STORE_KEY
+if os.getenv('TOKEN_STORE_ENABLED', 'false').lower() == 'true':
+    token_store_key = os.getenv('TOKEN_STORE_KEY')
+    if not token_store_key:
+        raise ValueError("TOKEN_STORE_KEY environment variable is not set")
+    authenticator.token_store = TokenStore(
+        os.getenv('TOKEN_STORE_PATH', os.path.join(os.path.expanduser('~'), '.temp', TOKEN_STORE_FILE_NAME)),
+        token_store_key,
+        flush_interval=float(os.getenv('TOKEN_STORE_FLUSH_INTERVAL', '1')),
+        prune_interval=float(os.getenv('TOKEN_STORE_PRUNE_INTERVAL', '300')))
+
+# Get az engine settings from environment variables, 'subprocess' or 'worker_pool'
+az_engine = os.getenv('AZ_ENGINE', 'subprocess')
+if az_engine == 'worker_pool':
+    authenticator.worker_pool = AzWorkerPool(size=int(os.getenv('AZ_WORKER_POOL_SIZE', '2')),
+                                             max_jobs_per_worker=int(os.getenv('AZ_WORKER_MAX_JOBS', '100')),
+                                             job_timeout=float(os.getenv('AZ_WORKER_JOB_TIMEOUT', '120')))
+elif az_engine != 'subprocess':
+    raise ValueError(f"AZ_ENGINE must be 'subprocess' or 'worker_pool', not '{az_engine}'")
+
+
+# Get batch token settings from environment variables
+batch_max_concurrency = int(os.getenv('BATCH_MAX_CONCURRENCY', '8'))
+
+# Get background token refresh settings from environment variables
+token_refresh_enabled = os.getenv('TOKEN_REFRESH_ENABLED', 'true').lower() == 'true'
+
+# Get the number of seconds between keep-alive comments of idle token streams
+token_stream_keepalive_interval = float(os.getenv('TOKEN_STREAM_KEEPALIVE_INTERVAL', '15'))
+
+token_refresher = TokenRefresher(authenticator,
+                                 lead_time=int(os.getenv('TOKEN_REFRESH_LEAD_TIME', '60')),
+                                 jitter=int(os.getenv('TOKEN_REFRESH_JITTER', '60')),
+                                 idle_timeout=int(os.getenv('TOKEN_REFRESH_IDLE_TIMEOUT', '3600')),
+                                 max_concurrency=int(os.getenv('TOKEN_REFRESH_MAX_CONCURRENCY', '2')))
+
+# an evicted user has to log in again, there is nothing left to refresh
+config_dirs.on_evict.append(lambda user_id, config_dir: token_refresher.untrack_user(user_id))
+
+# Get health check settings from environment variables, readiness fails once this many az commands are queued
+health_monitor = HealthMonitor(authenticator,
+                               max_queue_depth=int(os.getenv('READINESS_MAX_QUEUE_DEPTH', str(max(1, az_max_queue_depth // 2)))),
+                               deep_check_interval=float(os.getenv('HEALTH_DEEP_CHECK_INTERVAL', '0')))
+
+# Values other components already count are read when /metrics is scraped
+metrics.CallbackGauge('tokenflow_device_code_sessions_pending',
+                      'Number of device code logins waiting for the user.',
+                      lambda: authenticator.sessions.pending_count())
+metrics.CallbackGauge('tokenflow_az_queue_depth',
+                      'Number of az commands waiting for a free slot.',
+                      lambda: authenticator.scheduler.queue_depth)
+metrics.CallbackGauge('tokenflow_az_rejected_total',
+                      'Number of az commands rejected because the queue was full or the wait too long.',
+                      lambda: authenticator.scheduler.rejected, type='counter')
+metrics.CallbackGauge('tokenflow_token_cache_hits_total',
+                      'Number of tokens served from the in-memory token cache.',
+                      lambda: authenticator.token_cache.hits, type='counter')
+metrics.CallbackGauge('tokenflow_token_cache_misses_total',
+                      'Number of token requests the in-memory token cache could not serve.',
+                      lambda: authenticator.token_cache.misses, type='counter')
+metrics.CallbackGauge('tokenflow_az_commands_coalesced_total',
+                      'Number of az commands that shared the process of an identical running command.',
+                      lambda: authenticator.single_flight.coalesced, type='counter')
+metrics.CallbackGauge('tokenflow_config_dirs',
+                      'Number of per-user Azure CLI config directories, as of the last collection.',
+                      lambda: config_dirs.count)
+metrics.CallbackGauge('tokenflow_config_dirs_size_bytes',
+                      'Total size of the per-user Azure CLI config directories, as of the last collection.',
+                      lambda: config_dirs.total_size)
+metrics.CallbackGauge('tokenflow_config_dirs_evicted_total',
+                      'Number of per-user Azure CLI config directories evicted.',
+                      lambda: config_dirs.evicted, type='counter')
+metrics.CallbackGauge('tokenflow_token_refreshes_total',
+                      'Number of tokens refreshed in the background.',
+                      lambda: token_refresher.refreshed, type='counter')
+metrics.CallbackGauge('tokenflow_token_stream_subscribers',
+                      'Number of token stream subscriptions, one per stream and token.',
+                      lambda: token_refresher.stats()['subscribers'])
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    authenticator.sessions.start()
+    if token_refresh_enabled:
+        token_refresher.start()
+    if authenticator.token_store is not None:
+        authenticator.token_store.start()
+    config_dirs.start()
+    await health_monitor.start()
+
+    yield
+
+    await health_monitor.stop()
+    await config_dirs.stop()
+    await token_refresher.stop()
+    if authenticator.token_store is not None:
+        await authenticator.token_store.stop()
+    await authenticator.sessions.stop()
+
+    if authenticator.worker_pool is not None:
+        await authenticator.worker_pool.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(AuthMiddleware, secrets=x_auth_tokens)
+# added after the auth middleware so it wraps it and also times rejected requests
+app.add_middleware(metrics.MetricsMiddleware)
+# outermost, so every log line of a request carries its correlation ID
+app.add_middleware(CorrelationIdMiddleware)
+
+
+@app.exception_handler(SchedulerBusyError)
+async def scheduler_busy_handler(request: Request, e: SchedulerBusyError):
+    """
+    Fails fast with 503 when too many az commands are queued.
+    """
+    return JSONResponse(status_code=503,
+                        content={"detail": str(e)},
+                        headers={"Retry-After": str(e.retry_after)})
 
-x_auth_token = os.getenv('X_AUTH_TOKEN')
-if not x_auth_token:
-    raise ValueError("X_AUTH_TOKEN environment variable is not set")
 
-authenticator = AzureAuthenticator()
+@app.exception_handler(InvalidUserIdError)
+async def invalid_user_id_handler(request: Request, e: InvalidUserIdError):
+    return JSONResponse(status_code=400, content={"detail": str(e)})
+
+
+@app.exception_handler(SessionLimitError)
+async def session_limit_handler(request: Request, e: SessionLimitError):
+    """
+    Fails fast with 429 when too many device code logins are pending.
+    """
+    return JSONResponse(status_code=429,
+                        content={"detail": str(e)},
+                        headers={"Retry-After": str(e.retry_after)})
+
+
+@app.exception_handler(AzCommandError)
+async def az_command_error_handler(request: Request, e: AzCommandError):
+    """
+    Returns the class of an az failure with it, so clients know whether to retry or to log in again.
+    """
+    headers = None
+    if e.error_class == ERROR_CLASS_PERMANENT:
+        status_code = 400
+    elif e.error_class == ERROR_CLASS_LOGIN_REQUIRED:
+        status_code = 401
+    elif e.error_class == ERROR_CLASS_TRANSIENT:
+        status_code = 503
+        headers = {"Retry-After": str(az_retry_after)}
+    else:
+        status_code = 502
+
+    return JSONResponse(status_code=status_code,
+                        content={"detail": str(e), "error_class": e.error_class},
+                        headers=headers)
+
+
+def get_user_id(user_id: str = Path(..., description="The unique ID of the user")):
+    """
+    Validates the user ID of the path and returns it normalized, it names the user's config directory.
+    """
+    return normalize_user_id(user_id)
+
+
+# clients can bound how long a token request retries az, in seconds
+REQUEST_TIMEOUT_HEADER = Header(None, alias="X-Request-Timeout", gt=0,
+                                description="Maximum number of seconds the request may take, retries included")
 
 
 class TokenResponse(BaseModel):
@@ -41,6 +286,12 @@ class DeviceCodeResponse(BaseModel):
     device_code: str
 
 
+class LoginStatusResponse(BaseModel):
+    status: str
+    started_at: Optional[float] = None
+    completed_at: Optional[float] = None
+
+
 class TokenRequest(BaseModel):
     resource: str
 
@@ -51,8 +302,18 @@ class TenantTokenRequest(BaseModel):
     subscriptionId: str = None
 
 
+class BatchTokenResult(BaseModel):
+    index: int
+    resource: str
+    tenantId: Optional[str] = None
+    subscriptionId: Optional[str] = None
+    token: Optional[TokenResponse] = None
+    error: Optional[str] = None
+    error_class: Optional[str] = None
+
+
 @app.post("/device-code/{user_id}", response_model=DeviceCodeResponse)
-async def get_device_code(user_id: str = Path(..., description="The unique ID of the user")):
+async def get_device_code(user_id: str = Depends(get_user_id)):
     """
     Retrieves the device code for the specified user ID.
 
@@ -66,22 +327,47 @@ async def get_device_code(user_id: str = Path(..., description="The unique ID of
         HTTPException: If an error occurs while retrieving the device code.
     """
     try:
+        # tokens of the previous login must not be kept fresh
+        token_refresher.untrack_user(user_id)
+
         url, device_code = await authenticator.get_device_code_async(user_id)
         return {"url": url, "device_code": device_code}
+    except (SchedulerBusyError, SessionLimitError):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/login-status/{user_id}", response_model=LoginStatusResponse)
+async def get_login_status(user_id: str = Depends(get_user_id),
+                           timeout: float = Query(30, ge=0, le=300, description="Seconds to wait for a pending login to complete")):
+    """
+    Returns the status of the user's device code login as soon as it completes, or when the timeout expires.
+
+    Args:
+        user_id (str): The unique ID of the user.
+        timeout (float): The maximum number of seconds to wait while the login is pending.
+
+    Returns:
+        dict: The status, 'none', 'pending', 'succeeded' or 'failed', with its start and completion times.
+    """
+    return await authenticator.wait_for_login_async(user_id, timeout=timeout)
+
+
 @app.post("/token/{user_id}", response_model=TokenResponse)
-async def get_token(token_request: TokenRequest = Body(...), user_id: str = Path(..., description="The unique ID of the user")):
+async def get_token(token_request: TokenRequest = Body(...),
+                    user_id: str = Depends(get_user_id),
+                    x_request_timeout: Optional[float] = REQUEST_TIMEOUT_HEADER):
 
     await __check_az_login_async(user_id=user_id)
 
-    token_info = await authenticator.authenticate_async(user_id, token_request.resource)
+    token_info = await authenticator.authenticate_async(user_id, token_request.resource, timeout=x_request_timeout)
 
     if token_info is None:
         raise HTTPException(status_code=400, detail="Token was not found")
 
+    token_refresher.track(user_id, token_request.resource, token_info)
+
     token = {
         "accessToken": token_info["accessToken"],
         "expiresOn": token_info["expiresOn"],
@@ -95,15 +381,20 @@ async def get_token(token_request: TokenRequest = Body(...), user_id: str = Path
 
 
 @app.post("/tenant_token/{user_id}", response_model=TokenResponse)
-async def get_tenant_token(token_request: TenantTokenRequest = Body(...), user_id: str = Path(..., description="The unique ID of the user")):
+async def get_tenant_token(token_request: TenantTokenRequest = Body(...),
+                           user_id: str = Depends(get_user_id),
+                           x_request_timeout: Optional[float] = REQUEST_TIMEOUT_HEADER):
 
     await __check_az_login_async(user_id=user_id)
 
-    token_info = await authenticator.authenticate_async(user_id, token_request.resource, token_request.tenantId, token_request.subscriptionId)
+    token_info = await authenticator.authenticate_async(user_id, token_request.resource, token_request.tenantId,
+                                                        token_request.subscriptionId, timeout=x_request_timeout)
 
     if token_info is None:
         raise HTTPException(status_code=400, detail="Token was not found")
 
+    token_refresher.track(user_id, token_request.resource, token_info, token_request.tenantId, token_request.subscriptionId)
+
     token = {
         "accessToken": token_info["accessToken"],
         "expiresOn": token_info["expiresOn"],
@@ -113,45 +404,289 @@ async def get_tenant_token(token_request: TenantTokenRequest = Body(...), user_i
         "tokenType": token_info["tokenType"]
     }
     return token
-    
+
+
+@app.post("/tokens/{user_id}/batch", response_model=List[BatchTokenResult])
+async def get_batch_tokens(token_requests: List[TenantTokenRequest] = Body(...),
+                           user_id: str = Depends(get_user_id),
+                           stream: bool = Query(False, description="Stream the results as NDJSON as each one completes"),
+                           x_request_timeout: Optional[float] = REQUEST_TIMEOUT_HEADER):
+    """
+    Retrieves tokens for several resources, tenants and subscriptions of a user at once.
+
+    Args:
+        token_requests (list): The resource, tenantId and subscriptionId of every token.
+        user_id (str): The unique ID of the user.
+        stream (bool): Whether to stream the results as NDJSON in completion order.
+        x_request_timeout (float): The maximum number of seconds spent on every token.
+
+    Returns:
+        list: One result per requested token, with either the token or the error.
+    """
+    await __check_az_login_async(user_id=user_id)
+
+    semaphore = asyncio.Semaphore(batch_max_concurrency)
+
+    async def get_batch_token(index: int, token_request: TenantTokenRequest):
+        result = {
+            "index": index,
+            "resource": token_request.resource,
+            "tenantId": token_request.tenantId,
+            "subscriptionId": token_request.subscriptionId
+        }
+
+        async with semaphore:
+            try:
+                token_info = await authenticator.authenticate_async(user_id, token_request.resource, token_request.tenantId,
+                                                                    token_request.subscriptionId, timeout=x_request_timeout)
+            except Exception as e:
+                result["error"] = str(e)
+                result["error_class"] = getattr(e, 'error_class', None)
+                return result
+
+        if token_info is None:
+            result["error"] = "Token was not found"
+            return result
+
+        token_refresher.track(user_id, token_request.resource, token_info, token_request.tenantId, token_request.subscriptionId)
+
+        result["token"] = __to_token_response(token_info, token_request.subscriptionId)
+        return result
+
+    tasks = [asyncio.create_task(get_batch_token(index, token_request))
+             for index, token_request in enumerate(token_requests)]
+
+    if not stream:
+        return await asyncio.gather(*tasks)
+
+    async def stream_results():
+        try:
+            for completed in asyncio.as_completed(tasks):
+                result = await completed
+                yield json.dumps(BatchTokenResult(**result).model_dump()) + "\n"
+        finally:
+            # the client went away, stop fetching the remaining tokens
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+@app.post("/token-stream/{user_id}")
+async def stream_tokens(token_requests: List[TenantTokenRequest] = Body(...),
+                        user_id: str = Depends(get_user_id)):
+    """
+    Streams the tokens of several resources, tenants and subscriptions of a user as Server-Sent Events.
+
+    Every token is sent as a `token` event as soon as it is fetched, then again whenever the
+    background refresh replaces it before it expires. A token that cannot be had, or refreshed
+    any more, is sent as an `error` event and no longer streamed. The data of both is a
+    BatchTokenResult. The stream ends when every token failed.
+
+    Args:
+        token_requests (list): The resource, tenantId and subscriptionId of every token.
+        user_id (str): The unique ID of the user.
+
+    Returns:
+        StreamingResponse: The text/event-stream of the tokens.
+
+    Raises:
+        HTTPException: If the background token refresh is disabled, or the user has not logged in.
+    """
+    if not token_refresh_enabled:
+        raise HTTPException(status_code=501, detail="Token streams need TOKEN_REFRESH_ENABLED=true")
+
+    await __check_az_login_async(user_id=user_id)
+
+    indexes = {}
+    for index, token_request in enumerate(token_requests):
+        key = TokenCache.make_key(user_id, token_request.resource, token_request.tenantId, token_request.subscriptionId)
+        indexes.setdefault(key, []).append(index)
+
+    # subscribe before fetching, so a refresh completing meanwhile is not missed
+    keys = list(indexes)
+    queue = asyncio.Queue()
+    for key in keys:
+        token_refresher.subscribe(key, queue)
+
+    semaphore = asyncio.Semaphore(batch_max_concurrency)
+
+    async def get_first_token(key: tuple):
+        async with semaphore:
+            try:
+                token_info = await authenticator.authenticate_async(*key)
+            except Exception as e:
+                queue.put_nowait((key, None, e))
+                return
+
+        if token_info is None:
+            queue.put_nowait((key, None, Exception("Token was not found")))
+            return
+
+        user_id, resource, tenant_id, subscription_id = key
+        token_refresher.track(user_id, resource, token_info, tenant_id, subscription_id)
+        queue.put_nowait((key, token_info, None))
+
+    async def stream_events():
+        tasks = [asyncio.create_task(get_first_token(key)) for key in keys]
+        sent = {}
+
+        try:
+            while indexes:
+                try:
+                    key, token_info, error = await asyncio.wait_for(queue.get(), timeout=token_stream_keepalive_interval)
+                except asyncio.TimeoutError:
+                    # lets proxies know the stream is alive, and the server that the client is gone
+                    yield ": keepalive\n\n"
+                    continue
+
+                if key not in indexes:
+                    continue
+
+                if error is None:
+                    # the fetch and the refresher may both push the same token, and not in order
+                    expires_on = TokenCache.get_expires_on(token_info)
+                    if expires_on is not None and sent.get(key) is not None and expires_on <= sent[key]:
+                        continue
+                    sent[key] = expires_on
+
+                for index in indexes[key] if error is None else indexes.pop(key):
+                    token_request = token_requests[index]
+                    result = {
+                        "index": index,
+                        "resource": token_request.resource,
+                        "tenantId": token_request.tenantId,
+                        "subscriptionId": token_request.subscriptionId
+                    }
+                    if error is None:
+                        result["token"] = __to_token_response(token_info, token_request.subscriptionId)
+                    else:
+                        result["error"] = str(error)
+                        result["error_class"] = getattr(error, 'error_class', None)
+
+                    data = json.dumps(BatchTokenResult(**result).model_dump())
+                    yield f"event: {'token' if error is None else 'error'}\ndata: {data}\n\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+            for key in keys:
+                token_refresher.unsubscribe(key, queue)
+
+    return StreamingResponse(stream_events(),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.get("/subscriptions/{user_id}")
-async def get_list_of_subscriptions_async(user_id: str = Path(..., description="The unique ID of the user")):
+async def get_list_of_subscriptions_async(request: Request,
+                                          user_id: str = Depends(get_user_id),
+                                          tenant: Optional[str] = Query(None, description="Only return subscriptions of this tenant ID"),
+                                          state: Optional[str] = Query(None, description="Only return subscriptions in this state, e.g. Enabled"),
+                                          name: Optional[str] = Query(None, description="Only return subscriptions whose name contains this text"),
+                                          fields: Optional[str] = Query(None, description="Comma separated list of fields to return, e.g. id,name")):
     """
     Retrieve a list of subscriptions for a given azure user.
 
     Args:
+        request (Request): The request, for its If-None-Match header.
         user_id (str): The unique ID of the user.
+        tenant (str, optional): Only return subscriptions of this tenant ID.
+        state (str, optional): Only return subscriptions in this state.
+        name (str, optional): Only return subscriptions whose name contains this text, ignoring case.
+        fields (str, optional): Comma separated list of fields to return.
 
     Returns:
-        list: A list of subscriptions.
+        list: A list of subscriptions, or 304 when it matches the ETag sent in If-None-Match.
 
     """
     await __check_az_login_async(user_id=user_id)
     try:
         subscriptions = await authenticator.get_list_of_subscriptions_async(user_id)
-        return subscriptions
+    except SchedulerBusyError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    subscriptions = filter_subscriptions(subscriptions,
+                                         tenant_id=tenant,
+                                         state=state,
+                                         name=name,
+                                         fields=[field.strip() for field in fields.split(',') if field.strip()] if fields else None)
+
+    body = json.dumps(subscriptions, separators=(',', ':')).encode('utf-8')
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        if '*' in tags or etag in tags:
+            return Response(status_code=304, headers={"ETag": etag})
+
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
 
 @app.get("/healthz")
 async def health_check():
     """
     Performs a health check and returns the status.
 
+    The Azure CLI version is captured at startup, so no az process is started here.
+
     Returns:
         dict: A dictionary containing the status of the health check.
     """
     try:
-        version = await authenticator.get_version_async()
-        return {"status": "up", "version": version}
+        version = await health_monitor.get_version_async()
+        return {"status": "up",
+                "version": version,
+                "scheduler": authenticator.scheduler.stats(),
+                "config_dirs": config_dirs.stats()}
+    except SchedulerBusyError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    
+
+
+@app.get("/livez")
+async def liveness_check():
+    """
+    Returns 200 as long as the event loop answers.
+    """
+    return health_monitor.liveness()
+
+
+@app.get("/readyz")
+async def readiness_check():
+    """
+    Returns 200 when the service can take requests, 503 with the reasons when the az queue is
+    saturated, the Azure CLI version is unknown or the last deep check failed.
+    """
+    ready, details = health_monitor.readiness()
+    return JSONResponse(status_code=200 if ready else 503, content=details)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Returns the metrics of the service in the Prometheus text format.
+    """
+    return Response(content=metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
+def __to_token_response(token_info: dict, subscription_id: str = None):
+    return {
+        "accessToken": token_info["accessToken"],
+        "expiresOn": token_info["expiresOn"],
+        "expires_on": token_info["expires_on"],
+        "subscription": subscription_id or token_info.get("subscription"),
+        "tenant": token_info["tenant"],
+        "tokenType": token_info["tokenType"]
+    }
+
 
 async def __check_az_login_async(user_id: str):
 
-    logger.info(f"Checking if user: {user_id} has requested device code")
+    logger.info("Checking if user: %s has requested device code", user_id)
 
     if not await authenticator.check_az_login_async(user_id=user_id):
         raise HTTPException(
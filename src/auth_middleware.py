@@ -1,13 +1,80 @@
+import hmac
+import json
 import os
-from fastapi import Request, HTTPException
-from starlette.middleware.base import BaseHTTPMiddleware
 
-class AuthMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        x_auth_token = request.headers.get('X-Auth-Token')
+MISSING_TOKEN_BODY = json.dumps({"detail": "X-Auth-Token header is missing"}).encode('utf-8')
+INVALID_TOKEN_BODY = json.dumps({"detail": "Invalid X-Auth-Token header"}).encode('utf-8')
+
+
+class AuthMiddleware:
+    """
+    Pure ASGI middleware that checks the X-Auth-Token header against the shared secrets.
+
+    The secrets are read once, when the middleware is created. Several secrets can be
+    configured so one can be rotated while clients still use the other. Every secret
+    is compared in constant time, and requests without a valid token are answered
+    right away with a JSON 400 or 403 response.
+    """
+
+    def __init__(self, app, secrets: list = None):
+        self.app = app
+
+        if secrets is None:
+            secrets = parse_auth_tokens(os.getenv('X_AUTH_TOKEN'))
+        if not secrets:
+            raise ValueError("X_AUTH_TOKEN environment variable is not set")
+
+        self.secrets = [secret.encode('utf-8') for secret in secrets]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in ('http', 'websocket'):
+            await self.app(scope, receive, send)
+            return
+
+        x_auth_token = None
+        for name, value in scope['headers']:
+            if name == b'x-auth-token':
+                x_auth_token = value
+                break
+
         if not x_auth_token:
-            raise HTTPException(status_code=400, detail="X-Auth-Token header is missing")
-        if x_auth_token != os.getenv('X_AUTH_TOKEN'):
-            raise HTTPException(status_code=403, detail="Invalid X-Auth-Token header")
-        response = await call_next(request)
-        return response
+            await self.__reject(scope, send, 400, MISSING_TOKEN_BODY)
+            return
+        if not self.__is_valid(x_auth_token):
+            await self.__reject(scope, send, 403, INVALID_TOKEN_BODY)
+            return
+
+        await self.app(scope, receive, send)
+
+    def __is_valid(self, x_auth_token: bytes):
+        # check every secret, so the time taken does not tell which one matched
+        valid = False
+        for secret in self.secrets:
+            valid |= hmac.compare_digest(x_auth_token, secret)
+        return valid
+
+    @staticmethod
+    async def __reject(scope, send, status_code: int, body: bytes):
+        if scope['type'] == 'websocket':
+            await send({'type': 'websocket.close', 'code': 1008})
+            return
+
+        await send({
+            'type': 'http.response.start',
+            'status': status_code,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode('latin-1'))
+            ]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def parse_auth_tokens(value: str):
+    """
+    Splits a comma separated list of secrets, e.g. the X_AUTH_TOKEN environment variable.
+    """
+    if not value:
+        return []
+    return [token.strip() for token in value.split(',') if token.strip()]
+
@@ -0,0 +1,111 @@
+import random
+import re
+
+ERROR_CLASS_LOGIN_REQUIRED = 'login_required'
+ERROR_CLASS_TRANSIENT = 'transient'
+ERROR_CLASS_PERMANENT = 'permanent'
+ERROR_CLASS_UNKNOWN = 'unknown'
+
+# checked in this order, the first class with a matching pattern wins. Permanent errors come
+# first, az also suggests 'az login' for e.g. an unknown tenant, where logging in again does not help
+AZ_ERROR_PATTERNS = [
+    (ERROR_CLASS_PERMANENT, re.compile('|'.join([
+        r"AADSTS500011",  # the resource principal was not found in the tenant
+        r"AADSTS650057",  # invalid resource
+        r"AADSTS70011",   # invalid scope
+        r"AADSTS90002",   # tenant not found
+        r"AADSTS900023",  # the tenant identifier is invalid
+        r"AADSTS50020",   # the user does not exist in the tenant
+        r"AADSTS50034",   # the user account does not exist
+        r"AADSTS53003",   # blocked by conditional access
+        r"subscription .* (?:doesn't exist|does not exist|not found)",
+        r"invalid_resource",
+        r"invalid_scope",
+        r"is not a valid",
+    ]), re.IGNORECASE)),
+    (ERROR_CLASS_LOGIN_REQUIRED, re.compile('|'.join([
+        r"az login",
+        r"interaction_required",
+        r"AADSTS50076",   # MFA is required
+        r"AADSTS50078",   # MFA expired
+        r"AADSTS50173",   # the grant expired because the password changed
+        r"AADSTS70043",   # the refresh token expired
+        r"AADSTS700082",  # the refresh token expired due to inactivity
+        r"AADSTS700084",  # the refresh token was revoked
+        r"does not exist in MSAL token cache",
+    ]), re.IGNORECASE)),
+    (ERROR_CLASS_TRANSIENT, re.compile('|'.join([
+        r"\b429\b",
+        r"too many requests",
+        r"throttl",
+        r"\b50[234]\b",
+        r"service unavailable",
+        r"bad gateway",
+        r"gateway time-?out",
+        r"timed? ?out",
+        r"connection (?:reset|aborted|refused|error)",
+        r"ConnectionError",
+        r"Max retries exceeded",
+        r"temporary failure in name resolution",
+        r"name or service not known",
+        r"temporarily",
+        r"AADSTS90033",   # a transient error occurred
+        r"AADSTS50196",   # request loop detected, wait before retrying
+    ]), re.IGNORECASE)),
+]
+
+
+class AzCommandError(Exception):
+    """
+    Raised when an az command fails, with the class of the failure.
+
+    Args:
+        message (str): The error message.
+        error_class (str): 'login_required', 'transient', 'permanent' or 'unknown'.
+        returncode (int, optional): The exit code of az.
+        stderr (str, optional): What az printed to stderr.
+    """
+
+    def __init__(self, message: str, error_class: str, returncode: int = None, stderr: str = None):
+        super().__init__(message)
+        self.error_class = error_class
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+def classify_az_error(stderr: str):
+    """
+    Classifies what a failed az command printed to stderr.
+
+    Args:
+        stderr (str): The stderr of az.
+
+    Returns:
+        str: 'login_required' when the user has to log in again, 'permanent' when retrying
+             cannot help, 'transient' when it may, or 'unknown'.
+    """
+    for error_class, pattern in AZ_ERROR_PATTERNS:
+        if pattern.search(stderr or ''):
+            return error_class
+    return ERROR_CLASS_UNKNOWN
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter.
+
+    The n-th retry waits a random time between 0 and min(`max_delay`,
+    `initial_delay` * `multiplier` ** n) seconds.
+    """
+
+    def __init__(self, initial_delay: float = 1, max_delay: float = 15, multiplier: float = 2):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+
+    def get_delay(self, attempt: int):
+        return random.uniform(0, min(self.max_delay, self.initial_delay * self.multiplier ** attempt))
+
+    @staticmethod
+    def is_retryable(error_class: str):
+        return error_class in (ERROR_CLASS_TRANSIENT, ERROR_CLASS_UNKNOWN)
@@ -0,0 +1,185 @@
+import asyncio
+import contextlib
+import logging
+import time
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerBusyError(Exception):
+    """
+    Raised when an az process cannot be scheduled because the queue is full or the wait took too long.
+    """
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AzProcessScheduler:
+    """
+    Bounds the number of az processes running at the same time.
+
+    At most `max_concurrency` processes run overall and at most `per_user_concurrency`
+    per user. Callers beyond that wait in per-user queues that are served round-robin,
+    so a single busy user cannot starve the others. When `max_queue_depth` callers are
+    already waiting, or a caller waited `max_wait_seconds`, SchedulerBusyError is raised.
+
+    `az login --use-device-code` runs until the user completes the login, for up to the
+    lifetime of the device code, so it does not take one of these slots. The
+    `max_pending` limit of the DeviceCodeSessionRegistry bounds those processes.
+    """
+
+    def __init__(self,
+                 max_concurrency: int = 4,
+                 per_user_concurrency: int = 2,
+                 max_queue_depth: int = 100,
+                 max_wait_seconds: float = 30,
+                 retry_after: int = 5):
+        if max_concurrency <= 0 or per_user_concurrency <= 0:
+            raise ValueError("max_concurrency and per_user_concurrency must be greater than zero")
+
+        self.max_concurrency = max_concurrency
+        self.per_user_concurrency = per_user_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.max_wait_seconds = max_wait_seconds
+        self.retry_after = retry_after
+
+        self.running = 0
+        self.queue_depth = 0
+        self.rejected = 0
+        self.completed_waits = 0
+        self.total_wait_seconds = 0.0
+        self.max_observed_wait_seconds = 0.0
+
+        self._running_per_user = {}
+        self._queues = OrderedDict()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id: str):
+        """
+        Holds a process slot for the user for the duration of the block.
+        """
+        await self.acquire(user_id)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+    async def acquire(self, user_id: str):
+        """
+        Waits for a process slot for the user.
+
+        Raises:
+            SchedulerBusyError: If the queue is full or the wait exceeds max_wait_seconds.
+        """
+        # only skip the queue when nobody is waiting, otherwise fairness is lost
+        if self.queue_depth == 0 and self.__can_run(user_id):
+            self.__start(user_id)
+            return
+
+        if self.queue_depth >= self.max_queue_depth:
+            self.rejected += 1
+            raise SchedulerBusyError(
+                f"Too many az commands queued ({self.queue_depth}), try again later.", self.retry_after)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append(waiter)
+        self.queue_depth += 1
+        start = time.monotonic()
+
+        # other waiters may be held back only by their own per-user limit
+        self.__dispatch()
+
+        try:
+            await asyncio.wait_for(waiter, timeout=self.max_wait_seconds)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was granted just as the wait ended, hand it back
+                self.release(user_id)
+            else:
+                self.__remove_waiter(user_id, waiter)
+
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                raise SchedulerBusyError(
+                    f"Timed out after {self.max_wait_seconds} seconds waiting to run an az command.", self.retry_after)
+            raise
+        finally:
+            self.__record_wait(time.monotonic() - start)
+
+    def release(self, user_id: str):
+        """
+        Frees the user's process slot and hands it to the next waiting user.
+        """
+        self.running -= 1
+        count = self._running_per_user.get(user_id, 0) - 1
+        if count > 0:
+            self._running_per_user[user_id] = count
+        else:
+            self._running_per_user.pop(user_id, None)
+
+        self.__dispatch()
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "queue_depth": self.queue_depth,
+            "max_concurrency": self.max_concurrency,
+            "rejected": self.rejected,
+            "average_wait_seconds": self.total_wait_seconds / self.completed_waits if self.completed_waits else 0.0,
+            "max_wait_seconds": self.max_observed_wait_seconds
+        }
+
+    def __can_run(self, user_id: str):
+        return (self.running < self.max_concurrency
+                and self._running_per_user.get(user_id, 0) < self.per_user_concurrency)
+
+    def __start(self, user_id: str):
+        self.running += 1
+        self._running_per_user[user_id] = self._running_per_user.get(user_id, 0) + 1
+
+    def __dispatch(self):
+        while self.running < self.max_concurrency and self._queues:
+            for user_id in self._queues:
+                if self.__can_run(user_id):
+                    break
+            else:
+                return
+
+            waiters = self._queues[user_id]
+            waiter = waiters.popleft()
+            self.queue_depth -= 1
+
+            # rotate so the next free slot goes to another user first
+            if waiters:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+
+            # the waiter may have been cancelled and not yet removed itself
+            if waiter.done():
+                continue
+
+            self.__start(user_id)
+            waiter.set_result(None)
+
+    def __remove_waiter(self, user_id: str, waiter: asyncio.Future):
+        waiters = self._queues.get(user_id)
+        if waiters is None:
+            return
+
+        try:
+            waiters.remove(waiter)
+        except ValueError:
+            return
+
+        self.queue_depth -= 1
+        if not waiters:
+            del self._queues[user_id]
+
+    def __record_wait(self, wait_seconds: float):
+        self.completed_waits += 1
+        self.total_wait_seconds += wait_seconds
+        self.max_observed_wait_seconds = max(self.max_observed_wait_seconds, wait_seconds)
@@ -0,0 +1,121 @@
+"""
+Long-lived Azure CLI worker process used by AzWorkerPool.
+
+The worker reads one JSON job per line from stdin, {"args": [...], "config_dir": "..."},
+runs it and writes one JSON result per line to stdout,
+{"returncode": 0, "stdout": "...", "stderr": "..."}.
+
+It is started with the Python interpreter that has the Azure CLI installed (for the
+apt package that is /opt/az/bin/python3), so it must only import the standard library
+and azure.cli.
+"""
+import io
+import json
+import os
+import sys
+import traceback
+
+
+class _Redirect(io.TextIOBase):
+    """
+    Forwards writes to the buffer of the job being run, also for streams captured before the job started.
+    """
+
+    def __init__(self):
+        self.target = io.StringIO()
+
+    @property
+    def encoding(self):
+        return 'utf-8'
+
+    def isatty(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        return self.target.write(s)
+
+
+def serve(handler, stdin=None, stdout=None):
+    """
+    Runs jobs from stdin with `handler(args, config_dir)` until stdin is closed.
+
+    The handler writes the command output to sys.stdout and sys.stderr and returns the exit code.
+    """
+    stdin = stdin or sys.stdin
+
+    if stdout is None:
+        # keep the real stdout for the results and send anything else written to fd 1 to stderr
+        stdout = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    job_stdout, job_stderr = _Redirect(), _Redirect()
+    sys.stdout, sys.stderr = job_stdout, job_stderr
+
+    for line in stdin:
+        if not line.strip():
+            continue
+
+        job_stdout.target, job_stderr.target = io.StringIO(), io.StringIO()
+        try:
+            job = json.loads(line)
+            returncode = handler(job['args'], job.get('config_dir'))
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc(file=job_stderr)
+            returncode = 1
+
+        stdout.write(json.dumps({
+            "returncode": returncode,
+            "stdout": job_stdout.target.getvalue(),
+            "stderr": job_stderr.target.getvalue()
+        }) + '\n')
+        stdout.flush()
+
+
+def run_az(args, config_dir=None):
+    """
+    Runs an az command in-process against the given AZURE_CONFIG_DIR.
+    """
+    from azure.cli.core import AzCli, MainCommandsLoader
+    from azure.cli.core.azlogging import AzCliLogging
+    from azure.cli.core.commands import AzCliCommandInvoker
+    from azure.cli.core.parser import AzCliCommandParser
+    from azure.cli.core._config import GLOBAL_CONFIG_DIR, ENV_VAR_PREFIX
+    from azure.cli.core._help import AzCliHelp
+    from azure.cli.core._output import AzOutputProducer
+    from azure.cli.core.auth.identity import Identity
+
+    if config_dir:
+        os.environ['AZURE_CONFIG_DIR'] = config_dir
+    else:
+        os.environ.pop('AZURE_CONFIG_DIR', None)
+        config_dir = GLOBAL_CONFIG_DIR
+
+    # the MSAL caches are process wide singletons, they must not leak between users
+    Identity._msal_token_cache = None
+    Identity._msal_http_cache = None
+    Identity._service_principal_store_instance = None
+
+    # same as azure.cli.core.get_default_cli, with the config dir of the job
+    cli = AzCli(cli_name='az',
+                config_dir=config_dir,
+                config_env_var_prefix=ENV_VAR_PREFIX,
+                commands_loader_cls=MainCommandsLoader,
+                invocation_cls=AzCliCommandInvoker,
+                parser_cls=AzCliCommandParser,
+                logging_cls=AzCliLogging,
+                output_cls=AzOutputProducer,
+                help_cls=AzCliHelp)
+
+    return cli.invoke(args, out_file=sys.stdout)
+
+
+if __name__ == '__main__':
+    # pay the import cost once, before the first job arrives
+    import azure.cli.core  # noqa: F401
+
+    serve(run_az)
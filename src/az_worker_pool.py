@@ -0,0 +1,159 @@
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+
+logger = logging.getLogger(__name__)
+
+# the Python interpreter bundled with the azure-cli apt package
+AZ_PYTHON = '/opt/az/bin/python3'
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# az account list can return a lot of JSON on a single line
+WORKER_STREAM_LIMIT = 64 * 1024 * 1024
+
+
+class WorkerCrashedError(Exception):
+    """
+    Raised when a worker process dies or stops responding while running a job.
+    """
+
+
+class AzWorker:
+    def __init__(self, process: asyncio.subprocess.Process):
+        self.process = process
+        self.jobs = 0
+
+    @property
+    def alive(self):
+        return self.process.returncode is None
+
+    async def run(self, args: list, config_dir: str = None):
+        request = json.dumps({"args": args, "config_dir": config_dir}) + '\n'
+        self.process.stdin.write(request.encode('utf-8'))
+        await self.process.stdin.drain()
+
+        line = await self.process.stdout.readline()
+        if not line:
+            raise WorkerCrashedError(f"az worker {self.process.pid} exited with code {await self.process.wait()}")
+
+        self.jobs += 1
+        return json.loads(line)
+
+    async def close(self):
+        if self.alive:
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+        await self.process.wait()
+
+
+class AzWorkerPool:
+    """
+    Pool of long-lived worker processes that run az commands in-process.
+
+    Every worker imports the Azure CLI once and then serves jobs over its stdin and
+    stdout pipes (see src/az_worker.py), so a command does not pay the interpreter
+    start and import cost of a cold `az` process. Crashed or hung workers are killed
+    and replaced, and every worker is replaced after `max_jobs_per_worker` jobs.
+    """
+
+    def __init__(self,
+                 size: int = 2,
+                 max_jobs_per_worker: int = 100,
+                 job_timeout: float = 120,
+                 worker_module: str = 'src.az_worker',
+                 python: str = None):
+        if size <= 0:
+            raise ValueError("size must be greater than zero")
+
+        self.size = size
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.job_timeout = job_timeout
+        self.worker_module = worker_module
+        self.python = python or (AZ_PYTHON if os.path.exists(AZ_PYTHON) else sys.executable)
+
+        self.started = 0
+        self.crashed = 0
+        self.recycled = 0
+
+        self._idle = []
+        self._semaphore = asyncio.Semaphore(size)
+
+    async def run(self, args: list, config_dir: str = None):
+        """
+        Runs an az command on a worker.
+
+        Args:
+            args (list): The az arguments, without the leading 'az'.
+            config_dir (str, optional): The AZURE_CONFIG_DIR to run the command against.
+
+        Returns:
+            subprocess.CompletedProcess: The result, as if `az` had been run as a subprocess.
+
+        Raises:
+            WorkerCrashedError: If the worker died or timed out while running the command.
+        """
+        async with self._semaphore:
+            worker = await self.__acquire_worker()
+
+            try:
+                response = await asyncio.wait_for(worker.run(args, config_dir), timeout=self.job_timeout)
+            except (WorkerCrashedError, asyncio.TimeoutError, OSError, ValueError) as e:
+                self.crashed += 1
+                await worker.close()
+                logger.warning("az worker %s failed running az %s: %s", worker.process.pid, ' '.join(args), e)
+                raise WorkerCrashedError(str(e)) from e
+            except BaseException:
+                # the worker is in an unknown state when the job is cancelled half way
+                await worker.close()
+                raise
+
+            if worker.jobs >= self.max_jobs_per_worker:
+                self.recycled += 1
+                await worker.close()
+            else:
+                self._idle.append(worker)
+
+        return subprocess.CompletedProcess(['az', *args],
+                                           response['returncode'],
+                                           response['stdout'],
+                                           response['stderr'])
+
+    async def close(self):
+        """
+        Stops all idle workers.
+        """
+        workers, self._idle = self._idle, []
+        for worker in workers:
+            await worker.close()
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "idle": len(self._idle),
+            "started": self.started,
+            "crashed": self.crashed,
+            "recycled": self.recycled
+        }
+
+    async def __acquire_worker(self):
+        while self._idle:
+            worker = self._idle.pop()
+            if worker.alive:
+                return worker
+            self.crashed += 1
+
+        process = await asyncio.create_subprocess_exec(
+            self.python, '-m', self.worker_module,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            cwd=PROJECT_DIR,
+            limit=WORKER_STREAM_LIMIT)
+        self.started += 1
+        logger.debug("Started az worker %s", process.pid)
+        return AzWorker(process)
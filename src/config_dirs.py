@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import os
+import re
+import shutil
+import time
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+# letters, digits and . _ @ + -, starting with a letter or digit, e.g. a GUID or an e-mail address
+USER_ID_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._@+-]{0,127}$')
+
+# subfolders of an AZURE_CONFIG_DIR az only writes caches, command logs and telemetry to
+AZ_TRIM_DIRS = ('cache', 'commands', 'logs', 'telemetry')
+
+# directories used this recently are never evicted, az may be running in them
+EVICTION_GRACE = 600
+
+# the last use is written to the directory's mtime at most this often
+TOUCH_INTERVAL = 60
+
+
+class InvalidUserIdError(ValueError):
+    """
+    Raised when a user ID cannot be used as the name of a config directory.
+    """
+
+
+def normalize_user_id(user_id: str):
+    """
+    Returns the user ID in NFC form without surrounding whitespace.
+
+    Raises:
+        InvalidUserIdError: If the ID is empty, longer than 128 characters or has other
+                            characters than letters, digits and . _ @ + -.
+    """
+    normalized = unicodedata.normalize('NFC', user_id or '').strip()
+    if not USER_ID_PATTERN.match(normalized):
+        raise InvalidUserIdError(
+            "user_id must be 1 to 128 letters, digits or . _ @ + -, starting with a letter or digit")
+    return normalized
+
+
+class ConfigDirManager:
+    """
+    Creates the per-user AZURE_CONFIG_DIRs under `root` and garbage collects them.
+
+    Every `gc_interval` seconds, directories not used for `idle_ttl` seconds are
+    evicted, then the least recently used ones until the directories take less
+    than `max_total_size` bytes, and files older than `trim_age` seconds are
+    deleted from az's cache, command log and telemetry folders. 0 disables the
+    TTL and the quota. The last use of a directory is its mtime, so it survives
+    restarts. Directories of users with a pending login are never evicted.
+    """
+
+    def __init__(self,
+                 root: str = None,
+                 idle_ttl: float = 30 * 24 * 3600,
+                 max_total_size: int = 0,
+                 gc_interval: float = 3600,
+                 trim_age: float = 24 * 3600):
+        self._root = root
+        self.idle_ttl = idle_ttl
+        self.max_total_size = max_total_size
+        self.gc_interval = gc_interval
+        self.trim_age = trim_age
+
+        # callbacks called with (user_id, config_dir) after a directory was evicted
+        self.on_evict = []
+        # returns True when the user's directory must be kept, e.g. during a login
+        self.is_in_use = None
+
+        self.evicted = 0
+        self.trimmed_files = 0
+        self.count = 0
+        self.total_size = 0
+        self.last_gc_at = None
+
+        self._touched = {}
+        self._task = None
+
+    @property
+    def root(self):
+        # resolved on every use, HOME may change after the manager was created
+        return self._root if self._root is not None else os.path.join(os.path.expanduser('~'), '.temp')
+
+    def get_dir(self, user_id: str):
+        """
+        Returns the config directory of the user, creating it if needed, and records its use.
+
+        Raises:
+            InvalidUserIdError: If the user ID is not valid.
+        """
+        config_dir = os.path.join(self.root, normalize_user_id(user_id))
+        os.makedirs(config_dir, exist_ok=True)
+        self.touch(user_id, config_dir)
+        return config_dir
+
+    def touch(self, user_id: str, config_dir: str):
+        now = time.time()
+        if now - self._touched.get(user_id, 0) < TOUCH_INTERVAL:
+            return
+        self._touched[user_id] = now
+        try:
+            os.utime(config_dir)
+        except FileNotFoundError:
+            pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.__run_async())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "total_size_bytes": self.total_size,
+            "evicted": self.evicted,
+            "trimmed_files": self.trimmed_files,
+            "last_gc_at": self.last_gc_at
+        }
+
+    async def collect_async(self):
+        """
+        Trims the directories, evicts idle ones and enforces the size quota.
+        """
+        now = time.time()
+        directories, trimmed = await asyncio.to_thread(self.__scan, now)
+        self.trimmed_files += trimmed
+
+        evict = []
+        for user_id, (last_used, size) in directories.items():
+            if self.idle_ttl > 0 and now - last_used > self.idle_ttl:
+                evict.append(user_id)
+
+        if self.max_total_size > 0:
+            total_size = sum(size for user_id, (last_used, size) in directories.items() if user_id not in evict)
+            for user_id, (last_used, size) in sorted(directories.items(), key=lambda item: item[1][0]):
+                if total_size <= self.max_total_size:
+                    break
+                if user_id in evict or now - last_used < EVICTION_GRACE:
+                    continue
+                evict.append(user_id)
+                total_size -= size
+
+        for user_id in evict:
+            if self.is_in_use is not None and self.is_in_use(user_id):
+                continue
+            if await self.__evict_async(user_id):
+                del directories[user_id]
+
+        self.count = len(directories)
+        self.total_size = sum(size for last_used, size in directories.values())
+        self.last_gc_at = now
+
+    async def __evict_async(self, user_id: str):
+        config_dir = os.path.join(self.root, user_id)
+        logger.info("User: %s - evicting config directory %s.", user_id, config_dir)
+
+        try:
+            await asyncio.to_thread(shutil.rmtree, config_dir)
+        except OSError as e:
+            logger.error("User: %s - failed to evict config directory: %s", user_id, e)
+            return False
+
+        self.evicted += 1
+        self._touched.pop(user_id, None)
+        for callback in self.on_evict:
+            try:
+                callback(user_id, config_dir)
+            except Exception as e:
+                logger.error("User: %s - eviction callback failed: %s", user_id, e)
+        return True
+
+    def __scan(self, now: float):
+        """
+        Returns {user_id: (last_used, size)} of every directory, trimming them on the way.
+        """
+        directories = {}
+        trimmed = 0
+
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return directories, trimmed
+
+        for entry in entries:
+            # hidden entries hold shared state, e.g. the login state and the token store
+            if entry.name.startswith('.') or not entry.is_dir(follow_symlinks=False):
+                continue
+
+            if self.trim_age > 0:
+                trimmed += self.__trim(entry.path, now)
+
+            try:
+                last_used = entry.stat(follow_symlinks=False).st_mtime
+            except FileNotFoundError:
+                continue
+            directories[entry.name] = (last_used, self.__get_size(entry.path))
+
+        return directories, trimmed
+
+    def __trim(self, config_dir: str, now: float):
+        trimmed = 0
+        for name in AZ_TRIM_DIRS:
+            for dir_path, dir_names, file_names in os.walk(os.path.join(config_dir, name)):
+                for file_name in file_names:
+                    path = os.path.join(dir_path, file_name)
+                    try:
+                        if now - os.lstat(path).st_mtime > self.trim_age:
+                            os.remove(path)
+                            trimmed += 1
+                    except FileNotFoundError:
+                        pass
+        return trimmed
+
+    @staticmethod
+    def __get_size(path: str):
+        size = 0
+        for dir_path, dir_names, file_names in os.walk(path):
+            for file_name in file_names:
+                try:
+                    size += os.lstat(os.path.join(dir_path, file_name)).st_size
+                except FileNotFoundError:
+                    pass
+        return size
+
+    async def __run_async(self):
+        while True:
+            try:
+                await self.collect_async()
+            except Exception as e:
+                logger.error("Collecting config directories failed: %s", e)
+            await asyncio.sleep(self.gc_interval)
@@ -0,0 +1,331 @@
+import asyncio
+import collections
+import logging
+import os
+import socket
+import time
+import uuid
+
+from src.login_state import LoginStateBackend, MemoryLoginStateBackend
+
+logger = logging.getLogger(__name__)
+
+LOGIN_STATUS_NONE = 'none'
+LOGIN_STATUS_PENDING = 'pending'
+LOGIN_STATUS_SUCCEEDED = 'succeeded'
+LOGIN_STATUS_FAILED = 'failed'
+
+DEVICE_CODE_OUTPUT_LINES = 200
+
+# how often a worker checks the shared state of a login another worker is running
+LOGIN_STATE_POLL_INTERVAL = 0.5
+
+
+class SessionLimitError(Exception):
+    """
+    Raised when a device code login cannot start because too many logins are pending.
+    """
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DeviceCodeSession:
+    """
+    State of one `az login --use-device-code` process.
+    """
+
+    def __init__(self, user_id: str, owner: str = None, backend: LoginStateBackend = None):
+        self.user_id = user_id
+        self.session_id = uuid.uuid4().hex
+        self.owner = owner
+        self.backend = backend
+        self.child = None
+        self.login_task = None
+        self.output = collections.deque(maxlen=DEVICE_CODE_OUTPUT_LINES)
+        self.status = LOGIN_STATUS_PENDING
+        self.started_at = time.time()
+        self.completed_at = None
+        self.done = asyncio.Event()
+
+    def complete(self, status: str):
+        """
+        Records the outcome of the login and shares it through the backend.
+        """
+        if self.__finish(status):
+            self.__publish()
+            self.done.set()
+
+    async def complete_async(self, status: str):
+        """
+        Like `complete`, with the backend written in a worker thread.
+        """
+        if self.__finish(status):
+            await asyncio.to_thread(self.__publish)
+            self.done.set()
+
+    def __finish(self, status: str):
+        if self.completed_at is not None:
+            return False
+        self.status = status
+        self.completed_at = time.time()
+        return True
+
+    def __publish(self):
+        if self.backend is not None:
+            try:
+                self.backend.complete(self.user_id, self.session_id, self.status, self.completed_at)
+            except Exception as e:
+                logger.error("User: %s - failed to share the login state: %s", self.user_id, e)
+
+    async def close_async(self):
+        """
+        Kills the az login process if it is still running and waits for it to exit.
+        """
+        if self.child is not None:
+            if self.child.returncode is None:
+                try:
+                    self.child.kill()
+                except ProcessLookupError:
+                    pass
+            await self.child.wait()
+
+        if self.login_task is not None:
+            await asyncio.gather(self.login_task, return_exceptions=True)
+
+        await self.complete_async(LOGIN_STATUS_FAILED)
+
+    def to_dict(self):
+        return {
+            'status': self.status,
+            'started_at': self.started_at,
+            'completed_at': self.completed_at
+        }
+
+    def to_state(self):
+        return {
+            'session_id': self.session_id,
+            'owner': self.owner,
+            **self.to_dict()
+        }
+
+
+class DeviceCodeSessionRegistry:
+    """
+    Keeps the device code login sessions of all users.
+
+    At most `max_pending` logins can be pending at the same time. A pending login is
+    killed once it is older than `ttl` seconds, which should match the lifetime of
+    the device code, and completed sessions are forgotten `ttl` seconds after they
+    completed. A background reaper does this every `reap_interval` seconds.
+
+    A forgotten login leaves only the time it started in the backend, for
+    `login_history_ttl` seconds after that, so every worker can tell the tokens
+    issued before the user's latest login for as long as they may be valid.
+
+    The az login processes run in the worker that started them, their `owner`. The
+    login state is also written to `backend`, so with a backend shared by several
+    workers any of them can answer status and token requests of any login. The
+    `max_pending` limit applies to the logins running in this worker. Writes to the
+    backend run in a worker thread, reads are expected to be cheap.
+    """
+
+    def __init__(self,
+                 max_pending: int = 10,
+                 ttl: float = 900,
+                 reap_interval: float = 30,
+                 retry_after: int = 30,
+                 backend: LoginStateBackend = None,
+                 owner: str = None,
+                 login_history_ttl: float = 86400):
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.reap_interval = reap_interval
+        self.login_history_ttl = login_history_ttl
+        self.retry_after = retry_after
+        self.backend = backend if backend is not None else MemoryLoginStateBackend()
+        self.owner = owner if owner is not None else f"{socket.gethostname()}:{os.getpid()}"
+        self.expired = 0
+
+        self._sessions = {}
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    async def start_session_async(self, user_id: str):
+        """
+        Registers a new pending session for the user, closing the session the user had before.
+
+        Raises:
+            SessionLimitError: If max_pending logins are already pending.
+        """
+        async with self._lock:
+            previous = self._sessions.pop(user_id, None)
+            if previous is not None:
+                logger.info("User: %s - cancelling the previous device code login.", user_id)
+                await previous.close_async()
+
+            if self.pending_count() >= self.max_pending:
+                raise SessionLimitError(
+                    f"Too many device code logins are pending ({self.max_pending}), try again later.", self.retry_after)
+
+            session = DeviceCodeSession(user_id, owner=self.owner, backend=self.backend)
+            self._sessions[user_id] = session
+            # replaces the login the user may have started on another worker, which stops it when it notices
+            await asyncio.to_thread(self.backend.put, user_id, session.to_state())
+            return session
+
+    async def remove_session_async(self, session: DeviceCodeSession):
+        """
+        Closes the session and forgets it, unless the user already started a newer one.
+        """
+        async with self._lock:
+            if self._sessions.get(session.user_id) is session:
+                del self._sessions[session.user_id]
+            await asyncio.to_thread(self.backend.update, session.user_id,
+                                    lambda state: self.__forget_state(state, session.session_id))
+        await session.close_async()
+
+    def get(self, user_id: str):
+        return self._sessions.get(user_id)
+
+    def get_state(self, user_id: str):
+        """
+        Returns the login state of the user, whichever worker runs the login, or None if the user has none.
+        """
+        state = self.backend.get(user_id)
+        if state is None or state['status'] == LOGIN_STATUS_NONE:
+            return None
+        return state
+
+    def get_login_started_at(self, user_id: str):
+        """
+        Returns when the user's latest login started, on any worker, including logins already forgotten.
+        """
+        state = self.backend.get(user_id)
+        return state['started_at'] if state is not None else None
+
+    async def wait_async(self, user_id: str, timeout: float = 0):
+        """
+        Waits until the user's login completes, or the timeout expires, and returns its state.
+
+        A login running in this worker is awaited directly, the state of a login
+        running in another worker is polled.
+        """
+        state = self.get_state(user_id)
+        if state is None or state['status'] != LOGIN_STATUS_PENDING or timeout <= 0:
+            return state
+
+        session = self._sessions.get(user_id)
+        if session is not None and session.session_id == state['session_id']:
+            try:
+                await asyncio.wait_for(session.done.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            return self.get_state(user_id)
+
+        deadline = time.monotonic() + timeout
+        while state is not None and state['status'] == LOGIN_STATUS_PENDING:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(min(LOGIN_STATE_POLL_INTERVAL, remaining))
+            state = self.get_state(user_id)
+        return state
+
+    def pending_count(self):
+        return sum(1 for session in self._sessions.values() if session.status == LOGIN_STATUS_PENDING)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    async def reap_async(self):
+        """
+        Kills pending logins older than the TTL and forgets sessions that completed more than the TTL ago.
+        """
+        now = time.time()
+        expired = []
+        replaced = []
+
+        async with self._lock:
+            for user_id, session in list(self._sessions.items()):
+                if session.status == LOGIN_STATUS_PENDING:
+                    state = self.backend.get(user_id)
+                    if state is not None and state['session_id'] != session.session_id:
+                        replaced.append(session)
+                        del self._sessions[user_id]
+                    elif now - session.started_at > self.ttl:
+                        expired.append(session)
+                        del self._sessions[user_id]
+                elif session.completed_at is not None and now - session.completed_at > self.ttl:
+                    del self._sessions[user_id]
+
+        for session in replaced:
+            logger.info("User: %s - device code login was replaced by a login on another worker.", session.user_id)
+            await session.close_async()
+
+        for session in expired:
+            logger.info("User: %s - device code login expired.", session.user_id)
+            self.expired += 1
+            await session.close_async()
+
+        await asyncio.to_thread(self.__reap_states, now)
+
+    def __reap_states(self, now: float):
+        # any worker cleans up the shared state, including logins of workers that are gone
+        for user_id in self.backend.user_ids():
+            state = self.backend.get(user_id)
+            # only states that change take the backend's lock, the update checks them again under it
+            if state is not None and self.__reap_state(state, now) is not state:
+                self.backend.update(user_id, lambda current: self.__reap_state(current, now))
+
+    def __reap_state(self, state: dict, now: float):
+        if state is None:
+            return None
+        if state['status'] == LOGIN_STATUS_PENDING:
+            # the owner kills its login after the TTL, give it one more reap interval to say so
+            if now - state['started_at'] > self.ttl + self.reap_interval:
+                return {**state, 'status': LOGIN_STATUS_FAILED, 'completed_at': now}
+            return state
+        if state['status'] == LOGIN_STATUS_NONE:
+            if now - state['started_at'] > self.login_history_ttl:
+                return None
+            return state
+        if state['completed_at'] is not None and now - state['completed_at'] > self.ttl:
+            return self.__forget_state(state, state['session_id'])
+        return state
+
+    @staticmethod
+    def __forget_state(state: dict, session_id: str):
+        # keep when the login started, unless a newer login of the user replaced it
+        if state is None or state['session_id'] != session_id:
+            return state
+        return {**state, 'owner': None, 'status': LOGIN_STATUS_NONE}
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.__run_async())
+
+    async def stop(self):
+        """
+        Stops the reaper and kills every pending login.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        async with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+
+        for session in sessions:
+            await session.close_async()
+
+    async def __run_async(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            try:
+                await self.reap_async()
+            except Exception as e:
+                logger.error("Reaping device code sessions failed: %s", e)
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import time
+
+from src.az_errors import RetryPolicy
+from src.az_scheduler import SchedulerBusyError
+
+logger = logging.getLogger(__name__)
+
+
+class HealthMonitor:
+    """
+    Answers liveness and readiness probes from state kept in memory, without starting az.
+
+    The Azure CLI version is captured once, when the app starts. If `az version` fails
+    or takes longer than `deep_check_timeout` seconds then, it is retried in the
+    background with `version_retry_policy` backoff until it succeeds. The service is
+    ready while the version is known, fewer than `max_queue_depth` az commands wait
+    for a slot and, if enabled, the last deep check succeeded. A deep check runs
+    `az version` every `deep_check_interval` seconds, 0 disables it.
+    """
+
+    def __init__(self,
+                 authenticator,
+                 max_queue_depth: int = 50,
+                 deep_check_interval: float = 0,
+                 deep_check_timeout: float = 30,
+                 version_retry_policy: RetryPolicy = None):
+        self.authenticator = authenticator
+        self.max_queue_depth = max_queue_depth
+        self.deep_check_interval = deep_check_interval
+        self.deep_check_timeout = deep_check_timeout
+        self.version_retry_policy = version_retry_policy if version_retry_policy is not None else RetryPolicy(max_delay=60)
+
+        self.started_at = time.time()
+        self.version = None
+        self.last_deep_check = None
+
+        self._task = None
+        self._version_task = None
+
+    async def start(self):
+        """
+        Captures the Azure CLI version, retrying it in the background if that fails, and starts the deep check if it is enabled.
+        """
+        if not await self.__capture_version_async() and self._version_task is None:
+            self._version_task = asyncio.create_task(self.__retry_version_async())
+
+        if self.deep_check_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self.__run_async())
+
+    async def stop(self):
+        for task in (self._task, self._version_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._task = None
+        self._version_task = None
+
+    async def get_version_async(self):
+        """
+        Returns the cached Azure CLI version, running `az version` only until it succeeds once.
+        """
+        if self.version is None:
+            self.version = await self.authenticator.get_version_async()
+        return self.version
+
+    def liveness(self):
+        return {"status": "up", "uptime_seconds": round(time.time() - self.started_at, 3)}
+
+    def readiness(self):
+        """
+        Returns whether the service can take requests, with the reasons when it cannot.
+
+        Returns:
+            tuple: (ready, details) where details holds the status, the reasons and the scheduler stats.
+        """
+        scheduler = self.authenticator.scheduler.stats()
+        reasons = []
+
+        if self.version is None:
+            reasons.append("Azure CLI version is unknown")
+        if scheduler["queue_depth"] >= self.max_queue_depth:
+            reasons.append(f"{scheduler['queue_depth']} az commands are waiting for a slot")
+        if self.last_deep_check is not None and not self.last_deep_check["ok"]:
+            reasons.append(f"deep check failed: {self.last_deep_check['error']}")
+
+        details = {
+            "status": "not ready" if reasons else "ready",
+            "reasons": reasons,
+            "scheduler": scheduler,
+            "last_deep_check": self.last_deep_check
+        }
+        if self.authenticator.worker_pool is not None:
+            details["worker_pool"] = self.authenticator.worker_pool.stats()
+
+        return not reasons, details
+
+    async def deep_check_async(self):
+        """
+        Runs `az version` and records whether it succeeded.
+        """
+        try:
+            version = await asyncio.wait_for(self.authenticator.get_version_async(), timeout=self.deep_check_timeout)
+        except SchedulerBusyError:
+            # saturation is already part of the readiness, keep the previous result
+            return
+        except Exception as e:
+            logger.error("Deep health check failed: %s", e)
+            self.last_deep_check = {"ok": False, "at": time.time(), "error": str(e) or type(e).__name__}
+            return
+
+        self.version = version
+        self.last_deep_check = {"ok": True, "at": time.time(), "error": None}
+
+    async def __capture_version_async(self):
+        try:
+            await asyncio.wait_for(self.get_version_async(), timeout=self.deep_check_timeout)
+        except Exception as e:
+            logger.error("Failed to get the Azure CLI version: %s", str(e) or type(e).__name__)
+            return False
+        return True
+
+    async def __retry_version_async(self):
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.version_retry_policy.get_delay(attempt))
+            if await self.__capture_version_async():
+                logger.info("Azure CLI version captured after %s retries.", attempt + 1)
+                return
+            attempt += 1
+
+    async def __run_async(self):
+        while True:
+            await asyncio.sleep(self.deep_check_interval)
+            await self.deep_check_async()
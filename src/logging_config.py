@@ -0,0 +1,172 @@
+import atexit
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+import uuid
+
+# ID of the request being handled, set by CorrelationIdMiddleware
+correlation_id = contextvars.ContextVar('correlation_id', default=None)
+
+CORRELATION_ID_HEADER = b'x-request-id'
+
+# fields every LogRecord has, anything else was passed with `extra`
+RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'correlation_id'}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, with the correlation ID of the request.
+    """
+
+    def format(self, record: logging.LogRecord):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'correlation_id', None):
+            entry['correlation_id'] = record.correlation_id
+        for key, value in vars(record).items():
+            if key not in RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most `rate` records per second, with bursts of `burst`, through for every message template.
+
+    Only records at `max_level` or below are limited, so warnings and errors are
+    never dropped. The number of records dropped since the last one that went
+    through is added to it as `suppressed`.
+    """
+
+    def __init__(self, rate: float, burst: int, max_level: int = logging.INFO):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_level = max_level
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord):
+        if record.levelno > self.max_level:
+            return True
+
+        # with lazy formatting the template identifies the message, whatever its arguments
+        category = (record.name, record.msg)
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, updated_at, suppressed = self._buckets.get(category, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+
+            if tokens < 1:
+                self._buckets[category] = (tokens, now, suppressed + 1)
+                return False
+
+            self._buckets[category] = (tokens - 1, now, 0)
+
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records without formatting them, the listener's thread formats them.
+
+    The arguments of a record are formatted later, so they should not be mutated
+    after logging them.
+    """
+
+    def prepare(self, record: logging.LogRecord):
+        # the context variable is only visible on the thread that logged the record
+        record.correlation_id = correlation_id.get()
+        return record
+
+
+def configure_logging(level: str = 'INFO', log_format: str = 'json', rate: float = 10, burst: int = 20):
+    """
+    Sends the records of every logger through a queue to a background thread that writes them to stdout.
+
+    Args:
+        level (str): The logging level, e.g. 'INFO'.
+        log_format (str): 'json' for one JSON object per line, or 'text'.
+        rate (float): Records per second let through for every INFO or DEBUG message template, 0 for no limit.
+        burst (int): Records of one template let through at once before the rate applies.
+
+    Returns:
+        QueueListener: The listener writing the records, stopped when the process exits.
+    """
+    if log_format == 'json':
+        formatter = JsonFormatter()
+    elif log_format == 'text':
+        formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(correlation_id)s] %(message)s')
+    else:
+        raise ValueError(f"LOG_FORMAT must be 'json' or 'text', not '{log_format}'")
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(formatter)
+
+    queue_handler = _QueueHandler(queue.SimpleQueue())
+    if rate > 0:
+        queue_handler.addFilter(RateLimitFilter(rate, burst))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(getattr(logging, level.upper()))
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    # write the records still queued when the process exits
+    atexit.register(listener.stop)
+    return listener
+
+
+class CorrelationIdMiddleware:
+    """
+    Pure ASGI middleware giving every request a correlation ID for its log records.
+
+    The ID is taken from the X-Request-ID header, or generated, and is sent back in
+    the X-Request-ID response header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in ('http', 'websocket'):
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope['headers']:
+            if name == CORRELATION_ID_HEADER:
+                request_id = value.decode('latin-1')[:128]
+                break
+        if not request_id:
+            request_id = uuid.uuid4().hex
+
+        token = correlation_id.set(request_id)
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = list(message.get('headers', [])) + [(CORRELATION_ID_HEADER, request_id.encode('latin-1'))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            correlation_id.reset(token)
@@ -0,0 +1,178 @@
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import urllib.parse
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+LOGIN_STATE_DIR_NAME = '.login_state'
+LOCK_FILE_NAME = '.lock'
+
+
+class LoginStateBackend:
+    """
+    Shared store of the device code login state of every user.
+
+    A state is a dict with the session_id, the owner (the worker running the
+    az login process), the status and the started_at and completed_at times. A
+    state with the status 'none' only records when a forgotten login started.
+    Backends implement `get`, `update` and `user_ids`; `update` must be atomic
+    across every worker sharing the backend. `update` may block, async callers
+    run it in a worker thread.
+    """
+
+    def get(self, user_id: str):
+        """
+        Returns the login state of the user, or None if the user has none.
+        """
+        raise NotImplementedError
+
+    def update(self, user_id: str, fn):
+        """
+        Atomically replaces the state of the user with fn(state), removing it when fn returns None.
+
+        Returns:
+            dict: The new state.
+        """
+        raise NotImplementedError
+
+    def user_ids(self):
+        """
+        Returns the IDs of the users with a login state.
+        """
+        raise NotImplementedError
+
+    def put(self, user_id: str, state: dict):
+        return self.update(user_id, lambda current: state)
+
+    def complete(self, user_id: str, session_id: str, status: str, completed_at: float):
+        """
+        Records the outcome of a login, unless a newer login of the user replaced it.
+        """
+        def fn(state):
+            if state is None or state['session_id'] != session_id:
+                return state
+            return {**state, 'status': status, 'completed_at': completed_at}
+
+        return self.update(user_id, fn)
+
+    def delete(self, user_id: str, session_id: str):
+        """
+        Removes the state of the user, unless a newer login of the user replaced it.
+        """
+        return self.update(user_id, lambda state: None if state is None or state['session_id'] == session_id else state)
+
+
+class MemoryLoginStateBackend(LoginStateBackend):
+    """
+    Login state kept in the process, for a single worker.
+    """
+
+    def __init__(self):
+        self._states = {}
+
+    def get(self, user_id: str):
+        return self._states.get(user_id)
+
+    def update(self, user_id: str, fn):
+        state = fn(self._states.get(user_id))
+        if state is None:
+            self._states.pop(user_id, None)
+        else:
+            self._states[user_id] = state
+        return state
+
+    def user_ids(self):
+        return list(self._states)
+
+
+class FileLoginStateBackend(LoginStateBackend):
+    """
+    Login state kept as one JSON file per user in a directory on the shared config volume.
+
+    Updates hold an exclusive `fcntl` lock on the directory's lock file, so the workers
+    of one host, and the replicas sharing the volume if it supports locks, see each
+    other's logins. Files are replaced atomically, so reads need no lock. A file is
+    only parsed again when it was replaced, and only rewritten when its state changes.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        # user_id: (inode, mtime, state) of the last file read
+        self._cache = {}
+
+    def get(self, user_id: str):
+        path = self.__get_path(user_id)
+        try:
+            stat = os.stat(path)
+            cached = self._cache.get(user_id)
+            if cached is not None and cached[:2] == (stat.st_ino, stat.st_mtime_ns):
+                return cached[2]
+
+            with open(path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            self._cache.pop(user_id, None)
+            return None
+        except (OSError, ValueError) as e:
+            logger.error("User: %s - failed to read the login state: %s", user_id, e)
+            return None
+
+        self._cache[user_id] = (stat.st_ino, stat.st_mtime_ns, state)
+        return state
+
+    def update(self, user_id: str, fn):
+        path = self.__get_path(user_id)
+
+        with self.__lock():
+            current = self.get(user_id)
+            state = fn(current)
+
+            if state == current:
+                return state
+
+            if state is None:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                return None
+
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(state, f)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+
+        return state
+
+    def user_ids(self):
+        try:
+            file_names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [urllib.parse.unquote(file_name[:-len('.json')]) for file_name in file_names
+                if file_name.endswith('.json') and not file_name.startswith('.')]
+
+    @contextmanager
+    def __lock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LOCK_FILE_NAME), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def __get_path(self, user_id: str):
+        # quote the ID so it cannot leave the directory, or be taken for the lock or a temporary file
+        file_name = urllib.parse.quote(user_id, safe='')
+        if file_name.startswith('.'):
+            file_name = '%2E' + file_name[1:]
+        return os.path.join(self.directory, file_name + '.json')
@@ -0,0 +1,216 @@
+import bisect
+import time
+
+# Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+AZ_COMMAND_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+HTTP_REQUEST_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class MetricsRegistry:
+    """
+    Holds the metrics of the process and renders them in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        # a module imported again, e.g. under another name, replaces the metrics it defined before
+        self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name: str):
+        self._metrics.pop(name, None)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            metric.render(lines)
+        return '\n'.join(lines) + '\n'
+
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), registry: MetricsRegistry = None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *values):
+        """
+        Returns the child for the label values, creating it on first use.
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _format_labels(self, values: tuple, extra: str = None):
+        pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self._children[()].value += amount
+
+    def render(self, lines: list):
+        for values, child in self._children.items():
+            lines.append(f"{self.name}{self._format_labels(values)} {_format_value(child.value)}")
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount: float = 1):
+        self._children[()].value -= amount
+
+    def set(self, value: float):
+        self._children[()].value = value
+
+
+class CallbackGauge(_Metric):
+    """
+    Gauge or counter whose value is read from a function when the metrics are rendered.
+    """
+
+    def __init__(self, name: str, help: str, fn, type: str = 'gauge', registry: MetricsRegistry = None):
+        self.fn = fn
+        self.type = type
+        super().__init__(name, help, registry=registry)
+
+    def _new_child(self):
+        return None
+
+    def render(self, lines: list):
+        lines.append(f"{self.name} {_format_value(self.fn())}")
+
+
+class _HistogramValue:
+    __slots__ = ('upper_bounds', 'buckets', 'sum', 'count')
+
+    def __init__(self, upper_bounds: tuple):
+        self.upper_bounds = upper_bounds
+        # one slot per bucket plus +Inf, allocated once
+        self.buckets = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.buckets[bisect.bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = HTTP_REQUEST_BUCKETS,
+                 registry: MetricsRegistry = None):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.upper_bounds)
+
+    def observe(self, value: float):
+        self._children[()].observe(value)
+
+    def render(self, lines: list):
+        for values, child in self._children.items():
+            cumulative = 0
+            for upper_bound, count in zip(self.upper_bounds + (float('inf'),), child.buckets):
+                cumulative += count
+                le = '+Inf' if upper_bound == float('inf') else _format_value(upper_bound)
+                labels = self._format_labels(values, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(values)} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{self._format_labels(values)} {child.count}")
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware recording the latency of every request by route template and status code.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # FastAPI stores the matched route in the scope, its path keeps the label cardinality bounded
+            route = scope.get('route')
+            path = getattr(route, 'path', None) or 'unmatched'
+            HTTP_REQUEST_DURATION.labels(scope['method'], path, status_code).observe(time.perf_counter() - start)
+
+
+def _escape(value: str):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUEST_DURATION = Histogram('tokenflow_http_request_duration_seconds',
+                                  'Latency of HTTP requests by method, route and status code.',
+                                  ('method', 'route', 'status'),
+                                  buckets=HTTP_REQUEST_BUCKETS)
@@ -0,0 +1,170 @@
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+PROFILE_FILE_NAME = 'azureProfile.json'
+TOKEN_CACHE_FILE_NAME = 'msal_token_cache.json'
+
+
+class MsalTokenCacheReader:
+    """
+    Reads access tokens directly from the files the Azure CLI keeps in `AZURE_CONFIG_DIR`.
+
+    `azureProfile.json` tells which account, tenant and subscription are in use and
+    `msal_token_cache.json` holds the access tokens MSAL acquired for them. Parsed
+    files are kept in memory and only read again when their mtime or size changes.
+    """
+
+    def __init__(self):
+        self._files = {}
+
+    def get_token(self,
+                  config_dir: str,
+                  resource: str,
+                  tenant_id: str = None,
+                  subscription_id: str = None,
+                  min_validity: int = 0):
+        """
+        Looks up a cached access token, mirroring the output of `az account get-access-token`.
+
+        Args:
+            config_dir (str): The user's AZURE_CONFIG_DIR.
+            resource (str): The resource the token is requested for.
+            tenant_id (str, optional): The tenant to get the token for.
+            subscription_id (str, optional): The subscription to get the token for, ignored when tenant_id is set.
+            min_validity (int, optional): The number of seconds the token must still be valid for.
+
+        Returns:
+            dict: The token info, or None if no usable token is cached.
+        """
+        profile = self._load_json(os.path.join(config_dir, PROFILE_FILE_NAME), encoding='utf-8-sig')
+        if not profile:
+            return None
+
+        subscription = self._find_subscription(profile.get('subscriptions') or [],
+                                               None if tenant_id else subscription_id)
+        if subscription is None:
+            return None
+
+        user = subscription.get('user') or {}
+        if user.get('type') != 'user':
+            # service principal secrets are not stored in the MSAL token cache
+            return None
+
+        tenant = tenant_id or subscription.get('tenantId')
+        if not tenant:
+            return None
+
+        token_cache = self._load_json(os.path.join(config_dir, TOKEN_CACHE_FILE_NAME))
+        if not token_cache:
+            return None
+
+        entry = self._find_access_token(token_cache, user.get('name'), tenant, resource, min_validity)
+        if entry is None:
+            return None
+
+        expires_on = int(entry['expires_on'])
+        token_info = {
+            "accessToken": entry['secret'],
+            "expiresOn": datetime.fromtimestamp(expires_on).strftime('%Y-%m-%d %H:%M:%S.%f'),
+            "expires_on": expires_on,
+            "tenant": tenant,
+            "tokenType": entry.get('token_type') or 'Bearer'
+        }
+
+        # az only reports the subscription when the token was not requested for a tenant
+        if not tenant_id:
+            token_info["subscription"] = subscription['id']
+
+        return token_info
+
+    def has_account(self, config_dir: str):
+        """
+        Returns True if the Azure CLI profile in the directory has at least one logged in account.
+        """
+        profile = self._load_json(os.path.join(config_dir, PROFILE_FILE_NAME), encoding='utf-8-sig')
+        return bool(profile and profile.get('subscriptions'))
+
+    def invalidate(self, config_dir: str):
+        """
+        Drops the parsed files of the directory so they are read again on next use.
+        """
+        for file_name in (PROFILE_FILE_NAME, TOKEN_CACHE_FILE_NAME):
+            self._files.pop(os.path.join(config_dir, file_name), None)
+
+    @staticmethod
+    def _find_subscription(subscriptions: list, subscription_id: str = None):
+        if subscription_id:
+            subscription_id = subscription_id.lower()
+            for subscription in subscriptions:
+                if subscription_id in (str(subscription.get('id', '')).lower(), str(subscription.get('name', '')).lower()):
+                    return subscription
+            return None
+
+        for subscription in subscriptions:
+            if subscription.get('isDefault'):
+                return subscription
+        return None
+
+    @staticmethod
+    def _find_access_token(token_cache: dict, username: str, tenant: str, resource: str, min_validity: int):
+        username = (username or '').lower()
+        home_account_ids = {account.get('home_account_id')
+                            for account in (token_cache.get('Account') or {}).values()
+                            if str(account.get('username', '')).lower() == username}
+        if not home_account_ids:
+            return None
+
+        resource = resource.rstrip('/')
+        tenant = tenant.lower()
+        not_before = time.time() + min_validity
+        found = None
+
+        for entry in (token_cache.get('AccessToken') or {}).values():
+            if entry.get('credential_type') != 'AccessToken':
+                continue
+            if entry.get('home_account_id') not in home_account_ids:
+                continue
+            if str(entry.get('realm', '')).lower() != tenant:
+                continue
+            # az asks MSAL for "<resource>/.default", the granted scopes share the resource prefix
+            scopes = str(entry.get('target', '')).split()
+            if not any(scope.rsplit('/', 1)[0].rstrip('/') == resource for scope in scopes):
+                continue
+            try:
+                expires_on = int(entry['expires_on'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if expires_on <= not_before:
+                continue
+            if found is None or expires_on > int(found['expires_on']):
+                found = entry
+
+        return found
+
+    def _load_json(self, path: str, encoding: str = 'utf-8'):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._files.pop(path, None)
+            return None
+
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self._files.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        try:
+            with open(path, 'r', encoding=encoding) as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            # the file may be in the middle of being rewritten by az
+            logger.debug("Failed to read %s: %s", path, e)
+            return None
+
+        self._files[path] = (signature, data)
+        return data
@@ -0,0 +1,60 @@
+import asyncio
+import functools
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share the same key into a single execution.
+
+    The first caller for a key starts the work, every caller that arrives while it is
+    still in flight awaits the same result, including its exception. The work runs in
+    its own task, so a cancelled caller does not cancel it for the others.
+    """
+
+    def __init__(self):
+        self.executed = 0
+        self.coalesced = 0
+        self._calls = {}
+
+    async def do(self, key, fn):
+        """
+        Runs `fn` for the key, or joins the call already in flight for it.
+
+        Args:
+            key: A hashable identifying the call.
+            fn: A callable returning the awaitable to run.
+
+        Returns:
+            The result of the shared call.
+        """
+        task = self._calls.get(key)
+
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(functools.partial(self._on_done, key))
+            self.executed += 1
+        else:
+            self.coalesced += 1
+            logger.debug("Joined in-flight call %s", key)
+
+        return await asyncio.shield(task)
+
+    def _on_done(self, key, task: asyncio.Future):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+        # mark the exception as retrieved in case every caller was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        return {
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls)
+        }
+
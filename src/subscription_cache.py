@@ -0,0 +1,90 @@
+import logging
+import os
+
+from src.msal_token_cache import PROFILE_FILE_NAME
+
+logger = logging.getLogger(__name__)
+
+
+class SubscriptionCache:
+    """
+    Per-user cache of `az account list` results.
+
+    An entry is only served while the user's `azureProfile.json` has the same mtime and
+    size as when the list was fetched, so logins, logouts and `az account set` done
+    by az itself invalidate it.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, user_id: str, config_dir: str):
+        """
+        Returns the cached subscriptions of the user, or None if they are missing or outdated.
+        """
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+
+        signature, subscriptions = entry
+        if signature != self.__get_profile_signature(config_dir):
+            del self._entries[user_id]
+            return None
+
+        return subscriptions
+
+    def put(self, user_id: str, config_dir: str, subscriptions: list):
+        self._entries[user_id] = (self.__get_profile_signature(config_dir), subscriptions)
+
+    def invalidate_user(self, user_id: str):
+        self._entries.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def __get_profile_signature(config_dir: str):
+        try:
+            stat = os.stat(os.path.join(config_dir, PROFILE_FILE_NAME))
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+
+def filter_subscriptions(subscriptions: list,
+                         tenant_id: str = None,
+                         state: str = None,
+                         name: str = None,
+                         fields: list = None):
+    """
+    Filters and projects the output of `az account list`.
+
+    Args:
+        subscriptions (list): The subscriptions.
+        tenant_id (str, optional): Only keep subscriptions of this tenant.
+        state (str, optional): Only keep subscriptions in this state, e.g. 'Enabled'.
+        name (str, optional): Only keep subscriptions whose name contains this text, ignoring case.
+        fields (list, optional): Only keep these fields of every subscription.
+
+    Returns:
+        list: The matching subscriptions.
+    """
+    tenant_id = tenant_id.lower() if tenant_id else None
+    state = state.lower() if state else None
+    name = name.lower() if name else None
+
+    result = []
+    for subscription in subscriptions:
+        if tenant_id and str(subscription.get('tenantId', '')).lower() != tenant_id:
+            continue
+        if state and str(subscription.get('state', '')).lower() != state:
+            continue
+        if name and name not in str(subscription.get('name', '')).lower():
+            continue
+
+        if fields:
+            subscription = {field: subscription[field] for field in fields if field in subscription}
+
+        result.append(subscription)
+
+    return result
@@ -1,22 +1,90 @@
+import configparser
 import json
 import os
 import re
 import subprocess
-import threading
 import asyncio
-import time
 import logging
 
-import pexpect
 import functools
+import time
+
+from src.az_scheduler import AzProcessScheduler, SchedulerBusyError
+from src.az_worker_pool import AzWorkerPool, WorkerCrashedError
+from src.config_dirs import ConfigDirManager
+from src import metrics
+from src.az_errors import AzCommandError, RetryPolicy, classify_az_error, ERROR_CLASS_TRANSIENT, ERROR_CLASS_UNKNOWN
+from src.device_code_sessions import (DeviceCodeSession, DeviceCodeSessionRegistry, LOGIN_STATUS_FAILED,
+                                      LOGIN_STATUS_NONE, LOGIN_STATUS_PENDING, LOGIN_STATUS_SUCCEEDED)
+from src.msal_token_cache import MsalTokenCacheReader
+from src.single_flight import SingleFlight
+from src.subscription_cache import SubscriptionCache
+from src.token_cache import TokenCache
+from src.token_store import TokenStore
 
 logger = logging.getLogger(__name__)
 
+AZ_CONFIG_FILE_NAME = 'config'
+
+# az login --use-device-code prints
+# "To sign in, use a web browser to open the page https://microsoft.com/devicelogin and enter the code XXXXXXXXX to authenticate."
+DEVICE_CODE_PATTERN = re.compile(r'open the page (?P<url>\S+) and enter the code (?P<code>\S+) to authenticate')
+DEVICE_CODE_TIMEOUT = 120
+
+# az config settings every user's AZURE_CONFIG_DIR is initialized with
+AZ_CONFIG_DEFAULTS = {
+    'core': {
+        'login_experience_v2': 'off',
+        'only_show_errors': 'yes'
+    }
+}
+
+AZ_COMMAND_DURATION = metrics.Histogram('tokenflow_az_command_duration_seconds',
+                                        'Latency of az commands by subcommand, including the scheduler wait.',
+                                        ('command',),
+                                        buckets=metrics.AZ_COMMAND_BUCKETS)
+AZ_COMMAND_EXITS = metrics.Counter('tokenflow_az_command_exits_total',
+                                   'Exit codes of az commands by subcommand.',
+                                   ('command', 'code'))
+AZ_COMMANDS_IN_FLIGHT = metrics.Gauge('tokenflow_az_commands_in_flight',
+                                      'Number of az commands being executed, by a process or a worker.')
+AUTHENTICATION_RETRIES = metrics.Counter('tokenflow_authentication_retries_total',
+                                         'Number of times a token request was retried, by class of the error.',
+                                         ('error_class',))
+
 
 class AzureAuthenticator:
-    def __init__(self):
-        self.users_data = {}
-        self.lock = threading.Lock()
+    def __init__(self,
+                 token_cache: TokenCache = None,
+                 msal_reader: MsalTokenCacheReader = None,
+                 scheduler: AzProcessScheduler = None,
+                 worker_pool: AzWorkerPool = None,
+                 login_wait_timeout: float = 45,
+                 sessions: DeviceCodeSessionRegistry = None,
+                 token_store: TokenStore = None,
+                 retry_policy: RetryPolicy = None,
+                 retry_deadline: float = 45,
+                 config_dirs: ConfigDirManager = None):
+        self.sessions = sessions if sessions is not None else DeviceCodeSessionRegistry()
+        self.envs = {}
+        # the users' AZURE_CONFIG_DIRs, an evicted directory makes the user start over
+        self.config_dirs = config_dirs if config_dirs is not None else ConfigDirManager()
+        self.config_dirs.on_evict.append(self.forget_user)
+        self.config_dirs.is_in_use = self.__is_login_pending
+        self.token_cache = token_cache if token_cache is not None else TokenCache()
+        # when set, tokens outlive restarts of the service
+        self.token_store = token_store
+        self.msal_reader = msal_reader if msal_reader is not None else MsalTokenCacheReader()
+        self.subscription_cache = SubscriptionCache()
+        self.single_flight = SingleFlight()
+        self.scheduler = scheduler if scheduler is not None else AzProcessScheduler()
+        # when set, az commands run on warm workers instead of new az processes
+        self.worker_pool = worker_pool
+        # how long a token request waits for a pending device code login to complete
+        self.login_wait_timeout = login_wait_timeout
+        # how transient az failures are retried, and for how long at most
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.retry_deadline = retry_deadline
 
     async def get_device_code_async(self, user_id: str):
         """
@@ -32,58 +100,122 @@ class AzureAuthenticator:
             Exception: If there is an error retrieving the device code.
         """
 
+        # a new login replaces whatever tokens the user had before
+        self.token_cache.invalidate_user(user_id)
+        if self.token_store is not None:
+            self.token_store.invalidate_user(user_id)
+        self.subscription_cache.invalidate_user(user_id)
+
+        # and the login the user may have started before
+        session = await self.sessions.start_session_async(user_id)
+
+        try:
+            url, device_code = await self.__start_device_code_login_async(user_id, session)
+        except BaseException:
+            await self.sessions.remove_session_async(session)
+            raise
+
+        # keep reading the output so az never blocks on a full pipe, the login completes when az exits
+        session.login_task = asyncio.create_task(self.__watch_login_async(session))
+
+        logger.info("User: %s device code process completed successfully.", user_id)
+
+        return url, device_code
+
+    async def __start_device_code_login_async(self, user_id: str, session: DeviceCodeSession):
         # Set the environment variable
         env = self.__set_env(user_id)
 
         # run az logout to clear any existing sessions
-        logger.info(f"User: {user_id} logging out of Azure CLI...")
+        logger.info("User: %s logging out of Azure CLI...", user_id)
 
-        result = subprocess.run(
-            ['az', 'logout'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
-
-        # make sure the user is logged out
-        time.sleep(5)
+        # wait for the logout to actually finish instead of sleeping
+        result = await self.__execute_az_async(user_id, ['logout'], env)
 
         if result.returncode != 0:
-            logger.error(f"User: {user_id} failed to logout: {
-                         result.stderr.decode('utf-8')}")
+            logger.error("User: %s failed to logout: %s", user_id, result.stderr)
         else:
-            logger.info(f"User: {user_id} logged out of Azure CLI.")
+            logger.info("User: %s logged out of Azure CLI.", user_id)
 
-        # Execute the command
-        child = pexpect.spawn(
-            'az login --use-device-code', env=env, timeout=120)
+        # Execute the command, az prints the device code message to stderr. It runs until the user
+        # completes the login, outside the scheduler, the session registry's max_pending bounds it
+        session.child = await asyncio.create_subprocess_exec(
+            'az', 'login', '--use-device-code', stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, env=env)
 
-        logger.debug(f"User: {user_id} launching a device code process...")
+        logger.debug("User: %s launching a device code process...", user_id)
 
-        index = child.expect(
-            ['To sign in, use a web browser to open the page https://microsoft.com/devicelogin and enter the code .* to authenticate.', pexpect.EOF])
-        logger.debug(str(child.before))
+        try:
+            url, device_code = await asyncio.wait_for(
+                self.__read_device_code_async(session), timeout=DEVICE_CODE_TIMEOUT)
+        except asyncio.TimeoutError:
+            ex = f"User: {user_id} timed out waiting for the device code."
+            logger.error(ex)
+            raise Exception(ex)
 
-        if index == 0:
-            # Extract the device code from the output
-            match = re.search(
-                'enter the code (.*?) to authenticate', child.after.decode())
-            if match:
-                device_code = match.group(1)
-                logger.debug(f"User: {user_id} device code: {device_code} was created successfully.")
-            else:
-                ex = f"User: {user_id} could not extract device code successfully."
-                logger.error(ex)
-                raise Exception(ex)
-        elif index == 1:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s", ''.join(session.output))
+
+        if device_code is None:
             ex = f"User: {user_id} command exited before device code was provided."
             logger.error(ex)
             raise Exception(ex)
 
-        with self.lock:
-            self.users_data[user_id] = {'child': child}
+        logger.debug("User: %s device code: %s was created successfully.", user_id, device_code)
+        return url, device_code
 
-        logger.info(
-            f"User: {user_id} device code process completed successfully.")
+    @staticmethod
+    async def __read_device_code_async(session: DeviceCodeSession):
+        while True:
+            line = await session.child.stdout.readline()
+            if not line:
+                return None, None
 
-        url = 'https://microsoft.com/devicelogin'
-        return url, device_code
+            line = line.decode('utf-8', errors='replace')
+            session.output.append(line)
+
+            match = DEVICE_CODE_PATTERN.search(line)
+            if match:
+                return match.group('url'), match.group('code')
+
+    async def __watch_login_async(self, session: DeviceCodeSession):
+        child = session.child
+
+        while True:
+            line = await child.stdout.readline()
+            if not line:
+                break
+            session.output.append(line.decode('utf-8', errors='replace'))
+        await child.wait()
+
+        if child.returncode == 0:
+            await session.complete_async(LOGIN_STATUS_SUCCEEDED)
+            self.subscription_cache.invalidate_user(session.user_id)
+            logger.info("User: %s logged in to Azure CLI.", session.user_id)
+        else:
+            await session.complete_async(LOGIN_STATUS_FAILED)
+            logger.warning("User: %s device code login exited with code %s: %s",
+                           session.user_id, child.returncode, ''.join(session.output))
+
+        AZ_COMMAND_EXITS.labels('login', child.returncode).inc()
+
+    async def wait_for_login_async(self, user_id: str, timeout: float = 0):
+        """
+        Waits until the user's device code login completes, or the timeout expires.
+
+        Args:
+            user_id (str): The user ID.
+            timeout (float, optional): The maximum number of seconds to wait.
+
+        Returns:
+            dict: The login status ('none', 'pending', 'succeeded' or 'failed') with its start and completion times.
+        """
+        # the login may run in another worker, its state is shared by the session registry
+        state = await self.sessions.wait_async(user_id, timeout=timeout)
+
+        if state is None:
+            return {'status': LOGIN_STATUS_NONE, 'started_at': None, 'completed_at': None}
+
+        return {'status': state['status'], 'started_at': state['started_at'], 'completed_at': state['completed_at']}
 
     async def check_az_login_async(self, user_id: str):
         """
@@ -92,84 +224,157 @@ class AzureAuthenticator:
         Returns:
             bool: True if the user is logged in, False otherwise.
         """
+        # a valid token cached since the user's latest login means the user has already logged in
+        not_before = self.sessions.get_login_started_at(user_id)
+        if self.token_cache.has_user(user_id, not_before=not_before):
+            return True
+        if self.token_store is not None and self.token_store.has_user(user_id, not_before=not_before):
+            return True
+
+        # a device code login in progress will log the user in, whichever worker runs it
+        state = self.sessions.get_state(user_id)
+        if state is not None and state['status'] != LOGIN_STATUS_FAILED:
+            return True
+
+        # so does an account in the Azure CLI profile
+        if self.msal_reader.has_account(self.__get_temp_dir(user_id)):
+            return True
+
         env = self.__set_env(user_id=user_id)
 
         # Execute the command
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(None, functools.partial(subprocess.run, ['az', 'account', 'get-access-token'], capture_output=True, text=True, env=env))
+        result = await self.__run_az_async(user_id, ['account', 'get-access-token'], env)
 
         if re.search(r"Please run 'az login'.*to setup account", result.stderr):
             # Your code here
-            logger.warning(f"{result.stderr}")
+            logger.warning("%s", result.stderr)
             return False
         else:
             return True
 
+    async def __run_az_async(self, user_id: str, args: list, env: dict = None):
+        # identical concurrent commands of the same user share one az process
+        key = (user_id, tuple(args))
+        return await self.single_flight.do(key, functools.partial(self.__execute_az_async, user_id, args, env))
+
+    async def __execute_az_async(self, user_id: str, args: list, env: dict = None):
+        command = get_az_command_name(args)
+        start = time.perf_counter()
+
+        async with self.scheduler.slot(user_id or ''):
+            AZ_COMMANDS_IN_FLIGHT.inc()
+            try:
+                result = await self.__spawn_az_async(user_id, args, env)
+            finally:
+                AZ_COMMANDS_IN_FLIGHT.dec()
+
+        AZ_COMMAND_DURATION.labels(command).observe(time.perf_counter() - start)
+        AZ_COMMAND_EXITS.labels(command, result.returncode).inc()
+        return result
+
+    async def __spawn_az_async(self, user_id: str, args: list, env: dict = None):
+        if self.worker_pool is not None:
+            try:
+                return await self.worker_pool.run(args, env['AZURE_CONFIG_DIR'] if env else None)
+            except WorkerCrashedError:
+                logger.warning("User: %s - az worker failed, falling back to an az process.", user_id)
+
+        process = await asyncio.create_subprocess_exec(
+            'az', *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=env)
+        stdout, stderr = await process.communicate()
+
+        return subprocess.CompletedProcess(['az', *args],
+                                           process.returncode,
+                                           stdout.decode('utf-8', errors='replace'),
+                                           stderr.decode('utf-8', errors='replace'))
+
     def __set_env(self, user_id):
         # to utilize the multiple user login experience, we need to set the environment variable AZURE_CONFIG_DIR
         # https://github.com/microsoft/azure-pipelines-tasks/issues/8314
 
+        # another worker may have evicted the directory, the config has to be written again then
+        env = self.envs.get(user_id)
+        if env is not None and os.path.exists(os.path.join(env['AZURE_CONFIG_DIR'], AZ_CONFIG_FILE_NAME)):
+            return env
+
         temp_dir = self.__get_temp_dir(user_id)
         env = os.environ.copy()
         env['AZURE_CONFIG_DIR'] = temp_dir
 
-        # Ensure the directory exists
-        os.makedirs(env['AZURE_CONFIG_DIR'], exist_ok=True)
-
-        # execute az config set core.login_experience_v2=off
-        command = ['az', 'config', 'set', 'core.login_experience_v2=off']
-        result = subprocess.run(
-            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        # same as az config set core.login_experience_v2=off core.only_show_errors=yes,
+        # without starting an az process for it
+        self.__write_config(temp_dir)
 
-        if result.returncode != 0:
-            logger.error(f"Failed to set login_experience_v2: {
-                         result.stderr.decode('utf-8')}")
-        else:
-            logger.debug("az config set login_experience_v2 successfully")
+        self.envs[user_id] = env
+        return env
 
-        # New command to only show errors
-        error_command = ['az', 'config', 'set', 'core.only_show_errors=yes']
-        error_result = subprocess.run(
-            error_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    def __write_config(self, config_dir: str):
+        config_path = os.path.join(config_dir, AZ_CONFIG_FILE_NAME)
 
-        if error_result.returncode != 0:
-            logger.error(f"Failed to set only_show_errors: {
-                         error_result.stderr.decode('utf-8')}")
-        else:
-            logger.debug("az config set only_show_errors set successfully")
-
-        return env
+        config = configparser.ConfigParser()
+        try:
+            config.read(config_path)
+        except configparser.Error as e:
+            logger.error("Failed to read az config %s, it will be rewritten: %s", config_path, e)
+            config = configparser.ConfigParser()
+
+        changed = False
+        for section, options in AZ_CONFIG_DEFAULTS.items():
+            if not config.has_section(section):
+                config.add_section(section)
+            for option, value in options.items():
+                if config.get(section, option, fallback=None) != value:
+                    config.set(section, option, value)
+                    changed = True
+
+        if changed:
+            with open(config_path, 'w') as config_file:
+                config.write(config_file)
+            logger.debug("az config %s written successfully", config_path)
 
     def __get_temp_dir(self, user_id: str):
 
-        temp_dir = os.path.join(os.path.expanduser('~'), '.temp', user_id)
-        logger.info(
-            f"User: {user_id} - temp directory: {temp_dir}")
-
-        # Ensure the directory exists
-        os.makedirs(temp_dir, exist_ok=True)
+        # validates the user ID, creates the directory and records its use
+        temp_dir = self.config_dirs.get_dir(user_id)
+        logger.info("User: %s - temp directory: %s", user_id, temp_dir)
 
         return temp_dir
 
+    def forget_user(self, user_id: str, config_dir: str):
+        """
+        Drops everything known about the user, e.g. after the user's config directory was evicted.
+        """
+        self.envs.pop(user_id, None)
+        self.token_cache.invalidate_user(user_id)
+        self.subscription_cache.invalidate_user(user_id)
+        self.msal_reader.invalidate(config_dir)
+        if self.token_store is not None:
+            self.token_store.invalidate_user(user_id)
+
+    def __is_login_pending(self, user_id: str):
+        state = self.sessions.get_state(user_id)
+        return state is not None and state['status'] == LOGIN_STATUS_PENDING
+
     async def __get_token_async(self,
                                 user_id: str,
                                 resource: str,
                                 tenant_id: str = None,
-                                subscription_id: str = None):
-        try:
-            # Wait for the command to finish
-            child = self.users_data[user_id]['child']
-            child.close(True)
-            logger.debug(f'{child.exitstatus}-{child.signalstatus}')
-
-            output = child.before.decode() + child.after.decode()
-            logger.debug(output)
-        except KeyError:
-            logger.warning(f"No child process found for user {user_id}. Continuing execution.")
+                                subscription_id: str = None,
+                                force_refresh: bool = False):
+        # serve the token from the MSAL token cache written by az when it is still valid
+        if not force_refresh:
+            token_info = self.msal_reader.get_token(self.__get_temp_dir(user_id),
+                                                    resource,
+                                                    tenant_id,
+                                                    subscription_id,
+                                                    min_validity=self.token_cache.refresh_margin)
+            if token_info is not None:
+                logger.debug("User: %s - token read from the MSAL token cache.", user_id)
+                return token_info
 
         env = self.__set_env(user_id)
 
-        command = ['az', 'account', 'get-access-token', '--resource', resource]
+        command = ['account', 'get-access-token', '--resource', resource]
         
         if tenant_id:
             command.extend(['--tenant', tenant_id])
@@ -178,13 +383,15 @@ class AzureAuthenticator:
             command.extend(['--subscription', subscription_id])
 
         # Execute the command
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(None, functools.partial(subprocess.run, command, capture_output=True, text=True, env=env))
+        result = await self.__run_az_async(user_id, command, env)
 
         # Check if the command was successful
         if result.returncode != 0:
-            raise Exception(f'az account get-access-token --resource {
-                            resource} command failed with exit code {result.returncode}: {result.stderr}')
+            raise AzCommandError(f'az account get-access-token --resource {
+                                 resource} command failed with exit code {result.returncode}: {result.stderr}',
+                                 classify_az_error(result.stderr),
+                                 returncode=result.returncode,
+                                 stderr=result.stderr)
 
         # Parse the output as JSON
         token_info = json.loads(result.stdout)
@@ -207,9 +414,13 @@ class AzureAuthenticator:
         # Set the environment variable
         env = self.__set_env(user_id)
 
+        subscriptions = self.subscription_cache.get(user_id, env['AZURE_CONFIG_DIR'])
+        if subscriptions is not None:
+            logger.debug("User: %s - subscriptions served from cache.", user_id)
+            return subscriptions
+
         # Execute the command
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(None, functools.partial(subprocess.run, ['az', 'account', 'list'], capture_output=True, text=True, env=env))
+        result = await self.__run_az_async(user_id, ['account', 'list'], env)
 
         # Check if the command was successful
         if result.returncode != 0:
@@ -218,35 +429,134 @@ class AzureAuthenticator:
 
         # Parse the output as JSON
         subscriptions = json.loads(result.stdout)
+        self.subscription_cache.put(user_id, env['AZURE_CONFIG_DIR'], subscriptions)
         return subscriptions
 
-    async def authenticate_async(self, 
-                                 user_id: str, 
+    async def authenticate_async(self,
+                                 user_id: str,
                                  resource: str,
                                  tenant_id: str = None,
-                                 subscription_id: str = None):
-        retry_count = 0
-        max_retries = 3
+                                 subscription_id: str = None,
+                                 timeout: float = None):
+        """
+        Returns a token of the user, from the caches or from az.
+
+        Transient az failures are retried with exponential backoff and jitter until
+        `timeout` seconds, by default `retry_deadline`, have passed since the call.
+        Permanent failures and failures that need a new login are raised right away.
+
+        Args:
+            user_id (str): The user ID.
+            resource (str): The resource to get the token for.
+            tenant_id (str, optional): The tenant to get the token for.
+            subscription_id (str, optional): The subscription to get the token for.
+            timeout (float, optional): The maximum number of seconds the call may take.
+
+        Returns:
+            dict: The token info, or None if the device code login did not complete.
+
+        Raises:
+            AzCommandError: If az failed, with the class of the failure.
+            SchedulerBusyError: If too many az commands are queued.
+        """
+        # another worker may have started a new login, the tokens of the previous one are stale
+        not_before = self.sessions.get_login_started_at(user_id)
+
+        token = self.token_cache.get(user_id, resource, tenant_id, subscription_id, not_before=not_before)
+        if token is not None:
+            logger.debug("User: %s - token served from cache.", user_id)
+            return token
+
+        if self.token_store is not None:
+            token = self.token_store.get(user_id, resource, tenant_id, subscription_id,
+                                         min_validity=self.token_cache.refresh_margin, not_before=not_before)
+            if token is not None:
+                logger.debug("User: %s - token served from the token store.", user_id)
+                self.token_cache.put(user_id, resource, token, tenant_id, subscription_id)
+                return token
 
-        while retry_count < max_retries:
+        deadline = time.monotonic() + (timeout if timeout is not None else self.retry_deadline)
+
+        # the token is available as soon as the device code login completes
+        login_wait_timeout = min(self.login_wait_timeout, max(0, deadline - time.monotonic()))
+        login = await self.wait_for_login_async(user_id, timeout=login_wait_timeout)
+        if login['status'] == LOGIN_STATUS_PENDING:
+            logger.warning("User: %s - device code login did not complete within %s seconds.", user_id, login_wait_timeout)
+            return None
+        if login['status'] == LOGIN_STATUS_FAILED:
+            logger.error("User: %s - device code login failed.", user_id)
+            return None
+
+        attempt = 0
+
+        while True:
+            remaining = deadline - time.monotonic()
             try:
-                token = await self.__get_token_async(user_id=user_id, resource=resource, tenant_id=tenant_id, subscription_id=subscription_id)
-                logger.info(f"User: {user_id} - Authentication successful.")
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                token = await asyncio.wait_for(
+                    self.__get_token_async(user_id=user_id, resource=resource, tenant_id=tenant_id, subscription_id=subscription_id),
+                    timeout=remaining)
+                self.__remember_token(user_id, resource, token, tenant_id, subscription_id)
+                logger.info("User: %s - Authentication successful.", user_id)
                 return token
+            except SchedulerBusyError:
+                # waiting here would only add to the backlog, let the client retry later
+                raise
+            except asyncio.TimeoutError:
+                raise AzCommandError(f"Timed out getting a token for {resource} after {attempt + 1} attempts.",
+                                     ERROR_CLASS_TRANSIENT)
+            except AzCommandError as e:
+                error = e
             except Exception as e:
-                error_message = str(e)
-                if 'az login' in error_message:
-                    logger.error(f"User: {user_id} 'az login' found in the error message: {error_message}")
-                    return None
+                error = AzCommandError(str(e), ERROR_CLASS_UNKNOWN)
+
+            if not self.retry_policy.is_retryable(error.error_class):
+                logger.error("User: %s - %s error, not retrying: %s", user_id, error.error_class, error)
+                raise error
+
+            delay = self.retry_policy.get_delay(attempt)
+            if time.monotonic() + delay >= deadline:
+                logger.error("User: %s - Authentication failed after %s attempts: %s", user_id, attempt + 1, error)
+                raise error
+
+            logger.warning("User: %s - %s error, retrying in %.1f seconds: %s", user_id, error.error_class, delay, error)
+            await asyncio.sleep(delay)
+            attempt += 1
+            AUTHENTICATION_RETRIES.labels(error.error_class).inc()
+
+    async def refresh_token_async(self,
+                                  user_id: str,
+                                  resource: str,
+                                  tenant_id: str = None,
+                                  subscription_id: str = None):
+        """
+        Fetches a token with az, bypassing the caches, and stores it in the token cache.
 
-            logger.error(f"User: {user_id} - Waiting for user to authenticate..." + error_message)
-            await asyncio.sleep(15)
-            retry_count += 1
+        Args:
+            user_id (str): The user ID.
+            resource (str): The resource to get the token for.
+            tenant_id (str, optional): The tenant to get the token for.
+            subscription_id (str, optional): The subscription to get the token for.
 
-        if retry_count == max_retries:
-            logger.error(f"User: {user_id} - Authentication failed after {max_retries} attempts.")
+        Returns:
+            dict: The token info.
 
-        return None
+        Raises:
+            Exception: If the az command fails.
+        """
+        token = await self.__get_token_async(user_id=user_id,
+                                             resource=resource,
+                                             tenant_id=tenant_id,
+                                             subscription_id=subscription_id,
+                                             force_refresh=True)
+        self.__remember_token(user_id, resource, token, tenant_id, subscription_id)
+        return token
+
+    def __remember_token(self, user_id: str, resource: str, token: dict, tenant_id: str = None, subscription_id: str = None):
+        self.token_cache.put(user_id, resource, token, tenant_id, subscription_id)
+        if self.token_store is not None:
+            self.token_store.put(user_id, resource, token, tenant_id, subscription_id)
 
     async def get_version_async(self):
         """
@@ -256,8 +566,7 @@ class AzureAuthenticator:
             str: The version of the Azure CLI.
         """
         # Execute the command
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(None, functools.partial(subprocess.run, ['az', 'version'], capture_output=True, text=True))
+        result = await self.__run_az_async(None, ['version'])
 
         if result.returncode != 0:
             raise Exception(f'az version command failed with exit code {result.returncode}: {result.stderr}')
@@ -268,3 +577,15 @@ class AzureAuthenticator:
             return version_info
         except json.JSONDecodeError as e:
             raise Exception(f'Failed to parse Azure CLI version from output: {str(e)}')
+
+
+def get_az_command_name(args: list):
+    """
+    Returns the az subcommand without its options, e.g. 'account get-access-token', to label metrics with.
+    """
+    words = []
+    for arg in args:
+        if arg.startswith('-'):
+            break
+        words.append(arg)
+    return ' '.join(words)
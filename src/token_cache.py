@@ -0,0 +1,147 @@
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class TokenCache:
+    """
+    In-memory, expiry-aware cache of `az account get-access-token` results.
+
+    Entries are keyed by (user_id, resource, tenant_id, subscription_id) and are
+    evicted in least-recently-used order once `max_size` is reached. An entry is
+    only served while it is valid for at least `refresh_margin` more seconds, so
+    callers never receive a token that is about to expire. The keys of every user
+    are indexed, so per-user lookups do not scan the cache. Lookups can pass
+    `not_before`, e.g. the start of the user's latest login on any worker, to skip
+    entries written before it.
+    """
+
+    def __init__(self, max_size: int = 1024, refresh_margin: int = 120):
+        if max_size <= 0:
+            raise ValueError("max_size must be greater than zero")
+
+        self.max_size = max_size
+        self.refresh_margin = refresh_margin
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._user_keys = {}
+
+    @staticmethod
+    def make_key(user_id: str,
+                 resource: str,
+                 tenant_id: str = None,
+                 subscription_id: str = None):
+        return (user_id, resource, tenant_id or None, subscription_id or None)
+
+    @staticmethod
+    def get_expires_on(token_info: dict):
+        """
+        Returns the POSIX expiry time of a token, or None if it cannot be determined.
+
+        Args:
+            token_info (dict): The output of `az account get-access-token`.
+
+        Returns:
+            int: The expiry time in seconds since the epoch.
+        """
+        expires_on = token_info.get('expires_on')
+        if expires_on is not None:
+            try:
+                return int(expires_on)
+            except (TypeError, ValueError):
+                pass
+
+        # older Azure CLI versions only return the local time string
+        expires_on_str = token_info.get('expiresOn')
+        if expires_on_str:
+            try:
+                return int(datetime.strptime(expires_on_str, '%Y-%m-%d %H:%M:%S.%f').timestamp())
+            except ValueError:
+                pass
+
+        return None
+
+    def get(self,
+            user_id: str,
+            resource: str,
+            tenant_id: str = None,
+            subscription_id: str = None,
+            not_before: float = None):
+        """
+        Returns the cached token for the key, or None if it is missing, due for refresh or written before not_before.
+        """
+        key = self.make_key(user_id, resource, tenant_id, subscription_id)
+        entry = self._entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_on, token_info, written_at = entry
+        if expires_on - self.refresh_margin <= time.time() or (not_before is not None and written_at < not_before):
+            self.__remove(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return token_info
+
+    def put(self,
+            user_id: str,
+            resource: str,
+            token_info: dict,
+            tenant_id: str = None,
+            subscription_id: str = None):
+        """
+        Stores a token in the cache, evicting the least recently used entries if needed.
+        """
+        expires_on = self.get_expires_on(token_info)
+        if expires_on is None:
+            logger.debug("User: %s - token has no expiry, not caching it.", user_id)
+            return
+
+        key = self.make_key(user_id, resource, tenant_id, subscription_id)
+        self._entries[key] = (expires_on, token_info, time.time())
+        self._entries.move_to_end(key)
+        self._user_keys.setdefault(user_id, set()).add(key)
+
+        while len(self._entries) > self.max_size:
+            self.__remove(next(iter(self._entries)))
+
+    def has_user(self, user_id: str, not_before: float = None):
+        """
+        Returns True if there is at least one valid token cached for the user, written after not_before if given.
+        """
+        now = time.time()
+        for key in self._user_keys.get(user_id, ()):
+            expires_on, _, written_at = self._entries[key]
+            if expires_on - self.refresh_margin > now and (not_before is None or written_at >= not_before):
+                return True
+        return False
+
+    def invalidate_user(self, user_id: str):
+        """
+        Removes every cached token of the user.
+        """
+        keys = self._user_keys.pop(user_id, ())
+        for key in keys:
+            del self._entries[key]
+
+        if keys:
+            logger.debug("User: %s - removed %s cached token(s).", user_id, len(keys))
+
+    def __remove(self, key: tuple):
+        del self._entries[key]
+        keys = self._user_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._user_keys[key[0]]
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import random
+import time
+
+from src.az_errors import AzCommandError, ERROR_CLASS_LOGIN_REQUIRED, ERROR_CLASS_PERMANENT
+from src.az_scheduler import SchedulerBusyError
+from src.token_cache import TokenCache
+
+logger = logging.getLogger(__name__)
+
+# az (MSAL) hands back its cached access token until it is valid for less than this many seconds
+MSAL_RENEWAL_WINDOW = 300
+
+
+class TokenRefresher:
+    """
+    Refreshes recently requested tokens in the background before they expire.
+
+    Every (user_id, resource, tenant_id, subscription_id) handed out through `track` is
+    refreshed `lead_time` seconds, plus up to `jitter` random seconds, before the token
+    cache would consider it stale, but never before az renews tokens, so a refresh does
+    not get the same token back. Keys that were not requested for `idle_timeout`
+    seconds are dropped. At most `max_concurrency` refreshes run at the same time.
+
+    Every new token of a key is pushed to the queues subscribed to it. The key is
+    refreshed once however many subscribers it has, and never dropped while it has any.
+    """
+
+    def __init__(self,
+                 authenticator,
+                 lead_time: int = 60,
+                 jitter: int = 60,
+                 idle_timeout: int = 3600,
+                 max_concurrency: int = 2,
+                 interval: float = 5,
+                 retry_interval: float = 30):
+        self.authenticator = authenticator
+        self.lead_time = lead_time
+        self.jitter = jitter
+        self.idle_timeout = idle_timeout
+        self.interval = interval
+        self.retry_interval = retry_interval
+
+        self.refreshed = 0
+        self.failed = 0
+
+        self._tracked = {}
+        self._refreshing = {}
+        self._subscribers = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._task = None
+
+    def track(self,
+              user_id: str,
+              resource: str,
+              token_info: dict,
+              tenant_id: str = None,
+              subscription_id: str = None):
+        """
+        Records that a token was requested, so it is kept fresh while it is in use.
+        """
+        key = TokenCache.make_key(user_id, resource, tenant_id, subscription_id)
+        entry = self._tracked.get(key)
+
+        if entry is None:
+            entry = {'expires_on': None, 'refresh_at': None}
+            self._tracked[key] = entry
+
+        entry['last_requested'] = time.time()
+        if self.__schedule(entry, TokenCache.get_expires_on(token_info)):
+            self.__publish(key, token_info)
+
+    def untrack_user(self, user_id: str):
+        """
+        Stops refreshing the tokens of the user, their subscribers get a login_required error.
+        """
+        for key in [key for key in self._tracked if key[0] == user_id]:
+            del self._tracked[key]
+
+        error = AzCommandError("The user logged in again or was evicted, subscribe again after logging in.",
+                               ERROR_CLASS_LOGIN_REQUIRED)
+        for key in [key for key in self._subscribers if key[0] == user_id]:
+            self.__publish(key, None, error)
+
+    def subscribe(self, key: tuple, queue: asyncio.Queue):
+        """
+        Pushes (key, token_info, None) to the queue whenever the key gets a new token, and
+        (key, None, error) when it cannot be refreshed any more, until `unsubscribe`.
+
+        Args:
+            key (tuple): The (user_id, resource, tenant_id, subscription_id) of the token.
+            queue (asyncio.Queue): The queue of the subscriber.
+        """
+        self._subscribers.setdefault(key, set()).add(queue)
+        if key not in self._tracked:
+            # refreshed once its first token is tracked
+            self._tracked[key] = {'expires_on': None, 'refresh_at': None, 'last_requested': time.time()}
+
+    def unsubscribe(self, key: tuple, queue: asyncio.Queue):
+        queues = self._subscribers.get(key)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[key]
+            entry = self._tracked.get(key)
+            if entry is not None:
+                # idle from now on, unless it is requested again
+                entry['last_requested'] = time.time()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.__run_async())
+
+    async def stop(self):
+        tasks = list(self._refreshing.values())
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "tracked": len(self._tracked),
+            "refreshing": len(self._refreshing),
+            "subscribers": sum(len(queues) for queues in self._subscribers.values()),
+            "refreshed": self.refreshed,
+            "failed": self.failed
+        }
+
+    async def refresh_due_async(self):
+        """
+        Starts a refresh for every tracked token that is due, and drops idle ones.
+        """
+        now = time.time()
+
+        for key, entry in list(self._tracked.items()):
+            if key not in self._subscribers and now - entry['last_requested'] > self.idle_timeout:
+                logger.debug("User: %s - stopped refreshing idle token for %s.", key[0], key[1])
+                del self._tracked[key]
+                continue
+
+            if entry['refresh_at'] is not None and entry['refresh_at'] <= now and key not in self._refreshing:
+                task = asyncio.create_task(self.__refresh_async(key, entry))
+                self._refreshing[key] = task
+                task.add_done_callback(lambda _, key=key: self._refreshing.pop(key, None))
+
+    async def __run_async(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh_due_async()
+            except Exception as e:
+                logger.error("Token refresh failed: %s", e)
+
+    async def __refresh_async(self, key: tuple, entry: dict):
+        user_id, resource, tenant_id, subscription_id = key
+
+        async with self._semaphore:
+            try:
+                token_info = await self.authenticator.refresh_token_async(user_id, resource, tenant_id, subscription_id)
+            except SchedulerBusyError:
+                entry['refresh_at'] = time.time() + self.retry_interval
+                return
+            except Exception as e:
+                self.failed += 1
+                if getattr(e, 'error_class', None) in (ERROR_CLASS_LOGIN_REQUIRED, ERROR_CLASS_PERMANENT) \
+                        or 'az login' in str(e):
+                    # the user has to log in again, or the token cannot be had at all, nothing to refresh until then
+                    self._tracked.pop(key, None)
+                    self.__publish(key, None, e)
+                else:
+                    entry['refresh_at'] = time.time() + self.retry_interval
+                logger.warning("User: %s - failed to refresh token for %s: %s", user_id, resource, e)
+                return
+
+        self.refreshed += 1
+        logger.debug("User: %s - refreshed token for %s.", user_id, resource)
+        if self.__schedule(entry, TokenCache.get_expires_on(token_info)):
+            self.__publish(key, token_info)
+
+    def __publish(self, key: tuple, token_info: dict, error: Exception = None):
+        for queue in self._subscribers.get(key, ()):
+            queue.put_nowait((key, token_info, error))
+
+    def __schedule(self, entry: dict, expires_on: int):
+        """
+        Schedules the refresh of a token, returns True if it is newer than the one tracked.
+        """
+        if expires_on is None:
+            return False
+
+        if entry['expires_on'] is not None and expires_on <= entry['expires_on']:
+            if entry['refresh_at'] is not None and entry['refresh_at'] <= time.time():
+                # az handed back the token it already had, MSAL only renews it close to expiry
+                entry['refresh_at'] = time.time() + self.retry_interval
+            return False
+
+        entry['expires_on'] = expires_on
+        entry['refresh_at'] = max(expires_on
+                                  - self.authenticator.token_cache.refresh_margin
+                                  - self.lead_time
+                                  - random.uniform(0, self.jitter),
+                                  expires_on - MSAL_RENEWAL_WINDOW + 1)
+        return True
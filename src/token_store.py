@@ -0,0 +1,294 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from src.token_cache import TokenCache
+
+logger = logging.getLogger(__name__)
+
+TOKEN_STORE_FILE_NAME = '.token_store.sqlite3'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    user_id TEXT NOT NULL,
+    resource TEXT NOT NULL,
+    tenant_id TEXT NOT NULL,
+    subscription_id TEXT NOT NULL,
+    expires_on INTEGER NOT NULL,
+    token_type TEXT,
+    updated_at REAL NOT NULL,
+    token BLOB NOT NULL,
+    PRIMARY KEY (user_id, resource, tenant_id, subscription_id)
+);
+CREATE INDEX IF NOT EXISTS tokens_expires_on ON tokens (expires_on);
+"""
+
+
+class TokenStore:
+    """
+    Persistent store of issued tokens, so a restarted replica serves them without az.
+
+    Tokens are kept in a SQLite database in WAL mode, keyed by (user_id, resource,
+    tenant_id, subscription_id). The expiry and token type are stored as columns,
+    the token itself is encrypted with the Fernet `key`, with the time it was written
+    so lookups can skip tokens older than the user's latest login. Nothing is loaded at
+    startup, a token is read on the first miss of the in-memory cache. Writes are
+    queued and written in one transaction every `flush_interval` seconds, and
+    expired rows are deleted every `prune_interval` seconds. Queued and in-flight
+    writes are seen by reads until they are committed.
+
+    Reads are primary key lookups on a local database and run on the calling thread,
+    also when it is the event loop's. Writes run in a worker thread.
+    """
+
+    def __init__(self,
+                 path: str,
+                 key: str,
+                 flush_interval: float = 1,
+                 prune_interval: float = 300):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.prune_interval = prune_interval
+
+        self.hits = 0
+        self.misses = 0
+        self.written = 0
+        self.pruned = 0
+
+        self._fernet = Fernet(key)
+        self._pending = {}
+        self._deleted_users = set()
+        # the batch being written, read until it is committed
+        self._flushing_pending = {}
+        self._flushing_deleted_users = set()
+        self._flush_lock = asyncio.Lock()
+        self._reader = None
+        self._writer = None
+        # the writer connection is used from worker threads, one at a time
+        self._write_lock = threading.Lock()
+        self._task = None
+
+    def get(self,
+            user_id: str,
+            resource: str,
+            tenant_id: str = None,
+            subscription_id: str = None,
+            min_validity: int = 0,
+            not_before: float = None):
+        """
+        Returns the stored token for the key, or None if it is missing, valid for less than
+        min_validity seconds or written before not_before.
+        """
+        key = TokenCache.make_key(user_id, resource, tenant_id, subscription_id)
+
+        # newest first: queued writes, the batch being written, then the database
+        if key in self._pending:
+            entry = self._pending[key]
+        elif user_id in self._deleted_users:
+            entry = None
+        elif key in self._flushing_pending:
+            entry = self._flushing_pending[key]
+        elif user_id in self._flushing_deleted_users:
+            entry = None
+        else:
+            entry = self.__read(key)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        token_info, written_at = entry
+        if TokenCache.get_expires_on(token_info) - min_validity <= time.time() \
+                or (not_before is not None and written_at < not_before):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return token_info
+
+    def put(self,
+            user_id: str,
+            resource: str,
+            token_info: dict,
+            tenant_id: str = None,
+            subscription_id: str = None):
+        """
+        Queues the token to be written with the next batch.
+        """
+        if TokenCache.get_expires_on(token_info) is None:
+            logger.warning("User: %s - token without an expiry time is not stored.", user_id)
+            return
+        self._pending[TokenCache.make_key(user_id, resource, tenant_id, subscription_id)] = (token_info, time.time())
+
+    def invalidate_user(self, user_id: str):
+        """
+        Queues the deletion of every token of the user, e.g. when the user logs in again.
+        """
+        for key in [key for key in self._pending if key[0] == user_id]:
+            del self._pending[key]
+        self._deleted_users.add(user_id)
+
+    def has_user(self, user_id: str, not_before: float = None):
+        """
+        Returns True if a token of the user is stored and not expired yet, written after not_before if given.
+        """
+        now = time.time()
+        not_before = not_before if not_before is not None else 0
+        for pending, deleted_users in ((self._pending, self._deleted_users),
+                                       (self._flushing_pending, self._flushing_deleted_users)):
+            if any(key[0] == user_id and TokenCache.get_expires_on(token_info) > now and written_at >= not_before
+                   for key, (token_info, written_at) in pending.items()):
+                return True
+            if user_id in deleted_users:
+                return False
+
+        row = self.__get_reader().execute(
+            "SELECT 1 FROM tokens WHERE user_id = ? AND expires_on > ? AND updated_at >= ? LIMIT 1",
+            (user_id, int(now), not_before)).fetchone()
+        return row is not None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.__run_async())
+
+    async def stop(self):
+        """
+        Stops the background task, writes the queued tokens and closes the database.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        await self.flush_async()
+
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    async def flush_async(self):
+        """
+        Writes the queued tokens and deletions in one transaction.
+        """
+        async with self._flush_lock:
+            if not self._pending and not self._deleted_users:
+                return
+
+            self._flushing_pending, self._pending = self._pending, {}
+            self._flushing_deleted_users, self._deleted_users = self._deleted_users, set()
+
+            rows = [self.__to_row(key, *entry) for key, entry in self._flushing_pending.items()]
+            try:
+                await asyncio.to_thread(self.__write, rows, self._flushing_deleted_users)
+            except BaseException:
+                # queue the batch again, behind anything queued since
+                for key, entry in self._flushing_pending.items():
+                    if key[0] not in self._deleted_users:
+                        self._pending.setdefault(key, entry)
+                self._deleted_users |= self._flushing_deleted_users
+                raise
+            finally:
+                self._flushing_pending = {}
+                self._flushing_deleted_users = set()
+            self.written += len(rows)
+
+    async def prune_async(self):
+        """
+        Deletes the expired tokens.
+        """
+        self.pruned += await asyncio.to_thread(self.__prune, int(time.time()))
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "pending": len(self._pending),
+            "written": self.written,
+            "pruned": self.pruned
+        }
+
+    def __read(self, key: tuple):
+        row = self.__get_reader().execute(
+            "SELECT token, updated_at FROM tokens "
+            "WHERE user_id = ? AND resource = ? AND tenant_id = ? AND subscription_id = ?",
+            self.__to_columns(key)).fetchone()
+        if row is None:
+            return None
+
+        try:
+            return json.loads(self._fernet.decrypt(row[0])), row[1]
+        except InvalidToken:
+            # e.g. written with another TOKEN_STORE_KEY
+            logger.warning("User: %s - stored token could not be decrypted, it is ignored.", key[0])
+            return None
+
+    def __write(self, rows: list, deleted_users: set):
+        with self._write_lock:
+            writer = self.__get_writer()
+            with writer:
+                writer.executemany("DELETE FROM tokens WHERE user_id = ?", [(user_id,) for user_id in deleted_users])
+                writer.executemany(
+                    "INSERT OR REPLACE INTO tokens "
+                    "(user_id, resource, tenant_id, subscription_id, expires_on, token_type, updated_at, token) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def __prune(self, now: int):
+        with self._write_lock:
+            writer = self.__get_writer()
+            with writer:
+                return writer.execute("DELETE FROM tokens WHERE expires_on <= ?", (now,)).rowcount
+
+    def __to_row(self, key: tuple, token_info: dict, written_at: float):
+        token = self._fernet.encrypt(json.dumps(token_info).encode('utf-8'))
+        return (*self.__to_columns(key),
+                TokenCache.get_expires_on(token_info),
+                token_info.get('tokenType'),
+                written_at,
+                token)
+
+    @staticmethod
+    def __to_columns(key: tuple):
+        # NULLs are never equal in SQLite, so missing tenants and subscriptions are stored as ''
+        user_id, resource, tenant_id, subscription_id = key
+        return (user_id, resource, tenant_id or '', subscription_id or '')
+
+    def __get_reader(self):
+        if self._reader is None:
+            self._reader = self.__connect()
+        return self._reader
+
+    def __get_writer(self):
+        if self._writer is None:
+            self._writer = self.__connect(check_same_thread=False)
+        return self._writer
+
+    def __connect(self, check_same_thread: bool = True):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=10, check_same_thread=check_same_thread)
+        # readers do not wait for the writer in WAL mode
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        return connection
+
+    async def __run_async(self):
+        last_prune = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush_async()
+                if time.monotonic() - last_prune >= self.prune_interval:
+                    last_prune = time.monotonic()
+                    await self.prune_async()
+            except Exception as e:
+                logger.error("Writing the token store failed: %s", e)
@@ -0,0 +1,24 @@
+"""
+Stand-in for src/az_worker.py that does not need the Azure CLI, used by test_az_worker_pool.py.
+"""
+import json
+import os
+import sys
+
+from src.az_worker import serve
+
+
+def run_stub(args, config_dir=None):
+    if args == ['crash']:
+        os._exit(3)
+
+    if args == ['fail']:
+        print("ERROR: Please run 'az login' to setup account.", file=sys.stderr)
+        return 1
+
+    print(json.dumps({"args": args, "config_dir": config_dir, "pid": os.getpid()}))
+    return 0
+
+
+if __name__ == '__main__':
+    serve(run_stub)
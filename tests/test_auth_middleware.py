@@ -0,0 +1,41 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from src.auth_middleware import AuthMiddleware, parse_auth_tokens
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.add_middleware(AuthMiddleware, secrets=["current_token", "previous_token"])
+
+    @app.get("/healthz")
+    async def health_check():
+        return {"status": "up"}
+
+    return TestClient(app)
+
+
+def test_missing_token_returns_400(client):
+    response = client.get("/healthz")
+    assert response.status_code == 400
+    assert response.json() == {"detail": "X-Auth-Token header is missing"}
+
+
+def test_invalid_token_returns_403(client):
+    response = client.get("/healthz", headers={"X-Auth-Token": "wrong_token"})
+    assert response.status_code == 403
+    assert response.json() == {"detail": "Invalid X-Auth-Token header"}
+
+
+@pytest.mark.parametrize("token", ["current_token", "previous_token"])
+def test_any_configured_token_is_accepted(client, token):
+    response = client.get("/healthz", headers={"X-Auth-Token": token})
+    assert response.status_code == 200
+    assert response.json() == {"status": "up"}
+
+
+def test_parse_auth_tokens():
+    assert parse_auth_tokens(" token1, token2 ,,") == ["token1", "token2"]
+    assert parse_auth_tokens(None) == []
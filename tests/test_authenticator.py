@@ -1,7 +1,10 @@
+import asyncio
 import os
 import sys
+import time
+import shutil
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, AsyncMock, MagicMock
 
 # Add the directory containing authenticator.py to the Python path
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
@@ -29,22 +32,76 @@ def test_get_temp_dir(authenticator):
         assert user_id in temp_dir
         mock_makedirs.assert_called_once()
 
-def test_get_device_code(authenticator):
+FAKE_AZ = """#!/bin/sh
+case "$1" in
+    logout) exit 0 ;;
+    login)
+        sleep 0.2
+        echo "To sign in, use a web browser to open the page https://microsoft.com/devicelogin and enter the code ABC123 to authenticate." >&2
+        sleep 0.5
+        echo "[]"
+        ;;
+    account)
+        echo '{"accessToken": "fake_token", "expiresOn": "2100-01-01 00:00:00.000000", "expires_on": 4102444800, "subscription": "fake_subscription", "tenant": "fake_tenant", "tokenType": "Bearer"}'
+        ;;
+esac
+"""
+
+
+@pytest.fixture
+def fake_az(tmp_path):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    az = bin_dir / "az"
+    az.write_text(FAKE_AZ)
+    az.chmod(0o755)
+    path = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+    with patch.dict(os.environ, {"PATH": path}), \
+         patch('os.path.expanduser', return_value=str(tmp_path)):
+        yield az
+
+
+def test_get_device_code(authenticator, fake_az):
     user_id = "test_user"
-    with patch('pexpect.spawn') as mock_spawn, \
-         patch('re.search') as mock_search, \
-         patch('os.makedirs'), \
-         patch('subprocess.run') as mock_run:
-        mock_run.return_value.returncode = 0
-        mock_child = MagicMock()
-        mock_child.expect.return_value = 0
-        mock_child.after.decode.return_value = "enter the code ABC123 to authenticate"
-        mock_spawn.return_value = mock_child
-        mock_search.return_value.group.return_value = "ABC123"
-        
-        url, device_code = authenticator.get_device_code(user_id)
-        assert url == 'https://microsoft.com/devicelogin'
-        assert device_code == "ABC123"
+
+    async def get_device_code_and_measure_loop():
+        max_gap = 0
+        task = asyncio.create_task(authenticator.get_device_code_async(user_id))
+        while not task.done():
+            start = time.monotonic()
+            await asyncio.sleep(0.01)
+            max_gap = max(max_gap, time.monotonic() - start)
+        result = await task
+        await authenticator.sessions.get(user_id).login_task
+        return result, max_gap
+
+    (url, device_code), max_gap = asyncio.run(get_device_code_and_measure_loop())
+    assert url == 'https://microsoft.com/devicelogin'
+    assert device_code == "ABC123"
+    # the event loop kept running while az was starting
+    assert max_gap < 0.15
+    # the login process is gone once the login completed
+    assert authenticator.sessions.pending_count() == 0
+
+def test_authenticate_async_returns_when_login_completes(authenticator, fake_az):
+    user_id = "test_user"
+
+    async def login_and_authenticate():
+        await authenticator.get_device_code_async(user_id)
+        assert (await authenticator.wait_for_login_async(user_id))['status'] == 'pending'
+        assert await authenticator.check_az_login_async(user_id)
+
+        start = time.monotonic()
+        token_info = await authenticator.authenticate_async(user_id, "test_resource")
+        return token_info, time.monotonic() - start
+
+    token_info, elapsed = asyncio.run(login_and_authenticate())
+    assert token_info['accessToken'] == "fake_token"
+    assert elapsed < 5
+    login = asyncio.run(authenticator.wait_for_login_async(user_id))
+    assert login['status'] == 'succeeded'
+    assert login['completed_at'] >= login['started_at']
+
 
 def test_get_token(authenticator):
     user_id = "test_user"
@@ -79,3 +136,165 @@ def test_get_token_thread_safe(authenticator):
     authenticator.users_data[user_id] = {'token': "test_token"}
     token = authenticator.get_token_thread_safe(user_id)
     assert token == "test_token"
+
+def test_authenticate_async_serves_cached_token(authenticator):
+    user_id = "test_user"
+    resource = "test_resource"
+    token = {"accessToken": "test_token", "expires_on": int(time.time()) + 3600}
+    authenticator.token_cache.put(user_id, resource, token)
+    with patch('asyncio.create_subprocess_exec') as mock_exec:
+        token_info = asyncio.run(authenticator.authenticate_async(user_id, resource))
+        assert token_info['accessToken'] == "test_token"
+        mock_exec.assert_not_called()
+
+def test_authenticate_async_serves_stored_token_after_restart(tmp_path):
+    from cryptography.fernet import Fernet
+    from src.token_store import TokenStore
+
+    user_id = "test_user"
+    resource = "test_resource"
+    store = TokenStore(str(tmp_path / "tokens.sqlite3"), Fernet.generate_key())
+    store.put(user_id, resource, {"accessToken": "stored_token", "expires_on": int(time.time()) + 3600})
+
+    authenticator = AzureAuthenticator(token_store=store)
+    with patch('asyncio.create_subprocess_exec') as mock_exec:
+        assert asyncio.run(authenticator.check_az_login_async(user_id))
+        token_info = asyncio.run(authenticator.authenticate_async(user_id, resource))
+        assert token_info['accessToken'] == "stored_token"
+        assert authenticator.token_cache.get(user_id, resource) is not None
+        mock_exec.assert_not_called()
+
+def test_authenticate_async_reads_msal_token_cache(authenticator, tmp_path):
+    user_id = "test_user"
+    fixture_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fixtures", "azure_config_dir")
+    shutil.copytree(fixture_dir, tmp_path / ".temp" / user_id)
+    with patch('os.path.expanduser', return_value=str(tmp_path)), \
+         patch('asyncio.create_subprocess_exec') as mock_exec:
+        assert asyncio.run(authenticator.check_az_login_async(user_id))
+        token_info = asyncio.run(authenticator.authenticate_async(user_id, "https://graph.microsoft.com"))
+        assert token_info['accessToken'] == "graph_token"
+        mock_exec.assert_not_called()
+
+def test_set_env_writes_config_once(authenticator, tmp_path):
+    user_id = "test_user"
+    with patch('os.path.expanduser', return_value=str(tmp_path)), \
+         patch('asyncio.create_subprocess_exec') as mock_exec:
+        env = authenticator._AzureAuthenticator__set_env(user_id)
+        config_path = os.path.join(env['AZURE_CONFIG_DIR'], 'config')
+        with open(config_path) as config_file:
+            config = config_file.read()
+        assert "login_experience_v2 = off" in config
+        assert "only_show_errors = yes" in config
+
+        assert authenticator._AzureAuthenticator__set_env(user_id) is env
+        mock_exec.assert_not_called()
+
+def test_set_env_rewrites_config_of_a_directory_evicted_by_another_worker(authenticator, tmp_path):
+    user_id = "test_user"
+    with patch('os.path.expanduser', return_value=str(tmp_path)):
+        env = authenticator._AzureAuthenticator__set_env(user_id)
+        shutil.rmtree(env['AZURE_CONFIG_DIR'])
+
+        env = authenticator._AzureAuthenticator__set_env(user_id)
+        with open(os.path.join(env['AZURE_CONFIG_DIR'], 'config')) as config_file:
+            assert "login_experience_v2 = off" in config_file.read()
+
+def test_authenticate_async_fails_fast_on_permanent_errors():
+    from src.az_errors import AzCommandError, RetryPolicy
+
+    authenticator = AzureAuthenticator(retry_policy=RetryPolicy(initial_delay=0.01, max_delay=0.02))
+    get_token = AsyncMock(side_effect=AzCommandError("AADSTS90002: Tenant not found", "permanent"))
+    with patch.object(authenticator, '_AzureAuthenticator__get_token_async', new=get_token):
+        with pytest.raises(AzCommandError) as e:
+            asyncio.run(authenticator.authenticate_async("test_user", "test_resource", tenant_id="unknown"))
+    assert e.value.error_class == "permanent"
+    assert get_token.await_count == 1
+
+def test_authenticate_async_retries_transient_errors_until_success():
+    from src.az_errors import AzCommandError, RetryPolicy
+
+    authenticator = AzureAuthenticator(retry_policy=RetryPolicy(initial_delay=0.01, max_delay=0.02))
+    token = {"accessToken": "test_token", "expires_on": int(time.time()) + 3600}
+    get_token = AsyncMock(side_effect=[AzCommandError("(429) Too Many Requests", "transient"), Exception("blip"), token])
+    with patch.object(authenticator, '_AzureAuthenticator__get_token_async', new=get_token):
+        assert asyncio.run(authenticator.authenticate_async("test_user", "test_resource")) == token
+    assert get_token.await_count == 3
+
+def test_authenticate_async_stops_retrying_at_the_deadline():
+    from src.az_errors import AzCommandError, RetryPolicy
+
+    authenticator = AzureAuthenticator(retry_policy=RetryPolicy(initial_delay=0.05, max_delay=0.05))
+    get_token = AsyncMock(side_effect=AzCommandError("(429) Too Many Requests", "transient"))
+    with patch.object(authenticator, '_AzureAuthenticator__get_token_async', new=get_token):
+        start = time.monotonic()
+        with pytest.raises(AzCommandError) as e:
+            asyncio.run(authenticator.authenticate_async("test_user", "test_resource", timeout=0.3))
+    assert e.value.error_class == "transient"
+    assert time.monotonic() - start < 1
+    assert get_token.await_count > 1
+
+def test_evicted_config_dir_forgets_the_user(tmp_path):
+    from src.config_dirs import ConfigDirManager
+
+    authenticator = AzureAuthenticator(config_dirs=ConfigDirManager(str(tmp_path), idle_ttl=3600))
+    user_id = "test_user"
+    env = authenticator._AzureAuthenticator__set_env(user_id)
+    authenticator.token_cache.put(user_id, "test_resource", {"accessToken": "test_token", "expires_on": int(time.time()) + 3600})
+    old = time.time() - 7200
+    os.utime(env['AZURE_CONFIG_DIR'], (old, old))
+
+    asyncio.run(authenticator.config_dirs.collect_async())
+    assert not os.path.exists(env['AZURE_CONFIG_DIR'])
+    assert user_id not in authenticator.envs
+    assert authenticator.token_cache.get(user_id, "test_resource") is None
+
+def test_tokens_cached_before_a_login_on_another_worker_are_not_served():
+    from src.device_code_sessions import DeviceCodeSessionRegistry
+    from src.login_state import MemoryLoginStateBackend
+
+    user_id = "test_user"
+    resource = "test_resource"
+    backend = MemoryLoginStateBackend()
+    authenticator = AzureAuthenticator(sessions=DeviceCodeSessionRegistry(backend=backend))
+    authenticator.token_cache.put(user_id, resource, {"accessToken": "old_token", "expires_on": int(time.time()) + 3600})
+
+    # another worker sharing the login state logged the user in again
+    started_at = time.time() + 1
+    backend.put(user_id, {'session_id': 'other', 'owner': 'other', 'status': 'succeeded',
+                          'started_at': started_at, 'completed_at': started_at})
+
+    get_token = AsyncMock(return_value={"accessToken": "new_token", "expires_on": int(time.time()) + 3600})
+    with patch.object(authenticator, '_AzureAuthenticator__get_token_async', new=get_token):
+        assert asyncio.run(authenticator.authenticate_async(user_id, resource))['accessToken'] == "new_token"
+    get_token.assert_awaited_once()
+
+    # and that login failed, the old token does not prove the user is logged in
+    backend.put(user_id, {'session_id': 'other', 'owner': 'other', 'status': 'failed',
+                          'started_at': time.time() + 1, 'completed_at': None})
+    result = MagicMock(stderr="ERROR: Please run 'az login' to setup account.")
+    with patch.object(authenticator.msal_reader, 'has_account', return_value=False), \
+         patch.object(authenticator, '_AzureAuthenticator__run_az_async', new=AsyncMock(return_value=result)):
+        assert not asyncio.run(authenticator.check_az_login_async(user_id))
+
+def test_tokens_cached_before_a_forgotten_login_are_not_served():
+    from src.device_code_sessions import DeviceCodeSessionRegistry
+    from src.login_state import MemoryLoginStateBackend
+
+    user_id = "test_user"
+    resource = "test_resource"
+    backend = MemoryLoginStateBackend()
+    authenticator = AzureAuthenticator(sessions=DeviceCodeSessionRegistry(backend=backend))
+    authenticator.token_cache.put(user_id, resource, {"accessToken": "old_token", "expires_on": int(time.time()) + 3600})
+
+    # another worker logged the user in again, and the reaper forgot that login
+    started_at = time.time() + 1
+    backend.put(user_id, {'session_id': 'other', 'owner': 'other', 'status': 'succeeded',
+                          'started_at': started_at, 'completed_at': started_at})
+    asyncio.run(authenticator.sessions.reap_async())
+    authenticator.sessions._DeviceCodeSessionRegistry__reap_states(started_at + authenticator.sessions.ttl + 1)
+    assert authenticator.sessions.get_state(user_id) is None
+
+    get_token = AsyncMock(return_value={"accessToken": "new_token", "expires_on": int(time.time()) + 3600})
+    with patch.object(authenticator, '_AzureAuthenticator__get_token_async', new=get_token):
+        assert asyncio.run(authenticator.authenticate_async(user_id, resource))['accessToken'] == "new_token"
+    get_token.assert_awaited_once()
@@ -0,0 +1,29 @@
+from src.az_errors import RetryPolicy, classify_az_error
+
+
+def test_classify_az_error():
+    assert classify_az_error("ERROR: AADSTS90002: Tenant 'unknown' not found. "
+                             "To re-authenticate, please run:\naz login --tenant unknown") == 'permanent'
+    assert classify_az_error("ERROR: AADSTS500011: The resource principal named https://bad was not found") == 'permanent'
+    assert classify_az_error("ERROR: Subscription '00000000' not found. Check the spelling and casing and try again.") == 'permanent'
+    assert classify_az_error("ERROR: Please run 'az login' to setup account.") == 'login_required'
+    assert classify_az_error("ERROR: AADSTS700082: The refresh token has expired due to inactivity.") == 'login_required'
+    assert classify_az_error("ERROR: (429) Too Many Requests") == 'transient'
+    assert classify_az_error("ERROR: HTTPSConnectionPool(host='login.microsoftonline.com', port=443): "
+                             "Max retries exceeded with url") == 'transient'
+    assert classify_az_error("ERROR: something else") == 'unknown'
+    assert classify_az_error(None) == 'unknown'
+
+
+def test_retry_policy_backs_off_exponentially_with_jitter():
+    policy = RetryPolicy(initial_delay=1, max_delay=5, multiplier=2)
+
+    for attempt, limit in enumerate([1, 2, 4, 5, 5]):
+        delays = [policy.get_delay(attempt) for _ in range(100)]
+        assert all(0 <= delay <= limit for delay in delays)
+        assert len(set(delays)) > 1
+
+    assert RetryPolicy.is_retryable('transient')
+    assert RetryPolicy.is_retryable('unknown')
+    assert not RetryPolicy.is_retryable('permanent')
+    assert not RetryPolicy.is_retryable('login_required')
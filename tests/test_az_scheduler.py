@@ -0,0 +1,86 @@
+import asyncio
+import pytest
+
+from src.az_scheduler import AzProcessScheduler, SchedulerBusyError
+
+
+def test_slot_limits_global_and_per_user_concurrency():
+    scheduler = AzProcessScheduler(max_concurrency=3, per_user_concurrency=2)
+    running = {"total": 0, "max": 0, "user1": 0, "user1_max": 0}
+
+    async def run(user_id):
+        async with scheduler.slot(user_id):
+            running["total"] += 1
+            running["max"] = max(running["max"], running["total"])
+            if user_id == "user1":
+                running["user1"] += 1
+                running["user1_max"] = max(running["user1_max"], running["user1"])
+            await asyncio.sleep(0.01)
+            running["total"] -= 1
+            if user_id == "user1":
+                running["user1"] -= 1
+
+    async def main():
+        await asyncio.gather(*(run("user1") for _ in range(6)), *(run("user2") for _ in range(6)))
+
+    asyncio.run(main())
+    assert running["max"] == 3
+    assert running["user1_max"] == 2
+    assert scheduler.running == 0
+    assert scheduler.queue_depth == 0
+
+
+def test_waiting_users_are_served_round_robin():
+    scheduler = AzProcessScheduler(max_concurrency=1, per_user_concurrency=1)
+    order = []
+
+    async def run(user_id):
+        async with scheduler.slot(user_id):
+            order.append(user_id)
+            await asyncio.sleep(0)
+
+    async def main():
+        await scheduler.acquire("blocker")
+        tasks = [asyncio.create_task(run(user_id)) for user_id in ["user1", "user1", "user1", "user2", "user3"]]
+        await asyncio.sleep(0)
+        scheduler.release("blocker")
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    assert order == ["user1", "user2", "user3", "user1", "user1"]
+
+
+def test_acquire_rejects_when_queue_is_full():
+    scheduler = AzProcessScheduler(max_concurrency=1, max_queue_depth=1, retry_after=7)
+
+    async def main():
+        await scheduler.acquire("user1")
+        waiter = asyncio.create_task(scheduler.acquire("user2"))
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerBusyError) as e:
+            await scheduler.acquire("user3")
+        scheduler.release("user1")
+        await waiter
+        scheduler.release("user2")
+        return e.value
+
+    error = asyncio.run(main())
+    assert error.retry_after == 7
+    assert scheduler.rejected == 1
+    assert scheduler.running == 0
+
+
+def test_acquire_rejects_after_max_wait():
+    scheduler = AzProcessScheduler(max_concurrency=1, max_wait_seconds=0.01)
+
+    async def main():
+        await scheduler.acquire("user1")
+        with pytest.raises(SchedulerBusyError):
+            await scheduler.acquire("user2")
+        scheduler.release("user1")
+
+    asyncio.run(main())
+    assert scheduler.queue_depth == 0
+    assert scheduler.running == 0
+    assert scheduler.stats()["max_wait_seconds"] >= 0.01
+
@@ -0,0 +1,73 @@
+import asyncio
+import json
+import sys
+import pytest
+
+from src.az_worker_pool import AzWorkerPool, WorkerCrashedError
+
+
+def make_pool(**kwargs):
+    return AzWorkerPool(worker_module='tests.stub_az_worker', python=sys.executable, **kwargs)
+
+
+def test_run_returns_completed_process():
+    pool = make_pool()
+
+    async def main():
+        try:
+            return await pool.run(['account', 'list'], '/tmp/test_user')
+        finally:
+            await pool.close()
+
+    result = asyncio.run(main())
+    assert result.returncode == 0
+    output = json.loads(result.stdout)
+    assert output["args"] == ['account', 'list']
+    assert output["config_dir"] == '/tmp/test_user'
+
+
+def test_run_reports_command_failure():
+    pool = make_pool()
+
+    async def main():
+        try:
+            return await pool.run(['fail'])
+        finally:
+            await pool.close()
+
+    result = asyncio.run(main())
+    assert result.returncode == 1
+    assert "az login" in result.stderr
+
+
+def test_workers_are_reused_and_recycled():
+    pool = make_pool(size=1, max_jobs_per_worker=2)
+
+    async def main():
+        try:
+            return [json.loads((await pool.run(['version'])).stdout)["pid"] for _ in range(3)]
+        finally:
+            await pool.close()
+
+    pids = asyncio.run(main())
+    assert pids[0] == pids[1]
+    assert pids[2] != pids[1]
+    assert pool.started == 2
+    assert pool.recycled == 1
+
+
+def test_crashed_worker_is_replaced():
+    pool = make_pool(size=1)
+
+    async def main():
+        try:
+            with pytest.raises(WorkerCrashedError):
+                await pool.run(['crash'])
+            return await pool.run(['version'])
+        finally:
+            await pool.close()
+
+    result = asyncio.run(main())
+    assert result.returncode == 0
+    assert pool.crashed == 1
+    assert pool.started == 2
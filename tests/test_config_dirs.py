@@ -0,0 +1,76 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from src.config_dirs import ConfigDirManager, InvalidUserIdError, normalize_user_id
+
+
+def make_dir(manager, user_id: str, size: int = 0, age: float = 0):
+    config_dir = manager.get_dir(user_id)
+    with open(os.path.join(config_dir, 'azureProfile.json'), 'wb') as f:
+        f.write(b'x' * size)
+    used_at = time.time() - age
+    os.utime(config_dir, (used_at, used_at))
+    return config_dir
+
+
+def test_normalize_user_id():
+    assert normalize_user_id(" user@contoso.com ") == "user@contoso.com"
+    assert normalize_user_id("00000000-0000-0000-0000-000000000000") == "00000000-0000-0000-0000-000000000000"
+    for user_id in ("", "..", ".hidden", "../escape", "a/b", "a b", "x" * 129, None):
+        with pytest.raises(InvalidUserIdError):
+            normalize_user_id(user_id)
+
+
+def test_collect_evicts_idle_directories(tmp_path):
+    manager = ConfigDirManager(str(tmp_path), idle_ttl=3600)
+    evicted = []
+    manager.on_evict.append(lambda user_id, config_dir: evicted.append(user_id))
+
+    make_dir(manager, "idle_user", age=7200)
+    make_dir(manager, "active_user", age=60)
+    os.makedirs(tmp_path / ".login_state")
+
+    asyncio.run(manager.collect_async())
+    assert evicted == ["idle_user"]
+    assert sorted(os.listdir(tmp_path)) == [".login_state", "active_user"]
+    assert manager.stats()["count"] == 1
+    assert manager.evicted == 1
+
+
+def test_collect_keeps_directories_in_use(tmp_path):
+    manager = ConfigDirManager(str(tmp_path), idle_ttl=3600)
+    manager.is_in_use = lambda user_id: user_id == "pending_user"
+    make_dir(manager, "pending_user", age=7200)
+
+    asyncio.run(manager.collect_async())
+    assert os.listdir(tmp_path) == ["pending_user"]
+
+
+def test_collect_evicts_least_recently_used_over_quota(tmp_path):
+    manager = ConfigDirManager(str(tmp_path), idle_ttl=0, max_total_size=2500)
+    make_dir(manager, "oldest_user", size=1000, age=3 * 3600)
+    make_dir(manager, "older_user", size=1000, age=2 * 3600)
+    make_dir(manager, "recent_user", size=1000, age=3600)
+
+    asyncio.run(manager.collect_async())
+    assert sorted(os.listdir(tmp_path)) == ["older_user", "recent_user"]
+    assert manager.stats()["total_size_bytes"] == 2000
+
+
+def test_collect_trims_old_az_logs_and_telemetry(tmp_path):
+    manager = ConfigDirManager(str(tmp_path), trim_age=3600)
+    config_dir = make_dir(manager, "test_user")
+    for name in ("old.log", "new.log"):
+        os.makedirs(os.path.join(config_dir, "commands"), exist_ok=True)
+        with open(os.path.join(config_dir, "commands", name), 'w') as f:
+            f.write("log")
+    old = time.time() - 7200
+    os.utime(os.path.join(config_dir, "commands", "old.log"), (old, old))
+
+    asyncio.run(manager.collect_async())
+    assert os.listdir(os.path.join(config_dir, "commands")) == ["new.log"]
+    assert manager.trimmed_files == 1
+    assert os.path.exists(os.path.join(config_dir, "azureProfile.json"))
@@ -0,0 +1,159 @@
+import asyncio
+import os
+import time
+import pytest
+
+from src.device_code_sessions import DeviceCodeSessionRegistry, SessionLimitError
+from src.login_state import FileLoginStateBackend
+
+
+async def start_session_with_child(registry, user_id):
+    session = await registry.start_session_async(user_id)
+    session.child = await asyncio.create_subprocess_exec('sleep', '30')
+    return session
+
+
+def test_start_session_cancels_previous_session():
+    registry = DeviceCodeSessionRegistry()
+
+    async def main():
+        first = await start_session_with_child(registry, "test_user")
+        second = await start_session_with_child(registry, "test_user")
+        try:
+            return first, second, registry.get("test_user")
+        finally:
+            await registry.stop()
+
+    first, second, current = asyncio.run(main())
+    assert current is second
+    assert first.status == 'failed'
+    assert first.child.returncode is not None
+
+
+def test_start_session_enforces_max_pending():
+    registry = DeviceCodeSessionRegistry(max_pending=1, retry_after=10)
+
+    async def main():
+        await registry.start_session_async("user1")
+        try:
+            with pytest.raises(SessionLimitError) as e:
+                await registry.start_session_async("user2")
+            return e.value
+        finally:
+            await registry.stop()
+
+    assert asyncio.run(main()).retry_after == 10
+
+
+def test_reap_kills_expired_pending_sessions():
+    registry = DeviceCodeSessionRegistry(ttl=60)
+
+    async def main():
+        expired = await start_session_with_child(registry, "user1")
+        expired.started_at -= 120
+        await start_session_with_child(registry, "user2")
+        await registry.reap_async()
+        try:
+            return expired, registry.pending_count()
+        finally:
+            await registry.stop()
+
+    expired, pending_count = asyncio.run(main())
+    assert pending_count == 1
+    assert expired.status == 'failed'
+    assert expired.child.returncode is not None
+    assert registry.expired == 1
+
+
+def test_reap_forgets_old_completed_sessions():
+    registry = DeviceCodeSessionRegistry(ttl=60)
+
+    async def main():
+        session = await registry.start_session_async("test_user")
+        session.complete('succeeded')
+        session.completed_at -= 120
+        await registry.reap_async()
+
+    asyncio.run(main())
+    assert registry.get("test_user") is None
+    assert registry.pending_count() == 0
+
+
+def test_workers_sharing_a_backend_see_each_others_logins(tmp_path):
+    owner = DeviceCodeSessionRegistry(backend=FileLoginStateBackend(str(tmp_path)), owner="worker1")
+    other = DeviceCodeSessionRegistry(backend=FileLoginStateBackend(str(tmp_path)), owner="worker2")
+
+    async def main():
+        session = await owner.start_session_async("test_user")
+        assert other.get("test_user") is None
+        assert other.get_state("test_user")["status"] == 'pending'
+        assert other.get_state("test_user")["owner"] == "worker1"
+
+        asyncio.get_running_loop().call_later(0.1, session.complete, 'succeeded')
+        return await other.wait_async("test_user", timeout=5)
+
+    state = asyncio.run(main())
+    assert state["status"] == 'succeeded'
+    assert state["completed_at"] is not None
+
+
+def test_login_started_on_another_worker_replaces_the_previous_one(tmp_path):
+    first = DeviceCodeSessionRegistry(backend=FileLoginStateBackend(str(tmp_path)), owner="worker1")
+    second = DeviceCodeSessionRegistry(backend=FileLoginStateBackend(str(tmp_path)), owner="worker2")
+
+    async def main():
+        replaced = await start_session_with_child(first, "test_user")
+        current = await second.start_session_async("test_user")
+        await first.reap_async()
+        try:
+            return replaced, current
+        finally:
+            await first.stop()
+
+    replaced, current = asyncio.run(main())
+    assert replaced.child.returncode is not None
+    assert first.get("test_user") is None
+    # the replaced login does not overwrite the state of the new one
+    state = second.get_state("test_user")
+    assert state["session_id"] == current.session_id
+    assert state["status"] == 'pending'
+
+
+def test_reap_remembers_when_forgotten_logins_started():
+    registry = DeviceCodeSessionRegistry(ttl=60, login_history_ttl=3600)
+    now = time.time()
+    registry.backend.put("test_user", {"session_id": "done", "owner": "worker0", "status": 'succeeded',
+                                       "started_at": now - 120, "completed_at": now - 90})
+
+    asyncio.run(registry.reap_async())
+    assert registry.get_state("test_user") is None
+    assert registry.get_login_started_at("test_user") == now - 120
+
+    registry._DeviceCodeSessionRegistry__reap_states(now + 3600)
+    assert registry.get_login_started_at("test_user") is None
+
+
+def test_reap_fails_logins_of_workers_that_are_gone():
+    registry = DeviceCodeSessionRegistry(ttl=60, reap_interval=30)
+    registry.backend.put("test_user", {"session_id": "gone", "owner": "worker0", "status": 'pending',
+                                       "started_at": time.time() - 120, "completed_at": None})
+
+    asyncio.run(registry.reap_async())
+    assert registry.get_state("test_user")["status"] == 'failed'
+
+
+def test_reap_only_rewrites_states_that_change(tmp_path):
+    registry = DeviceCodeSessionRegistry(ttl=60, reap_interval=30, backend=FileLoginStateBackend(str(tmp_path)))
+    now = time.time()
+    for index in range(20):
+        registry.backend.put(f"user{index}", {"session_id": f"session{index}", "owner": "worker0", "status": 'succeeded',
+                                             "started_at": now - 10, "completed_at": now - 5})
+    registry.backend.put("stale_user", {"session_id": "gone", "owner": "worker0", "status": 'pending',
+                                        "started_at": now - 120, "completed_at": None})
+    inodes = {name: os.stat(tmp_path / name).st_ino for name in os.listdir(tmp_path) if name.endswith('.json')}
+
+    asyncio.run(registry.reap_async())
+
+    changed = [name for name, inode in inodes.items() if os.stat(tmp_path / name).st_ino != inode]
+    assert changed == ["stale_user.json"]
+    assert registry.get_state("stale_user")["status"] == 'failed'
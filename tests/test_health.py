@@ -0,0 +1,93 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock, MagicMock
+
+from src.az_errors import RetryPolicy
+from src.az_scheduler import AzProcessScheduler, SchedulerBusyError
+from src.health import HealthMonitor
+
+
+def make_authenticator(version=None, error=None):
+    authenticator = MagicMock()
+    authenticator.scheduler = AzProcessScheduler(max_concurrency=1)
+    authenticator.worker_pool = None
+    authenticator.get_version_async = AsyncMock(return_value=version, side_effect=error)
+    return authenticator
+
+
+def test_start_captures_version_once():
+    authenticator = make_authenticator(version={"azure-cli": "2.99.0"})
+    monitor = HealthMonitor(authenticator)
+
+    async def main():
+        await monitor.start()
+        return await monitor.get_version_async()
+
+    assert asyncio.run(main()) == {"azure-cli": "2.99.0"}
+    assert authenticator.get_version_async.await_count == 1
+    assert monitor.readiness()[0]
+
+
+def test_ready_once_version_is_captured_after_a_failure():
+    authenticator = make_authenticator()
+    authenticator.get_version_async.side_effect = [Exception("az not found"), {"azure-cli": "2.99.0"}]
+    monitor = HealthMonitor(authenticator, version_retry_policy=RetryPolicy(initial_delay=0.01, max_delay=0.01))
+
+    async def main():
+        await monitor.start()
+        ready, details = monitor.readiness()
+        assert not ready
+        assert details["reasons"] == ["Azure CLI version is unknown"]
+
+        # retried in the background, deep checks are disabled
+        await asyncio.wait_for(monitor._version_task, timeout=1)
+        await monitor.stop()
+
+    asyncio.run(main())
+    assert monitor.readiness()[0]
+    assert authenticator.get_version_async.await_count == 2
+
+
+def test_start_does_not_wait_for_a_hung_az():
+    authenticator = make_authenticator()
+
+    async def hang():
+        await asyncio.sleep(60)
+
+    authenticator.get_version_async = hang
+    monitor = HealthMonitor(authenticator, deep_check_timeout=0.05)
+
+    async def main():
+        start = time.monotonic()
+        await monitor.start()
+        elapsed = time.monotonic() - start
+        await monitor.stop()
+        return elapsed
+
+    assert asyncio.run(main()) < 1
+    assert not monitor.readiness()[0]
+
+
+def test_not_ready_when_queue_is_deep():
+    authenticator = make_authenticator()
+    monitor = HealthMonitor(authenticator, max_queue_depth=2)
+    monitor.version = {"azure-cli": "2.99.0"}
+
+    authenticator.scheduler.queue_depth = 2
+    ready, details = monitor.readiness()
+    assert not ready
+    assert details["status"] == "not ready"
+
+
+def test_deep_check_records_failures_but_not_saturation():
+    authenticator = make_authenticator(error=SchedulerBusyError("busy", retry_after=5))
+    monitor = HealthMonitor(authenticator)
+    monitor.version = {"azure-cli": "2.99.0"}
+
+    asyncio.run(monitor.deep_check_async())
+    assert monitor.last_deep_check is None
+
+    authenticator.get_version_async.side_effect = Exception("az version failed")
+    asyncio.run(monitor.deep_check_async())
+    assert not monitor.last_deep_check["ok"]
+    assert not monitor.readiness()[0]
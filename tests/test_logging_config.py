@@ -0,0 +1,88 @@
+import asyncio
+import json
+import logging
+import time
+
+from src.logging_config import CorrelationIdMiddleware, JsonFormatter, RateLimitFilter, _QueueHandler, correlation_id
+
+
+def make_record(msg, *args, level=logging.INFO, name='src.test'):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+
+def test_json_formatter_writes_message_correlation_id_and_extra():
+    record = make_record("User: %s - temp directory: %s", 'test_user', '/tmp/test_user')
+    record.correlation_id = 'abc'
+    record.suppressed = 3
+
+    entry = json.loads(JsonFormatter().format(record))
+
+    assert entry['message'] == "User: test_user - temp directory: /tmp/test_user"
+    assert entry['level'] == 'INFO'
+    assert entry['logger'] == 'src.test'
+    assert entry['correlation_id'] == 'abc'
+    assert entry['suppressed'] == 3
+
+
+def test_rate_limit_filter_limits_every_template_separately():
+    rate_limit = RateLimitFilter(rate=0.001, burst=2)
+
+    allowed = [rate_limit.filter(make_record("Checking if user: %s", i)) for i in range(5)]
+    other = rate_limit.filter(make_record("User: %s - temp directory", 1))
+
+    assert allowed == [True, True, False, False, False]
+    assert other
+
+
+def test_rate_limit_filter_counts_suppressed_records():
+    rate_limit = RateLimitFilter(rate=50, burst=1)
+
+    assert rate_limit.filter(make_record("Checking if user: %s", 1))
+    assert not rate_limit.filter(make_record("Checking if user: %s", 2))
+
+    # refills after 20 milliseconds
+    time.sleep(0.05)
+    record = make_record("Checking if user: %s", 3)
+    assert rate_limit.filter(record)
+    assert record.suppressed == 1
+
+
+def test_rate_limit_filter_never_drops_warnings():
+    rate_limit = RateLimitFilter(rate=0.001, burst=1)
+
+    assert all(rate_limit.filter(make_record("az failed", level=logging.WARNING)) for _ in range(5))
+
+
+def test_queue_handler_captures_correlation_id_without_formatting():
+    handler = _QueueHandler(None)
+    record = make_record("User: %s", 'test_user')
+
+    token = correlation_id.set('abc')
+    try:
+        prepared = handler.prepare(record)
+    finally:
+        correlation_id.reset(token)
+
+    assert prepared.correlation_id == 'abc'
+    assert prepared.args == ('test_user',)
+
+
+def test_middleware_sets_and_echoes_the_request_id():
+    seen = []
+    sent = []
+
+    async def app(scope, receive, send):
+        seen.append(correlation_id.get())
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+
+    async def send(message):
+        sent.append(message)
+
+    middleware = CorrelationIdMiddleware(app)
+    asyncio.run(middleware({'type': 'http', 'headers': [(b'x-request-id', b'req-1')]}, None, send))
+    asyncio.run(middleware({'type': 'http', 'headers': []}, None, send))
+
+    assert seen[0] == 'req-1'
+    assert (b'x-request-id', b'req-1') in sent[0]['headers']
+    assert len(seen[1]) == 32
+    assert correlation_id.get() is None
@@ -0,0 +1,56 @@
+import os
+
+from src.login_state import FileLoginStateBackend, MemoryLoginStateBackend
+
+
+def make_state(session_id: str, status: str = 'pending'):
+    return {"session_id": session_id, "owner": "worker1", "status": status, "started_at": 1.0, "completed_at": None}
+
+
+def test_file_backend_is_shared_between_instances(tmp_path):
+    FileLoginStateBackend(str(tmp_path)).put("test_user", make_state("session1"))
+
+    backend = FileLoginStateBackend(str(tmp_path))
+    assert backend.get("test_user") == make_state("session1")
+    assert backend.user_ids() == ["test_user"]
+    assert backend.get("other_user") is None
+
+
+def test_complete_and_delete_only_apply_to_the_current_session(tmp_path):
+    for backend in (MemoryLoginStateBackend(), FileLoginStateBackend(str(tmp_path))):
+        backend.put("test_user", make_state("session2"))
+
+        backend.complete("test_user", "session1", 'succeeded', 2.0)
+        assert backend.get("test_user")["status"] == 'pending'
+        backend.delete("test_user", "session1")
+        assert backend.get("test_user") is not None
+
+        backend.complete("test_user", "session2", 'succeeded', 2.0)
+        assert backend.get("test_user")["status"] == 'succeeded'
+        assert backend.get("test_user")["completed_at"] == 2.0
+        backend.delete("test_user", "session2")
+        assert backend.get("test_user") is None
+
+
+def test_file_backend_keeps_user_ids_inside_its_directory(tmp_path):
+    backend = FileLoginStateBackend(str(tmp_path / "state"))
+    for user_id in ("../escape", ".lock", "user/with/slashes"):
+        backend.put(user_id, make_state(user_id))
+        assert backend.get(user_id)["session_id"] == user_id
+
+    assert sorted(backend.user_ids()) == sorted(["../escape", ".lock", "user/with/slashes"])
+    assert os.listdir(tmp_path) == ["state"]
+
+
+def test_file_backend_does_not_rewrite_unchanged_states(tmp_path):
+    backend = FileLoginStateBackend(str(tmp_path))
+    backend.put("test_user", make_state("session1"))
+    inode = os.stat(tmp_path / "test_user.json").st_ino
+
+    backend.update("test_user", lambda state: state)
+    backend.complete("test_user", "other_session", 'succeeded', 2.0)
+    assert os.stat(tmp_path / "test_user.json").st_ino == inode
+
+    # another instance replacing the file is seen by the cached reader
+    FileLoginStateBackend(str(tmp_path)).complete("test_user", "session1", 'succeeded', 2.0)
+    assert backend.get("test_user")["status"] == 'succeeded'
@@ -1,7 +1,9 @@
+import asyncio
+import json
 import sys
 import os
 from fastapi.testclient import TestClient
-from unittest.mock import patch
+from unittest.mock import AsyncMock, patch
 
 # Set the X_AUTH_TOKEN environment variable for testing
 os.environ['X_AUTH_TOKEN'] = 'test_token'
@@ -11,7 +13,10 @@ os.environ['X_AUTH_TOKEN'] = 'test_token'
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../src")
 
 
+import src.api
 from src.api import app, TokenRequest
+from src.az_errors import AzCommandError
+from src.az_scheduler import SchedulerBusyError
 
 client = TestClient(app)
 
@@ -50,3 +55,146 @@ def test_get_token():
             assert "subscription" in response.json()
             assert "tenant" in response.json()
             assert "tokenType" in response.json()
+
+def test_scheduler_busy_returns_503_with_retry_after():
+    with patch('src.api.authenticator.get_version_async') as mock_get_version:
+        mock_get_version.side_effect = SchedulerBusyError("busy", retry_after=5)
+        response = client.get("/healthz", headers={"X-Auth-Token": os.getenv('X_AUTH_TOKEN')})
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "5"
+
+def test_get_batch_tokens():
+    user_id = "test_user"
+    token_info = {
+        "accessToken": "test_token",
+        "expiresOn": "2023-12-31 23:59:59.000000",
+        "expires_on": 1704067199,
+        "subscription": "test_subscription",
+        "tenant": "test_tenant",
+        "tokenType": "Bearer"
+    }
+
+    async def authenticate_async(user_id, resource, tenant_id=None, subscription_id=None, timeout=None):
+        if resource == "bad_resource":
+            raise AzCommandError("az account get-access-token failed", "permanent")
+        return token_info
+
+    token_requests = [{"resource": "test_resource", "tenantId": "test_tenant"}, {"resource": "bad_resource"}]
+    with patch('src.api.authenticator.check_az_login_async', new=AsyncMock(return_value=True)), \
+         patch('src.api.authenticator.authenticate_async', new=authenticate_async):
+        response = client.post(f"/tokens/{user_id}/batch", json=token_requests, headers={"X-Auth-Token": os.getenv('X_AUTH_TOKEN')})
+        assert response.status_code == 200
+        results = response.json()
+        assert results[0]["token"]["accessToken"] == "test_token"
+        assert results[0]["tenantId"] == "test_tenant"
+        assert results[1]["token"] is None
+        assert "failed" in results[1]["error"]
+        assert results[1]["error_class"] == "permanent"
+
+        response = client.post(f"/tokens/{user_id}/batch?stream=true", json=token_requests, headers={"X-Auth-Token": os.getenv('X_AUTH_TOKEN')})
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        results = sorted((json.loads(line) for line in response.text.splitlines()), key=lambda result: result["index"])
+        assert [result["index"] for result in results] == [0, 1]
+        assert results[0]["token"]["accessToken"] == "test_token"
+
+def test_get_subscriptions_with_etag():
+    user_id = "test_user"
+    subscriptions = [
+        {"id": "sub1", "name": "Production", "state": "Enabled", "tenantId": "tenant1"},
+        {"id": "sub2", "name": "Development", "state": "Disabled", "tenantId": "tenant1"},
+    ]
+    headers = {"X-Auth-Token": os.getenv('X_AUTH_TOKEN')}
+    with patch('src.api.authenticator.check_az_login_async', new=AsyncMock(return_value=True)), \
+         patch('src.api.authenticator.get_list_of_subscriptions_async', new=AsyncMock(return_value=subscriptions)):
+        response = client.get(f"/subscriptions/{user_id}?state=Enabled&fields=id,name", headers=headers)
+        assert response.status_code == 200
+        assert response.json() == [{"id": "sub1", "name": "Production"}]
+        etag = response.headers["ETag"]
+
+        response = client.get(f"/subscriptions/{user_id}?state=Enabled&fields=id,name", headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+
+        response = client.get(f"/subscriptions/{user_id}", headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 200
+        assert len(response.json()) == 2
+
+def test_get_metrics():
+    response = client.get("/metrics", headers={"X-Auth-Token": os.getenv('X_AUTH_TOKEN')})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert "# TYPE tokenflow_az_command_duration_seconds histogram" in response.text
+    assert "tokenflow_device_code_sessions_pending 0" in response.text
+
+def test_livez_and_readyz_do_not_start_az():
+    with patch('src.api.authenticator.get_version_async') as mock_get_version, \
+         patch.object(src.api.health_monitor, 'version', {"azure-cli": "2.99.0"}):
+        response = client.get("/livez", headers={"X-Auth-Token": os.getenv('X_AUTH_TOKEN')})
+        assert response.status_code == 200
+        assert response.json()["status"] == "up"
+
+        response = client.get("/readyz", headers={"X-Auth-Token": os.getenv('X_AUTH_TOKEN')})
+        assert response.status_code == 200
+        assert response.json()["status"] == "ready"
+
+        response = client.get("/healthz", headers={"X-Auth-Token": os.getenv('X_AUTH_TOKEN')})
+        assert response.status_code == 200
+        assert response.json()["version"] == {"azure-cli": "2.99.0"}
+
+        mock_get_version.assert_not_called()
+
+def test_az_error_class_is_returned_with_the_http_error():
+    authenticate_async = AsyncMock(side_effect=AzCommandError("AADSTS90002: Tenant not found", "permanent"))
+    with patch('src.api.authenticator.check_az_login_async', new=AsyncMock(return_value=True)), \
+         patch('src.api.authenticator.authenticate_async', new=authenticate_async):
+        response = client.post("/tenant_token/test_user", json={"resource": "test_resource", "tenantId": "unknown"},
+                               headers={"X-Auth-Token": os.getenv('X_AUTH_TOKEN'), "X-Request-Timeout": "5"})
+        assert response.status_code == 400
+        assert response.json()["error_class"] == "permanent"
+        assert authenticate_async.call_args.kwargs["timeout"] == 5
+
+        authenticate_async.side_effect = AzCommandError("429 Too Many Requests", "transient")
+        response = client.post("/token/test_user", json={"resource": "test_resource"},
+                               headers={"X-Auth-Token": os.getenv('X_AUTH_TOKEN')})
+        assert response.status_code == 503
+        assert response.json()["error_class"] == "transient"
+        assert "Retry-After" in response.headers
+
+def test_invalid_user_id_is_rejected():
+    response = client.get("/login-status/..%2Fescape", headers={"X-Auth-Token": os.getenv('X_AUTH_TOKEN')})
+    assert response.status_code in (400, 404)
+    response = client.get("/login-status/.hidden", headers={"X-Auth-Token": os.getenv('X_AUTH_TOKEN')})
+    assert response.status_code == 400
+
+def test_stream_tokens():
+    token_info = {
+        "accessToken": "test_token",
+        "expiresOn": "2023-12-31 23:59:59.000000",
+        "expires_on": 4102444799,
+        "subscription": "test_subscription",
+        "tenant": "test_tenant",
+        "tokenType": "Bearer"
+    }
+
+    async def authenticate_async(user_id, resource, tenant_id=None, subscription_id=None, timeout=None):
+        if resource == "bad_resource":
+            raise AzCommandError("AADSTS500011: resource not found", "permanent")
+        # a new login ends the subscription of the user right after the first token
+        asyncio.get_running_loop().call_soon(src.api.token_refresher.untrack_user, user_id)
+        return token_info
+
+    token_requests = [{"resource": "test_resource"}, {"resource": "bad_resource"}, {"resource": "test_resource"}]
+    with patch('src.api.authenticator.check_az_login_async', new=AsyncMock(return_value=True)), \
+         patch('src.api.authenticator.authenticate_async', new=authenticate_async):
+        response = client.post("/token-stream/test_user", json=token_requests, headers={"X-Auth-Token": os.getenv('X_AUTH_TOKEN')})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+
+        events = [(event.split("\n")[0].removeprefix("event: "), json.loads(event.split("\n")[1].removeprefix("data: ")))
+                  for event in response.text.strip().split("\n\n")]
+        tokens = sorted(data["index"] for name, data in events if name == "token")
+        errors = {data["index"]: data["error_class"] for name, data in events if name == "error"}
+        assert tokens == [0, 2]
+        assert errors == {0: "login_required", 1: "permanent", 2: "login_required"}
+        assert src.api.token_refresher.stats()["subscribers"] == 0
@@ -0,0 +1,73 @@
+import asyncio
+
+from src.metrics import CallbackGauge, Counter, Gauge, Histogram, MetricsMiddleware, MetricsRegistry, HTTP_REQUEST_DURATION
+
+
+def test_counter_and_gauge_render_by_label():
+    registry = MetricsRegistry()
+    exits = Counter('az_exits_total', 'Exit codes.', ('command', 'code'), registry=registry)
+    in_flight = Gauge('az_in_flight', 'Running commands.', registry=registry)
+
+    exits.labels('version', 0).inc()
+    exits.labels('version', 0).inc()
+    exits.labels('logout', 1).inc()
+    in_flight.inc()
+    in_flight.inc()
+    in_flight.dec()
+
+    text = registry.render()
+    assert '# TYPE az_exits_total counter' in text
+    assert 'az_exits_total{command="version",code="0"} 2' in text
+    assert 'az_exits_total{command="logout",code="1"} 1' in text
+    assert 'az_in_flight 1' in text
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = MetricsRegistry()
+    duration = Histogram('az_duration_seconds', 'Latency.', ('command',), buckets=(0.1, 1), registry=registry)
+
+    duration.labels('version').observe(0.05)
+    duration.labels('version').observe(0.5)
+    duration.labels('version').observe(5)
+
+    text = registry.render()
+    assert 'az_duration_seconds_bucket{command="version",le="0.1"} 1' in text
+    assert 'az_duration_seconds_bucket{command="version",le="1"} 2' in text
+    assert 'az_duration_seconds_bucket{command="version",le="+Inf"} 3' in text
+    assert 'az_duration_seconds_sum{command="version"} 5.55' in text
+    assert 'az_duration_seconds_count{command="version"} 3' in text
+
+
+def test_callback_gauge_reads_value_when_rendered():
+    registry = MetricsRegistry()
+    values = [3]
+    CallbackGauge('sessions_pending', 'Pending sessions.', lambda: values[0], registry=registry)
+
+    values[0] = 7
+    assert 'sessions_pending 7' in registry.render()
+
+
+def test_registering_a_name_again_replaces_the_metric():
+    registry = MetricsRegistry()
+    Counter('requests_total', 'Requests.', registry=registry).inc()
+    Counter('requests_total', 'Requests.', registry=registry)
+
+    assert 'requests_total 0' in registry.render()
+
+
+def test_middleware_records_route_template():
+    class Route:
+        path = '/token/{user_id}'
+
+    async def app(scope, receive, send):
+        scope['route'] = Route()
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def send(message):
+        pass
+
+    middleware = MetricsMiddleware(app)
+    asyncio.run(middleware({'type': 'http', 'method': 'POST', 'path': '/token/test_user'}, None, send))
+
+    assert HTTP_REQUEST_DURATION.labels('POST', '/token/{user_id}', 200).count == 1
@@ -0,0 +1,86 @@
+import json
+import os
+import shutil
+import pytest
+
+from src.msal_token_cache import MsalTokenCacheReader
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fixtures", "azure_config_dir")
+
+GRAPH = "https://graph.microsoft.com"
+MANAGEMENT = "https://management.core.windows.net/"
+DEFAULT_TENANT = "aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa"
+OTHER_TENANT = "bbbbbbbb-bbbb-bbbb-bbbb-bbbbbbbbbbbb"
+
+
+@pytest.fixture
+def config_dir(tmp_path):
+    shutil.copytree(FIXTURE_DIR, tmp_path, dirs_exist_ok=True)
+    return str(tmp_path)
+
+
+@pytest.fixture
+def reader():
+    return MsalTokenCacheReader()
+
+
+def test_get_token_for_default_subscription(reader, config_dir):
+    token_info = reader.get_token(config_dir, GRAPH)
+    assert token_info["accessToken"] == "graph_token"
+    assert token_info["expires_on"] == 4102444800
+    assert token_info["subscription"] == "11111111-1111-1111-1111-111111111111"
+    assert token_info["tenant"] == DEFAULT_TENANT
+    assert token_info["tokenType"] == "Bearer"
+    assert "expiresOn" in token_info
+
+
+def test_get_token_for_tenant(reader, config_dir):
+    token_info = reader.get_token(config_dir, MANAGEMENT, tenant_id=OTHER_TENANT)
+    assert token_info["accessToken"] == "other_tenant_management_token"
+    assert token_info["tenant"] == OTHER_TENANT
+    assert "subscription" not in token_info
+
+
+def test_get_token_for_subscription(reader, config_dir):
+    token_info = reader.get_token(config_dir, MANAGEMENT, subscription_id="Other Subscription")
+    assert token_info["accessToken"] == "other_tenant_management_token"
+    assert token_info["subscription"] == "22222222-2222-2222-2222-222222222222"
+
+
+def test_get_token_misses_expired_token(reader, config_dir):
+    assert reader.get_token(config_dir, MANAGEMENT) is None
+
+
+def test_get_token_misses_unknown_subscription(reader, config_dir):
+    assert reader.get_token(config_dir, GRAPH, subscription_id="unknown") is None
+
+
+def test_get_token_misses_without_cache_files(reader, tmp_path):
+    assert reader.get_token(str(tmp_path), GRAPH) is None
+    assert not reader.has_account(str(tmp_path))
+
+
+def test_has_account(reader, config_dir):
+    assert reader.has_account(config_dir)
+
+
+def test_files_are_parsed_again_only_when_changed(reader, config_dir):
+    path = os.path.join(config_dir, "msal_token_cache.json")
+    assert reader.get_token(config_dir, GRAPH)["accessToken"] == "graph_token"
+
+    with open(path) as file:
+        token_cache = json.load(file)
+    token_cache["AccessToken"]["graph-default-tenant"]["secret"] = "GRAPH_TOKEN"
+
+    stat = os.stat(path)
+    with open(path, "w") as file:
+        json.dump(token_cache, file)
+    with open(path, "a") as file:
+        file.write(" " * (stat.st_size - os.stat(path).st_size))
+
+    # same mtime and size as before, the parsed file is reused
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert reader.get_token(config_dir, GRAPH)["accessToken"] == "graph_token"
+
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert reader.get_token(config_dir, GRAPH)["accessToken"] == "GRAPH_TOKEN"
@@ -0,0 +1,70 @@
+import asyncio
+import pytest
+
+from src.single_flight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def run():
+        return await asyncio.gather(*(single_flight.do("key", work) for _ in range(10)))
+
+    assert asyncio.run(run()) == ["result"] * 10
+    assert len(calls) == 1
+    assert single_flight.stats() == {"executed": 1, "coalesced": 9, "in_flight": 0}
+
+
+def test_concurrent_calls_share_errors():
+    single_flight = SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.01)
+        raise ValueError("failed")
+
+    async def run():
+        return await asyncio.gather(*(single_flight.do("key", work) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert single_flight.executed == 1
+
+
+def test_different_keys_run_separately():
+    single_flight = SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def run():
+        return await asyncio.gather(single_flight.do("key1", work), single_flight.do("key2", work))
+
+    asyncio.run(run())
+    assert single_flight.executed == 2
+    assert single_flight.coalesced == 0
+
+
+def test_cancelled_caller_does_not_cancel_others():
+    single_flight = SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def run():
+        first = asyncio.create_task(single_flight.do("key", work))
+        second = asyncio.create_task(single_flight.do("key", work))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(run()) == "result"
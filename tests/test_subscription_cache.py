@@ -0,0 +1,48 @@
+import os
+import pytest
+
+from src.subscription_cache import SubscriptionCache, filter_subscriptions
+
+SUBSCRIPTIONS = [
+    {"id": "sub1", "name": "Production", "state": "Enabled", "tenantId": "tenant1", "isDefault": True},
+    {"id": "sub2", "name": "Development", "state": "Enabled", "tenantId": "tenant2", "isDefault": False},
+    {"id": "sub3", "name": "Old production", "state": "Disabled", "tenantId": "tenant1", "isDefault": False},
+]
+
+
+@pytest.fixture
+def config_dir(tmp_path):
+    (tmp_path / "azureProfile.json").write_text('{"subscriptions": []}')
+    return str(tmp_path)
+
+
+def test_get_returns_cached_subscriptions(config_dir):
+    cache = SubscriptionCache()
+    cache.put("test_user", config_dir, SUBSCRIPTIONS)
+    assert cache.get("test_user", config_dir) is SUBSCRIPTIONS
+
+
+def test_get_misses_when_profile_changes(config_dir):
+    cache = SubscriptionCache()
+    cache.put("test_user", config_dir, SUBSCRIPTIONS)
+
+    path = os.path.join(config_dir, "azureProfile.json")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    assert cache.get("test_user", config_dir) is None
+    assert len(cache) == 0
+
+
+def test_invalidate_user(config_dir):
+    cache = SubscriptionCache()
+    cache.put("test_user", config_dir, SUBSCRIPTIONS)
+    cache.invalidate_user("test_user")
+    assert cache.get("test_user", config_dir) is None
+
+
+def test_filter_subscriptions():
+    assert [s["id"] for s in filter_subscriptions(SUBSCRIPTIONS, tenant_id="TENANT1")] == ["sub1", "sub3"]
+    assert [s["id"] for s in filter_subscriptions(SUBSCRIPTIONS, state="enabled")] == ["sub1", "sub2"]
+    assert [s["id"] for s in filter_subscriptions(SUBSCRIPTIONS, name="production", state="Enabled")] == ["sub1"]
+    assert filter_subscriptions(SUBSCRIPTIONS, name="dev", fields=["id", "name", "unknown"]) == [{"id": "sub2", "name": "Development"}]
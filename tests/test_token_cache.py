@@ -0,0 +1,82 @@
+import time
+import pytest
+
+from src.token_cache import TokenCache
+
+
+def make_token(expires_in: int, access_token: str = "test_token"):
+    return {"accessToken": access_token, "expires_on": int(time.time()) + expires_in, "tokenType": "Bearer"}
+
+
+@pytest.fixture
+def cache():
+    return TokenCache(max_size=2, refresh_margin=60)
+
+
+def test_get_returns_cached_token(cache):
+    token = make_token(3600)
+    cache.put("test_user", "test_resource", token)
+    assert cache.get("test_user", "test_resource") is token
+    assert cache.hits == 1
+
+
+def test_get_misses_on_different_tenant(cache):
+    cache.put("test_user", "test_resource", make_token(3600))
+    assert cache.get("test_user", "test_resource", tenant_id="other_tenant") is None
+    assert cache.misses == 1
+
+
+def test_get_skips_token_within_refresh_margin(cache):
+    cache.put("test_user", "test_resource", make_token(30))
+    assert cache.get("test_user", "test_resource") is None
+    assert len(cache) == 0
+
+
+def test_put_evicts_least_recently_used(cache):
+    cache.put("user1", "test_resource", make_token(3600))
+    cache.put("user2", "test_resource", make_token(3600))
+    cache.get("user1", "test_resource")
+    cache.put("user3", "test_resource", make_token(3600))
+
+    assert cache.get("user2", "test_resource") is None
+    assert cache.get("user1", "test_resource") is not None
+    assert cache.get("user3", "test_resource") is not None
+
+
+def test_put_parses_expires_on_string(cache):
+    expires = time.localtime(time.time() + 3600)
+    token = {"accessToken": "test_token", "expiresOn": time.strftime('%Y-%m-%d %H:%M:%S.000000', expires)}
+    cache.put("test_user", "test_resource", token)
+    assert cache.get("test_user", "test_resource") is token
+
+
+def test_invalidate_user(cache):
+    cache.put("test_user", "test_resource", make_token(3600))
+    assert cache.has_user("test_user")
+    cache.invalidate_user("test_user")
+    assert not cache.has_user("test_user")
+    assert cache.get("test_user", "test_resource") is None
+
+
+def test_user_index_follows_eviction_and_expiry(cache):
+    cache.put("user1", "test_resource", make_token(3600))
+    cache.put("user1", "other_resource", make_token(30))
+    cache.put("user2", "test_resource", make_token(3600))
+
+    # user1's first token was evicted, the other one is within the refresh margin
+    assert not cache.has_user("user1")
+    assert cache.get("user1", "other_resource") is None
+    assert cache._user_keys == {"user2": {("user2", "test_resource", None, None)}}
+
+
+def test_not_before_skips_tokens_written_earlier(cache):
+    cache.put("test_user", "test_resource", make_token(3600))
+    written_at = time.time()
+
+    assert cache.has_user("test_user", not_before=written_at - 1)
+    assert cache.get("test_user", "test_resource", not_before=written_at - 1) is not None
+
+    # the user logged in again after the token was cached
+    assert not cache.has_user("test_user", not_before=written_at + 1)
+    assert cache.get("test_user", "test_resource", not_before=written_at + 1) is None
+    assert not cache.has_user("test_user")
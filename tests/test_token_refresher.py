@@ -0,0 +1,199 @@
+import asyncio
+import time
+from unittest.mock import MagicMock, patch
+
+from src.token_cache import TokenCache
+from src.token_refresher import TokenRefresher
+
+
+class FakeAuthenticator:
+    def __init__(self, expires_in: int = 3600):
+        self.token_cache = TokenCache()
+        self.expires_in = expires_in
+        self.calls = []
+        self.error = None
+
+    async def refresh_token_async(self, user_id, resource, tenant_id=None, subscription_id=None):
+        self.calls.append((user_id, resource, tenant_id, subscription_id))
+        if self.error is not None:
+            raise self.error
+        return {"accessToken": f"token{len(self.calls)}", "expires_on": int(time.time()) + self.expires_in}
+
+
+def make_token(expires_in: int):
+    return {"accessToken": "test_token", "expires_on": int(time.time()) + expires_in}
+
+
+def test_track_schedules_refresh_before_cache_margin():
+    refresher = TokenRefresher(FakeAuthenticator(), lead_time=60, jitter=60)
+    token = make_token(3600)
+    refresher.track("test_user", "test_resource", token)
+
+    entry = refresher._tracked[("test_user", "test_resource", None, None)]
+    assert token["expires_on"] - 120 - 120 <= entry["refresh_at"] <= token["expires_on"] - 120 - 60
+
+
+def test_refresh_due_refreshes_expiring_tokens():
+    authenticator = FakeAuthenticator()
+    refresher = TokenRefresher(authenticator, lead_time=60, jitter=0)
+    refresher.track("test_user", "test_resource", make_token(100), tenant_id="test_tenant")
+    refresher.track("other_user", "test_resource", make_token(3600))
+
+    async def main():
+        await refresher.refresh_due_async()
+        await asyncio.gather(*refresher._refreshing.values())
+
+    asyncio.run(main())
+    assert authenticator.calls == [("test_user", "test_resource", "test_tenant", None)]
+    assert refresher.refreshed == 1
+    entry = refresher._tracked[("test_user", "test_resource", "test_tenant", None)]
+    assert entry["refresh_at"] > time.time() + 3000
+
+
+def test_refresh_due_drops_idle_tokens():
+    authenticator = FakeAuthenticator()
+    refresher = TokenRefresher(authenticator, idle_timeout=60)
+    refresher.track("test_user", "test_resource", make_token(100))
+    refresher._tracked[("test_user", "test_resource", None, None)]["last_requested"] -= 120
+
+    asyncio.run(refresher.refresh_due_async())
+    assert refresher.stats()["tracked"] == 0
+    assert authenticator.calls == []
+
+
+def test_refresh_stops_when_login_is_required():
+    authenticator = FakeAuthenticator()
+    authenticator.error = Exception("Please run 'az login' to setup account.")
+    refresher = TokenRefresher(authenticator)
+    refresher.track("test_user", "test_resource", make_token(100))
+
+    async def main():
+        await refresher.refresh_due_async()
+        await asyncio.gather(*refresher._refreshing.values())
+
+    asyncio.run(main())
+    assert refresher.failed == 1
+    assert refresher.stats()["tracked"] == 0
+
+
+def test_stop_cancels_background_task():
+    refresher = TokenRefresher(MagicMock(), interval=0.01)
+
+    async def main():
+        refresher.start()
+        await asyncio.sleep(0.03)
+        await refresher.stop()
+
+    asyncio.run(main())
+    assert refresher._task is None
+
+
+def test_subscribers_share_one_refresh():
+    authenticator = FakeAuthenticator()
+    refresher = TokenRefresher(authenticator, lead_time=60, jitter=0)
+    key = ("test_user", "test_resource", None, None)
+
+    async def main():
+        first, second = asyncio.Queue(), asyncio.Queue()
+        refresher.subscribe(key, first)
+        refresher.subscribe(key, second)
+        refresher.track("test_user", "test_resource", make_token(100))
+        first.get_nowait()
+        second.get_nowait()
+
+        await refresher.refresh_due_async()
+        await asyncio.gather(*refresher._refreshing.values())
+        return first.get_nowait(), second.get_nowait()
+
+    first_event, second_event = asyncio.run(main())
+    assert len(authenticator.calls) == 1
+    assert first_event == second_event
+    assert first_event[1]["accessToken"] == "token1"
+
+
+def test_subscribed_tokens_are_not_dropped_when_idle():
+    refresher = TokenRefresher(FakeAuthenticator(), idle_timeout=60)
+    key = ("test_user", "test_resource", None, None)
+    queue = asyncio.Queue()
+    refresher.subscribe(key, queue)
+    refresher.track("test_user", "test_resource", make_token(3600))
+    refresher._tracked[key]["last_requested"] -= 120
+
+    asyncio.run(refresher.refresh_due_async())
+    assert refresher.stats()["tracked"] == 1
+
+    refresher.unsubscribe(key, queue)
+    refresher._tracked[key]["last_requested"] -= 120
+    asyncio.run(refresher.refresh_due_async())
+    assert refresher.stats() == {"tracked": 0, "refreshing": 0, "subscribers": 0, "refreshed": 0, "failed": 0}
+
+
+def test_subscribers_get_the_error_when_login_is_required():
+    refresher = TokenRefresher(FakeAuthenticator())
+    key = ("test_user", "test_resource", None, None)
+    queue = asyncio.Queue()
+    refresher.subscribe(key, queue)
+
+    refresher.untrack_user("test_user")
+
+    _, token_info, error = queue.get_nowait()
+    assert token_info is None
+    assert error.error_class == "login_required"
+
+
+class MsalLikeAuthenticator(FakeAuthenticator):
+    """
+    Hands back the token it has until it is valid for less than 5 minutes, like az.
+    """
+
+    def __init__(self, token: dict):
+        super().__init__()
+        self.token = token
+
+    async def refresh_token_async(self, user_id, resource, tenant_id=None, subscription_id=None):
+        self.calls.append((user_id, resource, tenant_id, subscription_id))
+        if self.token["expires_on"] - time.time() < 300:
+            self.token = {"accessToken": f"token{len(self.calls)}", "expires_on": int(time.time()) + 3600}
+        return self.token
+
+
+def test_refresh_with_default_settings_gets_a_new_token_before_the_cache_goes_stale():
+    token = make_token(3600)
+    authenticator = MsalLikeAuthenticator(token)
+    refresher = TokenRefresher(authenticator)
+    refresher.track("test_user", "test_resource", token)
+    authenticator.token_cache.put("test_user", "test_resource", token)
+
+    entry = refresher._tracked[("test_user", "test_resource", None, None)]
+    refresh_at = entry["refresh_at"]
+    assert token["expires_on"] - 300 < refresh_at
+
+    async def main():
+        await refresher.refresh_due_async()
+        await asyncio.gather(*refresher._refreshing.values())
+
+    with patch('time.time', return_value=refresh_at):
+        # the cached token is still served when the refresh is due
+        assert authenticator.token_cache.get("test_user", "test_resource") is token
+        asyncio.run(main())
+
+    # one az call got a new token, it was not retried for getting the same one back
+    assert len(authenticator.calls) == 1
+    assert entry["expires_on"] > token["expires_on"]
+
+
+def test_refresh_getting_the_same_token_back_is_retried_later():
+    token = make_token(3600)
+    authenticator = MsalLikeAuthenticator(token)
+    refresher = TokenRefresher(authenticator)
+    refresher.track("test_user", "test_resource", token)
+    entry = refresher._tracked[("test_user", "test_resource", None, None)]
+    entry["refresh_at"] = time.time()
+
+    async def main():
+        await refresher.refresh_due_async()
+        await asyncio.gather(*refresher._refreshing.values())
+
+    asyncio.run(main())
+    assert entry["expires_on"] == token["expires_on"]
+    assert time.time() + 25 < entry["refresh_at"] <= time.time() + 30
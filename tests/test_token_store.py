@@ -0,0 +1,166 @@
+import asyncio
+import sqlite3
+import threading
+import time
+
+from cryptography.fernet import Fernet
+
+from src.token_store import TokenStore
+
+
+def make_token(expires_in: int, access_token: str = "test_token"):
+    return {"accessToken": access_token, "expires_on": int(time.time()) + expires_in, "tokenType": "Bearer"}
+
+
+def test_tokens_survive_a_restart(tmp_path):
+    key = Fernet.generate_key()
+    path = str(tmp_path / "tokens.sqlite3")
+
+    async def write():
+        store = TokenStore(path, key)
+        store.put("test_user", "test_resource", make_token(3600))
+        store.put("test_user", "test_resource", make_token(3600, "tenant_token"), tenant_id="test_tenant")
+        await store.stop()
+
+    asyncio.run(write())
+
+    store = TokenStore(path, key)
+    assert store.get("test_user", "test_resource")["accessToken"] == "test_token"
+    assert store.get("test_user", "test_resource", tenant_id="test_tenant")["accessToken"] == "tenant_token"
+    assert store.get("test_user", "other_resource") is None
+    assert store.has_user("test_user")
+    assert not store.has_user("other_user")
+
+
+def test_tokens_are_encrypted_at_rest(tmp_path):
+    path = tmp_path / "tokens.sqlite3"
+
+    async def write():
+        store = TokenStore(str(path), Fernet.generate_key())
+        store.put("test_user", "test_resource", make_token(3600, "secret_access_token"))
+        await store.stop()
+
+    asyncio.run(write())
+
+    content = b''.join(file.read_bytes() for file in tmp_path.iterdir())
+    assert b"secret_access_token" not in content
+
+    # a store with another key does not serve the token
+    assert TokenStore(str(path), Fernet.generate_key()).get("test_user", "test_resource") is None
+
+
+def test_get_respects_min_validity(tmp_path):
+    store = TokenStore(str(tmp_path / "tokens.sqlite3"), Fernet.generate_key())
+    store.put("test_user", "test_resource", make_token(100))
+
+    assert store.get("test_user", "test_resource", min_validity=300) is None
+    assert store.get("test_user", "test_resource") is not None
+
+
+def test_invalidate_user_deletes_stored_tokens(tmp_path):
+    store = TokenStore(str(tmp_path / "tokens.sqlite3"), Fernet.generate_key())
+
+    async def main():
+        store.put("test_user", "test_resource", make_token(3600))
+        store.put("other_user", "test_resource", make_token(3600))
+        await store.flush_async()
+
+        store.invalidate_user("test_user")
+        assert store.get("test_user", "test_resource") is None
+        await store.flush_async()
+
+    asyncio.run(main())
+    assert store.get("test_user", "test_resource") is None
+    assert store.get("other_user", "test_resource") is not None
+    assert store.stats()["written"] == 2
+
+
+def test_prune_deletes_expired_tokens(tmp_path):
+    store = TokenStore(str(tmp_path / "tokens.sqlite3"), Fernet.generate_key())
+
+    async def main():
+        store.put("test_user", "expired_resource", make_token(-10))
+        store.put("test_user", "test_resource", make_token(3600))
+        await store.flush_async()
+        await store.prune_async()
+
+    asyncio.run(main())
+    assert store.pruned == 1
+    assert store.get("test_user", "test_resource") is not None
+
+
+def test_batch_being_written_is_read_until_it_is_committed(tmp_path):
+    store = TokenStore(str(tmp_path / "tokens.sqlite3"), Fernet.generate_key())
+    write = store._TokenStore__write
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_write(rows, deleted_users):
+        started.set()
+        release.wait(5)
+        write(rows, deleted_users)
+
+    async def main():
+        store.put("test_user", "test_resource", make_token(3600, "old_token"))
+        await store.flush_async()
+
+        # the user logs in again while the deletion is being written
+        store._TokenStore__write = slow_write
+        store.invalidate_user("test_user")
+        flush = asyncio.create_task(store.flush_async())
+        await asyncio.to_thread(started.wait, 5)
+
+        in_flight = (store.get("test_user", "test_resource"), store.has_user("test_user"))
+        store.put("test_user", "test_resource", make_token(3600, "new_token"))
+        queued = store.get("test_user", "test_resource")["accessToken"]
+
+        release.set()
+        await flush
+        await store.flush_async()
+        return in_flight, queued
+
+    in_flight, queued = asyncio.run(main())
+    assert in_flight == (None, False)
+    assert queued == "new_token"
+    assert store.get("test_user", "test_resource")["accessToken"] == "new_token"
+
+
+def test_failed_batch_does_not_bring_back_invalidated_tokens(tmp_path):
+    store = TokenStore(str(tmp_path / "tokens.sqlite3"), Fernet.generate_key())
+
+    def failing_write(rows, deleted_users):
+        # the user logs in again while the batch is being written
+        store.invalidate_user("test_user")
+        raise sqlite3.OperationalError("database is locked")
+
+    async def main():
+        store.put("test_user", "test_resource", make_token(3600))
+        store._TokenStore__write = failing_write
+        try:
+            await store.flush_async()
+        except sqlite3.OperationalError:
+            pass
+
+    asyncio.run(main())
+    assert store.get("test_user", "test_resource") is None
+    assert not store.has_user("test_user")
+
+
+def test_not_before_skips_tokens_written_earlier(tmp_path):
+    key = Fernet.generate_key()
+    path = str(tmp_path / "tokens.sqlite3")
+    store = TokenStore(path, key)
+    store.put("test_user", "test_resource", make_token(3600))
+    written_at = time.time()
+
+    assert store.has_user("test_user", not_before=written_at - 1)
+    assert not store.has_user("test_user", not_before=written_at + 1)
+    assert store.get("test_user", "test_resource", not_before=written_at + 1) is None
+
+    asyncio.run(store.stop())
+
+    # the time the token was written is stored with it
+    store = TokenStore(path, key)
+    assert store.get("test_user", "test_resource", not_before=written_at - 1) is not None
+    assert store.get("test_user", "test_resource", not_before=written_at + 1) is None
+    assert not store.has_user("test_user", not_before=written_at + 1)